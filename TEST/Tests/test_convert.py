@@ -2,7 +2,9 @@ import argparse
 import csv
 import datetime as dt
 import json
+import os
 import shutil
+import time
 from pathlib import Path
 
 import pydicom
@@ -135,7 +137,7 @@ def test_convert_excludes_derivative_series_by_series_number(tmp_path, monkeypat
             series_number = str(ds.SeriesNumber)
             (Path(output_directory) / f"{series_uid}---{ds.ContentTime}---{ds.SeriesDescription}---MPRAGE---{series_number}---.nii.gz").write_bytes(b"")
 
-    monkeypatch.setattr(dicom_reader, "random_tmp_directory", lambda: str(output_dir))
+    monkeypatch.setattr(dicom_reader, "random_tmp_directory", lambda parent_directory=None: str(output_dir))
     monkeypatch.setattr(dicom_reader, "run_dcm2niix_on_directory", _fake_run_dcm2niix_on_directory)
 
     dataset = dicom_reader.convert_dicom_directory(
@@ -157,7 +159,22 @@ def _run_main(monkeypatch, input_dir: Path, output_dir: Path, heuristic_file: Pa
               use_session_dates: bool | None = None,
               combine_sessions: bool | None = None,
               source_ids: list[str] | None = None,
-              debug: bool = False):
+              debug: bool = False,
+              jobs: int = 1,
+              header_index: Path | None = None,
+              rebuild_header_index: bool = False,
+              selective_conversion: bool = False,
+              plan: bool = False,
+              identifiers_from_dcm2niix: bool = False,
+              conversion_cache: Path | None = None,
+              conversion_cache_size: float | None = None,
+              skip_converted: bool = False,
+              watch: bool = False,
+              staged: bool = False,
+              stream: bool = False,
+              journal: bool = False,
+              resume: bool = False,
+              scratch_dir: Path | None = None):
     monkeypatch.setattr(
         convert,
         "parse_args",
@@ -172,6 +189,23 @@ def _run_main(monkeypatch, input_dir: Path, output_dir: Path, heuristic_file: Pa
             no_anonymize=False,
             verbose=False,
             debug=debug,
+            jobs=jobs,
+            header_index=str(header_index) if header_index else None,
+            rebuild_header_index=rebuild_header_index,
+            selective_conversion=selective_conversion,
+            plan=plan,
+            identifiers_from_dcm2niix=identifiers_from_dcm2niix,
+            conversion_cache=str(conversion_cache) if conversion_cache else None,
+            conversion_cache_size=conversion_cache_size,
+            skip_converted=skip_converted,
+            watch=watch,
+            settle_time=10,
+            poll_interval=2,
+            staged=staged,
+            stream=stream,
+            journal=journal,
+            resume=resume,
+            scratch_dir=str(scratch_dir) if scratch_dir else None,
         ),
     )
     convert.main()
@@ -205,6 +239,129 @@ def test_convert_omits_run_number_for_single_image(tmp_path, monkeypatch, basic_
     assert not any("run-" in path.name for path in (out_dir / "sub-SUBJ001").rglob("*.nii.gz"))
 
 
+def test_convert_staged_publishes_complete_subjects(tmp_path, monkeypatch, basic_heuristic):
+    out_dir = tmp_path / "bids"
+
+    _write_test_dicom(tmp_path / "batch1" / "scan1.dcm", "SUBJ001", "T1 MPRAGE", dt.datetime(2024, 1, 1, 8, 0, 0))
+    _run_main(monkeypatch, tmp_path / "batch1", out_dir, basic_heuristic, staged=True)
+    first_images = sorted((out_dir / "sub-SUBJ001").rglob("*.nii.gz"))
+    assert len(first_images) == 1
+    inode = first_images[0].stat().st_ino
+    directory_inode = (out_dir / "sub-SUBJ001").stat().st_ino
+
+    _write_test_dicom(tmp_path / "batch2" / "scan1.dcm", "SUBJ001", "T1 MPRAGE", dt.datetime(2024, 1, 1, 9, 0, 0))
+    _write_test_dicom(tmp_path / "batch2" / "scan2.dcm", "SUBJ002", "T1 MPRAGE", dt.datetime(2024, 1, 1, 9, 0, 0))
+    _run_main(monkeypatch, tmp_path / "batch2", out_dir, basic_heuristic, staged=True)
+
+    images = sorted((out_dir / "sub-SUBJ001").rglob("*.nii.gz"))
+    assert len(images) == 2
+    assert (out_dir / "sub-SUBJ001").stat().st_ino != directory_inode
+    # the files of the published subject were hard linked into the staging directory, not copied
+    assert inode in [image.stat().st_ino for image in images]
+    assert list((out_dir / "sub-SUBJ002").rglob("*.nii.gz"))
+    assert not list((out_dir / ".bidsmanager" / "staging").iterdir())
+
+
+def test_convert_resumes_interrupted_writes_without_running_dcm2niix_again(tmp_path, monkeypatch, basic_heuristic):
+    input_dir = tmp_path / "dicoms"
+    out_dir = tmp_path / "bids"
+    _write_test_dicom(input_dir / "a" / "scan1.dcm", "SUBJ001", "T1 MPRAGE", dt.datetime(2024, 1, 1, 8, 0, 0))
+    _write_test_dicom(input_dir / "b" / "scan1.dcm", "SUBJ002", "T1 MPRAGE", dt.datetime(2024, 1, 1, 9, 0, 0))
+
+    from bidsmanager.write.write_plan import WritePlan
+    execute_operation = WritePlan._execute_operation
+    executed = []
+
+    def _interrupted_execute_operation(plan, operation):
+        if len(executed) == 2:
+            raise KeyboardInterrupt()
+        executed.append(operation)
+        execute_operation(plan, operation)
+
+    monkeypatch.setattr(WritePlan, "_execute_operation", _interrupted_execute_operation)
+    with pytest.raises(KeyboardInterrupt):
+        _run_main(monkeypatch, input_dir, out_dir, basic_heuristic, journal=True)
+    journals = list((out_dir / ".bidsmanager" / "conversion_journals").iterdir())
+    assert [path.name for path in journals] and not list(journals[0].glob("*.pickle"))
+    assert sorted(path.name for path in journals[0].glob("*.json")) == ["dicom_headers.json", "write_plan.json"]
+    monkeypatch.setattr(WritePlan, "_execute_operation", execute_operation)
+
+    def _fail_dcm2niix(*args, **kwargs):
+        raise AssertionError("dcm2niix should not run again")
+
+    monkeypatch.setattr(dicom_reader, "run_dcm2niix_on_directory", _fail_dcm2niix)
+    _run_main(monkeypatch, input_dir, out_dir, basic_heuristic, resume=True)
+
+    assert list((out_dir / "sub-SUBJ001").rglob("*.nii.gz"))
+    assert list((out_dir / "sub-SUBJ002").rglob("*.nii.gz"))
+    assert list((out_dir / "sub-SUBJ002").rglob("*.json"))
+    assert not list((out_dir / ".bidsmanager" / "conversion_journals").iterdir())
+
+
+def test_failed_conversion_without_journal_leaves_no_resume_state(tmp_path, monkeypatch, basic_heuristic):
+    input_dir = tmp_path / "dicoms"
+    out_dir = tmp_path / "bids"
+    _write_test_dicom(input_dir / "scan1.dcm", "SUBJ001", "T1 MPRAGE", dt.datetime(2024, 1, 1, 8, 0, 0))
+
+    def _fail_dcm2niix(*args, **kwargs):
+        raise RuntimeError("dcm2niix failed")
+
+    monkeypatch.setattr(dicom_reader, "run_dcm2niix_on_directory", _fail_dcm2niix)
+    with pytest.raises(RuntimeError, match="dcm2niix failed"):
+        _run_main(monkeypatch, input_dir, out_dir, basic_heuristic)
+    assert not (out_dir / ".bidsmanager" / "conversion_journals").exists()
+
+
+def test_convert_writes_dcm2niix_outputs_to_the_scratch_directory(tmp_path, monkeypatch, basic_heuristic):
+    input_dir = tmp_path / "dicoms"
+    out_dir = tmp_path / "bids"
+    _write_test_dicom(input_dir / "scan1.dcm", "SUBJ001", "T1 MPRAGE", dt.datetime(2024, 1, 1, 8, 0, 0))
+    run_dcm2niix_on_directory = dicom_reader.run_dcm2niix_on_directory
+    output_directories = []
+
+    def _recording_run_dcm2niix_on_directory(input_directory, output_directory, **kwargs):
+        output_directories.append(output_directory)
+        run_dcm2niix_on_directory(input_directory, output_directory, **kwargs)
+
+    monkeypatch.setattr(dicom_reader, "run_dcm2niix_on_directory", _recording_run_dcm2niix_on_directory)
+    _run_main(monkeypatch, input_dir, out_dir, basic_heuristic)
+    assert Path(output_directories[0]).parent == tmp_path / ".bids.bidsmanager_scratch"
+    assert not (tmp_path / ".bids.bidsmanager_scratch").exists()
+    assert not (out_dir / ".bidsmanager" / "scratch").exists()
+    assert list((out_dir / "sub-SUBJ001").rglob("*.nii.gz"))
+
+    scratch_dir = tmp_path / "scratch"
+    _run_main(monkeypatch, input_dir, tmp_path / "bids2", basic_heuristic, scratch_dir=scratch_dir)
+    assert Path(output_directories[1]).parent == scratch_dir
+    assert not list(scratch_dir.iterdir())
+
+    plan_scratch_dir = tmp_path / "plan_scratch"
+    _run_main(monkeypatch, input_dir, tmp_path / "bids3", basic_heuristic, plan=True, scratch_dir=plan_scratch_dir)
+    assert len(output_directories) == 2
+    assert not plan_scratch_dir.exists()
+    assert not (tmp_path / "bids3" / ".bidsmanager").exists()
+
+
+def test_convert_checks_free_space_before_running_dcm2niix(tmp_path, monkeypatch, basic_heuristic):
+    input_dir = tmp_path / "dicoms"
+    _write_test_dicom(input_dir / "scan1.dcm", "SUBJ001", "T1 MPRAGE", dt.datetime(2024, 1, 1, 8, 0, 0))
+    checked_directories = []
+
+    def _no_free_space(path):
+        checked_directories.append(Path(path))
+        return 0
+
+    monkeypatch.setattr(dicom_reader, "get_free_space", _no_free_space)
+
+    def _fail_dcm2niix(*args, **kwargs):
+        raise AssertionError("dcm2niix should not run")
+
+    monkeypatch.setattr(dicom_reader, "run_dcm2niix_on_directory", _fail_dcm2niix)
+    with pytest.raises(RuntimeError, match="Not enough free space"):
+        _run_main(monkeypatch, input_dir, tmp_path / "bids", basic_heuristic)
+    assert checked_directories[0].parent == tmp_path / ".bids.bidsmanager_scratch"
+
+
 def test_convert_uses_csv_subject_mapping(tmp_path, monkeypatch, basic_heuristic):
     input_dir = tmp_path / "dicoms"
     out_dir = tmp_path / "bids"
@@ -511,7 +668,7 @@ def test_main_disables_temp_cleanup_in_debug_mode(tmp_path, monkeypatch, basic_h
 def test_convert_dicom_directory_cleans_temp_directory_by_default(tmp_path, monkeypatch):
     temp_dir = tmp_path / "tmp_dcm2niix"
 
-    def _fake_random_tmp_directory():
+    def _fake_random_tmp_directory(parent_directory=None):
         temp_dir.mkdir(parents=True, exist_ok=True)
         return str(temp_dir)
 
@@ -529,7 +686,7 @@ def test_convert_dicom_directory_cleans_temp_directory_by_default(tmp_path, monk
 def test_convert_dicom_directory_keeps_temp_directory_when_requested(tmp_path, monkeypatch):
     temp_dir = tmp_path / "tmp_dcm2niix_keep"
 
-    def _fake_random_tmp_directory():
+    def _fake_random_tmp_directory(parent_directory=None):
         temp_dir.mkdir(parents=True, exist_ok=True)
         return str(temp_dir)
 
@@ -565,7 +722,7 @@ def test_convert_handles_missing_acquisition_time_without_breaking(tmp_path, mon
         (Path(output_directory) / "1.1.1---20240101080000---T1 MPRAGE---MPRAGE---101---.nii.gz").write_bytes(b"")
         (Path(output_directory) / "2.2.2------T1 MPRAGE---MPRAGE---101---.nii.gz").write_bytes(b"")
 
-    monkeypatch.setattr(dicom_reader, "random_tmp_directory", lambda: str(output_dir))
+    monkeypatch.setattr(dicom_reader, "random_tmp_directory", lambda parent_directory=None: str(output_dir))
     monkeypatch.setattr(dicom_reader, "run_dcm2niix_on_directory", _fake_run_dcm2niix_on_directory)
 
     dataset = dicom_reader.convert_dicom_directory(
@@ -607,7 +764,7 @@ def test_convert_orders_runs_by_acquisition_time(tmp_path, monkeypatch, basic_he
         (Path(output_directory) / "1.1.1---20240101090000---T1 MPRAGE---MPRAGE---101---.nii.gz").write_bytes(b"")
         (Path(output_directory) / "2.2.2---20240101080000---T1 MPRAGE---MPRAGE---101---.nii.gz").write_bytes(b"")
 
-    monkeypatch.setattr(dicom_reader, "random_tmp_directory", lambda: str(output_dir))
+    monkeypatch.setattr(dicom_reader, "random_tmp_directory", lambda parent_directory=None: str(output_dir))
     monkeypatch.setattr(dicom_reader, "run_dcm2niix_on_directory", _fake_run_dcm2niix_on_directory)
 
     dataset = dicom_reader.convert_dicom_directory(
@@ -625,3 +782,614 @@ def test_convert_orders_runs_by_acquisition_time(tmp_path, monkeypatch, basic_he
     assert images_by_time[dt.datetime(2024, 1, 1, 9, 0, 0)].get_run_number() == 2
 
 
+
+
+def test_index_dicom_metadata_in_parallel_matches_serial(tmp_path):
+    input_dir = tmp_path / "dicoms"
+
+    _write_test_dicom(input_dir / "a" / "scan1.dcm", "SUBJ001", "T1 MPRAGE", dt.datetime(2024, 1, 1, 8, 0, 0),
+                      mrn="MRN001", series_instance_uid="1.1.1")
+    _write_test_dicom(input_dir / "a" / "scan2.dcm", "SUBJ001", "T1 MPRAGE", dt.datetime(2024, 1, 1, 8, 0, 0),
+                      mrn="MRN001", series_instance_uid="1.1.1")
+    _write_test_dicom(input_dir / "b" / "scan1.dcm", "SUBJ002", "T1 MPRAGE", dt.datetime(2024, 1, 1, 9, 0, 0),
+                      mrn="MRN002", series_instance_uid="2.2.2")
+    (input_dir / "b" / "notes.txt").write_text("not a dicom", encoding="utf-8")
+
+    serial = dicom_reader._index_dicom_metadata(str(input_dir), jobs=1)
+    parallel = dicom_reader._index_dicom_metadata(str(input_dir), jobs=2)
+
+    assert serial == parallel == {
+        "1.1.1": {"patient_name": "SUBJ001", "patient_id": "MRN001"},
+        "2.2.2": {"patient_name": "SUBJ002", "patient_id": "MRN002"},
+    }
+
+
+def test_index_follows_symlinked_series_directories(tmp_path):
+    input_dir = tmp_path / "in"
+    _write_test_dicom(tmp_path / "store" / "sub" / "f.dcm", "SUBJ003", "T1 MPRAGE", dt.datetime(2024, 1, 1, 8, 0, 0),
+                      series_instance_uid="3.3.3")
+    input_dir.mkdir()
+    (input_dir / "link").symlink_to(tmp_path / "store", target_is_directory=True)
+    # links back up the tree are only listed once
+    (tmp_path / "store" / "loop").symlink_to(input_dir, target_is_directory=True)
+
+    assert dicom_reader._list_input_files(str(input_dir)) == [str(input_dir / "link" / "sub" / "f.dcm")]
+    assert dicom_reader._index_dicom_metadata(str(input_dir)) == {
+        "3.3.3": {"patient_name": "SUBJ003", "patient_id": "SUBJ003"}}
+
+
+def test_main_passes_jobs_to_conversion(tmp_path, monkeypatch, basic_heuristic):
+    captured = {}
+
+    def _fake_convert_dicom_directory(**kwargs):
+        captured.update(kwargs)
+
+    monkeypatch.setattr("bidsmanager.read.dicom_reader.convert_dicom_directory", _fake_convert_dicom_directory)
+
+    _run_main(monkeypatch, tmp_path / "dicoms", tmp_path / "bids", basic_heuristic, jobs=4)
+
+    assert captured["jobs"] == 4
+
+
+def test_header_index_only_reads_new_files_and_can_be_rebuilt(tmp_path, monkeypatch):
+    input_dir = tmp_path / "dicoms"
+    index_file = tmp_path / "index" / "headers.sqlite"
+
+    _write_test_dicom(input_dir / "scan1.dcm", "SUBJ001", "T1 MPRAGE", dt.datetime(2024, 1, 1, 8, 0, 0),
+                      series_instance_uid="1.1.1")
+
+    read_files = []
+    read_dicom_header = dicom_reader._read_dicom_header
+
+    def _counting_read_dicom_header(file_path):
+        read_files.append(Path(file_path).name)
+        return read_dicom_header(file_path)
+
+    monkeypatch.setattr(dicom_reader, "_read_dicom_header", _counting_read_dicom_header)
+
+    first = dicom_reader._index_dicom_metadata(str(input_dir), header_index=str(index_file))
+    assert read_files == ["scan1.dcm"]
+
+    _write_test_dicom(input_dir / "scan2.dcm", "SUBJ002", "T1 MPRAGE", dt.datetime(2024, 1, 1, 9, 0, 0),
+                      series_instance_uid="2.2.2")
+    read_files.clear()
+    second = dicom_reader._index_dicom_metadata(str(input_dir), header_index=str(index_file))
+    assert read_files == ["scan2.dcm"]
+    assert first == {"1.1.1": {"patient_name": "SUBJ001", "patient_id": "SUBJ001"}}
+    assert set(second) == {"1.1.1", "2.2.2"}
+
+    read_files.clear()
+    rebuilt = dicom_reader._index_dicom_metadata(str(input_dir), header_index=str(index_file),
+                                                 rebuild_header_index=True)
+    assert sorted(read_files) == ["scan1.dcm", "scan2.dcm"]
+    assert rebuilt == second
+
+
+def test_header_index_is_not_written_without_pydicom(tmp_path, monkeypatch):
+    input_dir = tmp_path / "dicoms"
+    index_file = tmp_path / "index" / "headers.sqlite"
+    _write_test_dicom(input_dir / "scan1.dcm", "SUBJ001", "T1 MPRAGE", dt.datetime(2024, 1, 1, 8, 0, 0),
+                      series_instance_uid="1.1.1")
+
+    monkeypatch.setattr(dicom_reader, "_pydicom_available", lambda: False)
+    monkeypatch.setattr(dicom_reader, "_read_dicom_header", lambda file_path: None)
+    with pytest.warns(RuntimeWarning, match="header index"):
+        assert dicom_reader._index_dicom_files(str(input_dir), header_index=str(index_file)) == {}
+    monkeypatch.undo()
+
+    headers = dicom_reader._index_dicom_files(str(input_dir), header_index=str(index_file))
+    assert [header["series_instance_uid"] for header in headers.values()] == ["1.1.1"]
+
+
+def test_convert_runs_dcm2niix_per_series_in_parallel(tmp_path, monkeypatch, basic_heuristic):
+    input_dir = tmp_path / "dicoms"
+    out_dir = tmp_path / "bids"
+
+    for index, hour in enumerate((8, 9, 10)):
+        _write_test_dicom(input_dir / "scan{}.dcm".format(index), "SUBJ001", "T1 MPRAGE",
+                          dt.datetime(2024, 1, 1, hour, 0, 0), series_instance_uid="1.1.{}".format(index))
+
+    calls = []
+    run_dcm2niix_on_directory = dicom_reader.run_dcm2niix_on_directory
+
+    def _recording_run_dcm2niix_on_directory(input_directory, output_directory, **kwargs):
+        calls.append(input_directory)
+        run_dcm2niix_on_directory(input_directory, output_directory, **kwargs)
+
+    monkeypatch.setattr(dicom_reader, "run_dcm2niix_on_directory", _recording_run_dcm2niix_on_directory)
+
+    dataset = dicom_reader.convert_dicom_directory(
+        input_directory=str(input_dir),
+        heuristic=json.loads(basic_heuristic.read_text(encoding="utf-8")),
+        bids_directory=str(out_dir),
+        jobs=2,
+    )
+
+    assert len(calls) == 3
+    images = dataset.get_images(modality="T1w")
+    images_by_time = {image.get_metadata("AcquisitionTime"): image.get_run_number() for image in images}
+    assert images_by_time == {
+        dt.datetime(2024, 1, 1, 8, 0, 0): 1,
+        dt.datetime(2024, 1, 1, 9, 0, 0): 2,
+        dt.datetime(2024, 1, 1, 10, 0, 0): 3,
+    }
+    assert len(list((out_dir / "sub-SUBJ001" / "anat").glob("*.nii.gz"))) == 3
+
+
+def test_stream_writes_each_session_while_other_series_convert(tmp_path, monkeypatch, basic_heuristic):
+    input_dir = tmp_path / "dicoms"
+    out_dir = tmp_path / "bids"
+
+    for index, hour in enumerate((8, 9)):
+        _write_test_dicom(input_dir / "subj1_{}.dcm".format(index), "SUBJ001", "T1 MPRAGE",
+                          dt.datetime(2024, 1, 1, hour, 0, 0), series_instance_uid="1.1.{}".format(index))
+    _write_test_dicom(input_dir / "subj2.dcm", "SUBJ002", "rest", dt.datetime(2024, 1, 1, 8, 0, 0),
+                      series_instance_uid="1.2.0")
+
+    written_before_subj2 = []
+    run_dcm2niix_on_directory = dicom_reader.run_dcm2niix_on_directory
+
+    def _run_dcm2niix_after_subj1_is_written(input_directory, output_directory, **kwargs):
+        if any(name.endswith("subj2.dcm") for name in os.listdir(input_directory)):
+            # only a streamed conversion writes SUBJ001 while this series has not been converted yet
+            deadline = time.time() + 10
+            while time.time() < deadline and len(list(out_dir.glob("sub-SUBJ001/anat/*.nii.gz"))) < 2:
+                time.sleep(0.05)
+            written_before_subj2.append(len(list(out_dir.glob("sub-SUBJ001/anat/*.nii.gz"))))
+        run_dcm2niix_on_directory(input_directory, output_directory, **kwargs)
+
+    monkeypatch.setattr(dicom_reader, "run_dcm2niix_on_directory", _run_dcm2niix_after_subj1_is_written)
+
+    dataset = dicom_reader.convert_dicom_directory(
+        input_directory=str(input_dir),
+        heuristic=json.loads(basic_heuristic.read_text(encoding="utf-8")),
+        bids_directory=str(out_dir),
+        jobs=3,
+        stream=True,
+    )
+
+    assert written_before_subj2 == [2]
+    images = dataset.get_subject("SUBJ001").get_images(modality="T1w")
+    assert {image.get_metadata("AcquisitionTime"): image.get_run_number() for image in images} == {
+        dt.datetime(2024, 1, 1, 8, 0, 0): 1,
+        dt.datetime(2024, 1, 1, 9, 0, 0): 2,
+    }
+    assert (out_dir / "sub-SUBJ002" / "func" / "sub-SUBJ002_task-rest_bold.nii.gz").exists()
+    assert sorted(os.path.basename(row["bids_file"]) for row in
+                  dicom_reader._read_series_manifest(str(out_dir))) == ["sub-SUBJ001_run-01_T1w.nii.gz",
+                                                                        "sub-SUBJ001_run-02_T1w.nii.gz",
+                                                                        "sub-SUBJ002_task-rest_bold.nii.gz"]
+    with pytest.raises(ValueError):
+        dicom_reader.convert_dicom_directory(input_directory=str(input_dir), heuristic={},
+                                             bids_directory=str(out_dir), stream=True, journal=True)
+
+
+def test_convert_per_series_includes_files_without_an_indexed_series(tmp_path, monkeypatch, basic_heuristic):
+    input_dir = tmp_path / "dicoms"
+    for index, hour in enumerate((8, 9, 10)):
+        _write_test_dicom(input_dir / "scan{}.dcm".format(index), "SUBJ001", "T1 MPRAGE",
+                          dt.datetime(2024, 1, 1, hour, 0, 0), series_instance_uid="1.1.{}".format(index))
+    (input_dir / "notes.txt").write_text("not a DICOM file", encoding="utf-8")
+
+    read_dicom_headers = dicom_reader._read_dicom_headers
+
+    def _read_dicom_headers_failing_on_scan2(file_paths, jobs=1):
+        # e.g. a file pydicom cannot read without force=True
+        headers = read_dicom_headers(file_paths, jobs=jobs)
+        return [None if file_path.endswith("scan2.dcm") else header for file_path, header in zip(file_paths, headers)]
+
+    monkeypatch.setattr(dicom_reader, "_read_dicom_headers", _read_dicom_headers_failing_on_scan2)
+    heuristic = json.loads(basic_heuristic.read_text(encoding="utf-8"))
+
+    outputs = dict()
+    for jobs in (1, 2):
+        out_dir = tmp_path / "bids{}".format(jobs)
+        dicom_reader.convert_dicom_directory(input_directory=str(input_dir), heuristic=heuristic,
+                                             bids_directory=str(out_dir), jobs=jobs)
+        outputs[jobs] = sorted(path.relative_to(out_dir).as_posix() for path in out_dir.rglob("*.nii.gz"))
+
+    assert len(outputs[1]) == 3
+    assert outputs[2] == outputs[1]
+
+
+def test_convert_per_series_lists_input_once_and_skips_files_that_cannot_be_dicom(tmp_path, monkeypatch,
+                                                                                 basic_heuristic):
+    input_dir = tmp_path / "dicoms"
+    for index, hour in enumerate((8, 9)):
+        _write_test_dicom(input_dir / "scan{}.dcm".format(index), "SUBJ001", "T1 MPRAGE",
+                          dt.datetime(2024, 1, 1, hour, 0, 0), series_instance_uid="1.1.{}".format(index))
+    (input_dir / "notes.txt").write_text("not a DICOM file", encoding="utf-8")
+    (input_dir / "DICOMDIR").write_bytes(b"\0" * 128 + b"DICM")
+
+    listed = []
+    list_input_files = dicom_reader._list_input_files
+
+    def _recording_list_input_files(input_directory):
+        listed.append(input_directory)
+        return list_input_files(input_directory)
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("no unindexed file can be converted")
+
+    monkeypatch.setattr(dicom_reader, "_list_input_files", _recording_list_input_files)
+    monkeypatch.setattr(dicom_reader, "run_dcm2niix_on_unindexed_files", _fail)
+    dataset = dicom_reader.convert_dicom_directory(input_directory=str(input_dir),
+                                                   heuristic=json.loads(basic_heuristic.read_text(encoding="utf-8")),
+                                                   bids_directory=str(tmp_path / "bids"), jobs=2)
+
+    assert len(listed) == 1
+    assert len(dataset.get_images(modality="T1w")) == 2
+
+
+def test_selective_conversion_only_converts_series_that_map_to_a_modality(tmp_path, monkeypatch):
+    input_dir = tmp_path / "dicoms"
+    out_dir = tmp_path / "bids"
+
+    _write_test_dicom(input_dir / "t1.dcm", "SUBJ001", "T1 MPRAGE", dt.datetime(2024, 1, 1, 8, 0, 0),
+                      series_number=2, series_instance_uid="1.1.1")
+    _write_test_dicom(input_dir / "localizer.dcm", "SUBJ001", "AAHead_Scout", dt.datetime(2024, 1, 1, 8, 5, 0),
+                      series_number=1, series_instance_uid="2.2.2")
+    _write_test_dicom(input_dir / "derived.dcm", "SUBJ001", "T1 MPRAGE", dt.datetime(2024, 1, 1, 8, 10, 0),
+                      series_number=102, series_instance_uid="3.3.3")
+
+    converted = []
+    run_dcm2niix_on_directory = dicom_reader.run_dcm2niix_on_directory
+
+    def _recording_run_dcm2niix_on_directory(input_directory, output_directory, **kwargs):
+        converted.extend(str(path.resolve().name) for path in Path(input_directory).rglob("*") if path.is_file())
+        run_dcm2niix_on_directory(input_directory, output_directory, **kwargs)
+
+    monkeypatch.setattr(dicom_reader, "run_dcm2niix_on_directory", _recording_run_dcm2niix_on_directory)
+
+    heuristic = {
+        "SeriesDescription": [["T1_MPRAGE", {"modality": "T1w"}]],
+        "SeriesNumber": [[r"0[2-9]$", None]],
+    }
+    dataset = dicom_reader.convert_dicom_directory(
+        input_directory=str(input_dir),
+        heuristic=heuristic,
+        bids_directory=str(out_dir),
+        selective_conversion=True,
+    )
+
+    assert converted == ["t1.dcm"]
+    assert len(dataset.get_images(modality="T1w")) == 1
+
+
+def test_plan_predicts_layout_without_running_dcm2niix(tmp_path, monkeypatch, basic_heuristic):
+    input_dir = tmp_path / "dicoms"
+    out_dir = tmp_path / "bids"
+
+    _write_test_dicom(input_dir / "t1_a.dcm", "ALPHA", "T1 MPRAGE", dt.datetime(2024, 1, 2, 8, 0, 0),
+                      series_number=2)
+    _write_test_dicom(input_dir / "t1_b.dcm", "ALPHA", "T1 MPRAGE", dt.datetime(2024, 1, 2, 8, 0, 0),
+                      series_number=3)
+    _write_test_dicom(input_dir / "scout.dcm", "ALPHA", "Scout", dt.datetime(2024, 1, 2, 8, 0, 0), series_number=1)
+    _write_test_dicom(input_dir / "other.dcm", "BETA", "T1 MPRAGE", dt.datetime(2024, 1, 3, 8, 0, 0))
+
+    mapping_csv = tmp_path / "subject_map.csv"
+    mapping_csv.write_text("source_patient_name,bids_subject\nALPHA,001\n", encoding="utf-8")
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("dcm2niix must not run in plan mode")
+
+    monkeypatch.setattr(dicom_reader, "run_dcm2niix_on_directory", _fail)
+
+    _run_main(monkeypatch, input_dir, out_dir, basic_heuristic, subject_map=mapping_csv,
+              source_ids=["patient_name"], use_session_dates=True, plan=True)
+
+    with (out_dir / "source" / "conversion_plan.csv").open(newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+
+    assert sorted(row["filename"] for row in rows if row["status"] == "convert") == [
+        "sub-001/ses-20240102/anat/sub-001_ses-20240102_run-01_T1w.nii.gz",
+        "sub-001/ses-20240102/anat/sub-001_ses-20240102_run-02_T1w.nii.gz",
+    ]
+    assert [row["status"] for row in rows].count("skipped") == 1
+    assert [row["status"] for row in rows].count("unmatched") == 1
+    assert not list(out_dir.rglob("*.nii.gz"))
+
+
+def test_identifiers_from_dcm2niix_skips_header_indexing(tmp_path, monkeypatch, basic_heuristic):
+    input_dir = tmp_path / "dicoms"
+    out_dir = tmp_path / "bids"
+
+    _write_test_dicom(input_dir / "scan_a.dcm", "DOE^JANE", "T1 MPRAGE", dt.datetime(2024, 1, 8, 8, 0, 0),
+                      mrn="00 123")
+    _write_test_dicom(input_dir / "scan_b.dcm", "ROE^JOHN", "T1 MPRAGE", dt.datetime(2024, 1, 8, 9, 0, 0),
+                      mrn="MRN456")
+
+    mapping_csv = tmp_path / "subject_map.csv"
+    mapping_csv.write_text("source_patient_id,bids_subject\n00 123,401\nMRN456,402\n", encoding="utf-8")
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("DICOM headers must not be indexed")
+
+    monkeypatch.setattr(dicom_reader, "_index_dicom_files", _fail)
+
+    _run_main(monkeypatch, input_dir, out_dir, basic_heuristic, subject_map=mapping_csv,
+              source_ids=["patient_id"], identifiers_from_dcm2niix=True)
+
+    assert (out_dir / "sub-401").is_dir()
+    assert (out_dir / "sub-402").is_dir()
+
+
+def test_conversion_cache_reuses_outputs_after_heuristic_change(tmp_path, monkeypatch, basic_heuristic):
+    input_dir = tmp_path / "dicoms"
+    cache_dir = tmp_path / "cache"
+
+    _write_test_dicom(input_dir / "scan1.dcm", "SUBJ001", "T1 MPRAGE", dt.datetime(2024, 1, 1, 8, 0, 0))
+    _write_test_dicom(input_dir / "scan2.dcm", "SUBJ001", "rest", dt.datetime(2024, 1, 1, 9, 0, 0))
+
+    calls = []
+    run_dcm2niix_on_directory = dicom_reader.run_dcm2niix_on_directory
+
+    def _recording_run_dcm2niix_on_directory(input_directory, output_directory, **kwargs):
+        calls.append(input_directory)
+        run_dcm2niix_on_directory(input_directory, output_directory, **kwargs)
+
+    monkeypatch.setattr(dicom_reader, "run_dcm2niix_on_directory", _recording_run_dcm2niix_on_directory)
+
+    heuristic = json.loads(basic_heuristic.read_text(encoding="utf-8"))
+    first = dicom_reader.convert_dicom_directory(input_directory=str(input_dir), heuristic=heuristic,
+                                                 bids_directory=str(tmp_path / "bids_1"),
+                                                 conversion_cache=str(cache_dir))
+    assert len(calls) == 2
+    assert len(first.get_images(modality="bold")) == 1
+
+    heuristic["SeriesDescription"][1] = ["rest", {"modality": "bold", "task": "resting"}]
+    calls.clear()
+    second = dicom_reader.convert_dicom_directory(input_directory=str(input_dir), heuristic=heuristic,
+                                                  bids_directory=str(tmp_path / "bids_2"),
+                                                  conversion_cache=str(cache_dir))
+    assert calls == []
+    assert len(second.get_images(task="resting")) == 1
+    assert (tmp_path / "bids_2" / "sub-SUBJ001" / "func" / "sub-SUBJ001_task-resting_bold.json").exists()
+
+    dicom_reader.ConversionCache(str(cache_dir), max_size=0).evict()
+    assert dicom_reader.ConversionCache(str(cache_dir)).entries() == []
+
+
+def test_conversion_cache_evicts_least_recently_used_without_rescanning(tmp_path, monkeypatch):
+    cache = dicom_reader.ConversionCache(str(tmp_path / "cache"), max_size=20)
+    (tmp_path / "restored").mkdir()
+    scans = []
+    entries = cache.entries
+
+    def _recording_entries():
+        scans.append(True)
+        return entries()
+
+    monkeypatch.setattr(cache, "entries", _recording_entries)
+
+    keys = []
+    for index in range(3):
+        output_file = tmp_path / "series_{}.nii.gz".format(index)
+        output_file.write_bytes(b"0" * 10)
+        keys.append("{:02d}".format(index) * 32)
+        cache.put(keys[-1], [str(output_file)])
+        if index == 1:
+            # using the first entry makes the second one the least recently used
+            assert cache.get(keys[0], str(tmp_path / "restored"))
+    assert len(scans) == 1
+    assert cache.get(keys[0], str(tmp_path / "restored"))
+    assert cache.get(keys[1], str(tmp_path / "restored")) is None
+    assert cache.get(keys[2], str(tmp_path / "restored"))
+
+
+def test_rerun_skips_series_recorded_in_manifest(tmp_path, monkeypatch, basic_heuristic):
+    input_dir = tmp_path / "dicoms"
+    out_dir = tmp_path / "bids"
+
+    _write_test_dicom(input_dir / "scan1.dcm", "SUBJ500", "T1 MPRAGE", dt.datetime(2024, 8, 1, 8, 0, 0))
+    _run_main(monkeypatch, input_dir, out_dir, basic_heuristic)
+
+    manifest = (out_dir / "source" / "series_manifest.csv").read_text(encoding="utf-8")
+    assert "sub-SUBJ500/anat/sub-SUBJ500_T1w.nii.gz" in manifest
+
+    _write_test_dicom(input_dir / "scan2.dcm", "SUBJ500", "rest", dt.datetime(2024, 8, 1, 9, 0, 0))
+    converted = []
+    run_dcm2niix_on_directory = dicom_reader.run_dcm2niix_on_directory
+
+    def _recording_run_dcm2niix_on_directory(input_directory, output_directory, **kwargs):
+        converted.extend(path.resolve().name for path in Path(input_directory).rglob("*") if path.is_file())
+        run_dcm2niix_on_directory(input_directory, output_directory, **kwargs)
+
+    monkeypatch.setattr(dicom_reader, "run_dcm2niix_on_directory", _recording_run_dcm2niix_on_directory)
+    _run_main(monkeypatch, input_dir, out_dir, basic_heuristic, skip_converted=True)
+
+    assert converted == ["scan2.dcm"]
+    assert [path.name for path in (out_dir / "sub-SUBJ500").rglob("*.nii.gz")
+            if "T1w" in path.name] == ["sub-SUBJ500_T1w.nii.gz"]
+    assert (out_dir / "sub-SUBJ500" / "func" / "sub-SUBJ500_task-rest_bold.nii.gz").exists()
+    scans_tsv = (out_dir / "sub-SUBJ500" / "sub-SUBJ500_scans.tsv").read_text(encoding="utf-8")
+    assert "anat/sub-SUBJ500_T1w.nii.gz" in scans_tsv
+    assert "func/sub-SUBJ500_task-rest_bold.nii.gz" in scans_tsv
+
+
+def test_run_dcm2niix_on_series_reports_each_series_as_it_finishes(tmp_path, monkeypatch):
+    input_dir = tmp_path / "dicoms"
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    files_by_series_uid = {}
+    for series_uid in ("1.1", "2.2", "3.3"):
+        path = input_dir / "{}.dcm".format(series_uid)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"")
+        files_by_series_uid[series_uid] = [str(path)]
+
+    def _fake_run_dcm2niix_on_directory(input_directory, output_directory, **kwargs):
+        for link in Path(input_directory).iterdir():
+            series_uid = link.resolve().stem
+            (Path(output_directory) / "{}---.nii.gz".format(series_uid)).write_bytes(b"")
+
+    monkeypatch.setattr(dicom_reader, "run_dcm2niix_on_directory", _fake_run_dcm2niix_on_directory)
+
+    reported = {}
+
+    def _on_series_converted(series_uid, output_files):
+        assert all(Path(output_file).exists() for output_file in output_files)
+        reported[series_uid] = [Path(output_file).name for output_file in output_files]
+
+    outputs = dicom_reader.run_dcm2niix_on_series(files_by_series_uid, str(output_dir), filename="%j---", jobs=2,
+                                                  on_series_converted=_on_series_converted)
+
+    assert reported == {"1.1": ["1.1---.nii.gz"], "2.2": ["2.2---.nii.gz"], "3.3": ["3.3---.nii.gz"]}
+    assert sorted(outputs) == sorted(reported)
+    assert sorted(path.name for path in output_dir.iterdir()) == ["1.1---.nii.gz", "2.2---.nii.gz", "3.3---.nii.gz"]
+
+    with pytest.raises(ValueError, match="%j"):
+        dicom_reader.run_dcm2niix_on_series(files_by_series_uid, str(output_dir), filename="%t%d")
+
+
+def test_inbox_watcher_converts_each_series_once_it_settles(tmp_path, basic_heuristic):
+    from bidsmanager.read.ingest import DicomInboxWatcher
+
+    inbox = tmp_path / "inbox"
+    out_dir = tmp_path / "bids"
+    heuristic = json.loads(basic_heuristic.read_text(encoding="utf-8"))
+    watcher = DicomInboxWatcher(str(inbox), str(out_dir), heuristic, settle_time=10)
+
+    _write_test_dicom(inbox / "t1.dcm", "SUBJ600", "T1 MPRAGE", dt.datetime(2024, 9, 1, 8, 0, 0),
+                      series_instance_uid="1.2.600.1")
+    assert len(watcher.poll(now=0)) == 1
+    assert watcher.poll(now=3) == []
+    _write_test_dicom(inbox / "rest.dcm", "SUBJ600", "rest", dt.datetime(2024, 9, 1, 9, 0, 0),
+                      series_instance_uid="1.2.600.2")
+    watcher.poll(now=5)
+
+    assert watcher.get_ready_series(now=9) == []
+    assert watcher.get_ready_series(now=12) == ["1.2.600.1"]
+    watcher.convert_series("1.2.600.1")
+    assert (out_dir / "sub-SUBJ600" / "anat" / "sub-SUBJ600_T1w.nii.gz").exists()
+    assert not (out_dir / "sub-SUBJ600" / "func").exists()
+
+    assert watcher.get_ready_series(now=15) == ["1.2.600.2"]
+    watcher.convert_series("1.2.600.2")
+    assert (out_dir / "sub-SUBJ600" / "func" / "sub-SUBJ600_task-rest_bold.nii.gz").exists()
+    assert [path.name for path in (out_dir / "sub-SUBJ600").rglob("*T1w.nii.gz")] == ["sub-SUBJ600_T1w.nii.gz"]
+
+    _write_test_dicom(inbox / "t1_late.dcm", "SUBJ600", "T1 MPRAGE", dt.datetime(2024, 9, 1, 8, 0, 0),
+                      series_instance_uid="1.2.600.1")
+    with pytest.warns(RuntimeWarning, match="arrived after series 1.2.600.1 was converted"):
+        watcher.poll(now=20)
+    assert watcher.get_ready_series(now=40) == []
+    with open(out_dir / "source" / "unconverted_series.csv", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [(row["series_instance_uid"], row["status"], Path(row["source_file"]).name) for row in rows] == [
+        ("1.2.600.1", "arrived_after_conversion", "t1_late.dcm")]
+
+    for path in inbox.iterdir():
+        path.unlink()
+    watcher.poll(now=50)
+    assert watcher._file_stats == {}
+    assert watcher._finished_files == {}
+
+
+def test_inbox_watcher_forgets_pending_files_removed_from_the_inbox(tmp_path, basic_heuristic):
+    from bidsmanager.read.ingest import DicomInboxWatcher
+
+    inbox = tmp_path / "inbox"
+    out_dir = tmp_path / "bids"
+    heuristic = json.loads(basic_heuristic.read_text(encoding="utf-8"))
+    watcher = DicomInboxWatcher(str(inbox), str(out_dir), heuristic, settle_time=10)
+    for index in range(2):
+        _write_test_dicom(inbox / "t1_{}.dcm".format(index), "SUBJ640", "T1 MPRAGE", dt.datetime(2024, 9, 5, 8, 0, 0),
+                          series_instance_uid="1.2.640.1")
+    _write_test_dicom(inbox / "rest.dcm", "SUBJ640", "rest", dt.datetime(2024, 9, 5, 9, 0, 0),
+                      series_instance_uid="1.2.640.2")
+    watcher.poll(now=0)
+    (inbox / "t1_1.dcm").unlink()
+    (inbox / "rest.dcm").unlink()
+    watcher.poll(now=5)
+
+    assert [Path(file_path).name for file_path in watcher._pending_files["1.2.640.1"]] == ["t1_0.dcm"]
+    assert "1.2.640.2" not in watcher._pending_files
+    assert watcher.get_ready_series(now=20) == ["1.2.640.1"]
+    assert watcher.convert_series("1.2.640.1", now=20) is not None
+    assert (out_dir / "sub-SUBJ640" / "anat" / "sub-SUBJ640_T1w.nii.gz").exists()
+    assert not (out_dir / "source" / "unconverted_series.csv").exists()
+
+
+def test_inbox_watcher_keeps_scans_rows_of_earlier_series(tmp_path, basic_heuristic):
+    from bidsmanager.read.ingest import DicomInboxWatcher
+    from bidsmanager.utils.utils import read_tsv
+
+    inbox = tmp_path / "inbox"
+    out_dir = tmp_path / "bids"
+    heuristic = json.loads(basic_heuristic.read_text(encoding="utf-8"))
+    watcher = DicomInboxWatcher(str(inbox), str(out_dir), heuristic, settle_time=10)
+    _write_test_dicom(inbox / "t1.dcm", "S1", "T1 MPRAGE", dt.datetime(2024, 9, 3, 8, 0, 0),
+                      series_instance_uid="1.2.620.1")
+    _write_test_dicom(inbox / "rest.dcm", "S1", "rest", dt.datetime(2024, 9, 3, 9, 0, 0),
+                      series_instance_uid="1.2.620.2")
+    watcher.poll(now=0)
+    watcher.convert_series("1.2.620.1")
+    watcher.convert_series("1.2.620.2")
+
+    rows = read_tsv(str(out_dir / "sub-S1" / "sub-S1_scans.tsv"))
+    assert sorted(rows) == ["anat/sub-S1_T1w.nii.gz", "func/sub-S1_task-rest_bold.nii.gz"]
+    assert rows["anat/sub-S1_T1w.nii.gz"]["AcquisitionTime"] == dt.datetime(2024, 9, 3, 8, 0, 0)
+
+
+def test_inbox_watcher_reads_each_header_once(tmp_path, monkeypatch, basic_heuristic):
+    from bidsmanager.read.ingest import DicomInboxWatcher
+
+    inbox = tmp_path / "inbox"
+    heuristic = json.loads(basic_heuristic.read_text(encoding="utf-8"))
+    watcher = DicomInboxWatcher(str(inbox), str(tmp_path / "bids"), heuristic, settle_time=10)
+    for index in range(3):
+        _write_test_dicom(inbox / "t1_{}.dcm".format(index), "SUBJ630", "T1 MPRAGE", dt.datetime(2024, 9, 4, 8, 0, 0),
+                          series_instance_uid="1.2.630.1")
+    read_headers = []
+    read_dicom_header = dicom_reader._read_dicom_header
+
+    def _recording_read_dicom_header(file_path):
+        read_headers.append(Path(file_path).resolve().name)
+        return read_dicom_header(file_path)
+
+    monkeypatch.setattr(dicom_reader, "_read_dicom_header", _recording_read_dicom_header)
+    watcher.poll(now=0)
+    watcher.convert_series("1.2.630.1")
+
+    assert sorted(read_headers) == ["t1_0.dcm", "t1_1.dcm", "t1_2.dcm"]
+    assert (tmp_path / "bids" / "sub-SUBJ630" / "anat" / "sub-SUBJ630_T1w.nii.gz").exists()
+    assert watcher._headers == {}
+
+
+def test_inbox_watcher_retries_series_that_fail_to_convert(tmp_path, monkeypatch, basic_heuristic):
+    from bidsmanager.read.ingest import DicomInboxWatcher
+
+    inbox = tmp_path / "inbox"
+    out_dir = tmp_path / "bids"
+    heuristic = json.loads(basic_heuristic.read_text(encoding="utf-8"))
+    watcher = DicomInboxWatcher(str(inbox), str(out_dir), heuristic, settle_time=10, max_retries=1)
+    _write_test_dicom(inbox / "t1.dcm", "SUBJ610", "T1 MPRAGE", dt.datetime(2024, 9, 2, 8, 0, 0),
+                      series_instance_uid="1.2.610.1")
+    watcher.poll(now=0)
+
+    def _failing_convert_dicom_directory(**kwargs):
+        raise RuntimeError("dcm2niix failed")
+
+    monkeypatch.setattr(dicom_reader, "convert_dicom_directory", _failing_convert_dicom_directory)
+    with pytest.warns(RuntimeWarning, match="tried again"):
+        assert watcher.convert_series("1.2.610.1", now=10) is None
+    assert watcher.get_ready_series(now=15) == []
+    assert watcher.get_ready_series(now=20) == ["1.2.610.1"]
+    with pytest.warns(RuntimeWarning, match="unconverted_series.csv"):
+        watcher.convert_series("1.2.610.1", now=20)
+    assert watcher.get_ready_series(now=100) == []
+    with open(out_dir / "source" / "unconverted_series.csv", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [(row["status"], Path(row["source_file"]).name, row["error"]) for row in rows] == [
+        ("failed", "t1.dcm", "dcm2niix failed")]
+
+    monkeypatch.undo()
+    watcher = DicomInboxWatcher(str(inbox), str(out_dir), heuristic, settle_time=10)
+    watcher.poll(now=0)
+    monkeypatch.setattr(dicom_reader, "convert_dicom_directory", _failing_convert_dicom_directory)
+    with pytest.warns(RuntimeWarning, match="tried again"):
+        watcher.convert_series("1.2.610.1", now=10)
+    monkeypatch.undo()
+    watcher.convert_series("1.2.610.1", now=20)
+    assert (out_dir / "sub-SUBJ610" / "anat" / "sub-SUBJ610_T1w.nii.gz").exists()
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 from unittest import TestCase
 from datetime import datetime
@@ -31,5 +34,22 @@ class TestGroup(TestCase):
         ])
         self.assertEqual([image.get_run_number() for image in images], [1, 2])
 
+    def test_assign_run_numbers_skips_runs_on_disk(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for basename in ("run-01_T1w.nii", "run-02_T1w.nii", "FLAIR.nii"):
+                open(os.path.join(directory, basename), "w").close()
+            group = Group(name="anat", path=directory)
+            group.add_images([Image(modality="T1w"), Image(modality="T1w"), Image(modality="FLAIR"),
+                              Image(modality="T2w")])
+
+            group.prepare_images_for_write()
+
+            self.assertEqual(sorted(image.get_basename() for image in group.get_all_images()),
+                             ["T2w.nii", "run-01_FLAIR.nii", "run-03_T1w.nii", "run-04_T1w.nii"])
+        finally:
+            shutil.rmtree(directory)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -57,9 +57,9 @@ class TestImage(TestCase):
         write_json(json_data, tmp_json)
         image = read_image_from_bids_path(tmp_file)
 
-        # lazy loading (disabled for now)
-        # self.assertFalse(image._sidecar_metadata)
-        # self.assertEqual(image.get_metadata(), json_data)
+        # lazy loading
+        self.assertFalse(image._sidecar_loaded)
+        self.assertEqual(image.get_metadata(), json_data)
         self.assertTrue(image._sidecar_metadata)
 
         image._run = 6
@@ -148,6 +148,20 @@ class TestImage(TestCase):
         for fn in (image.get_path(), image.get_bval_path(), image.get_bvec_path(), image.get_sidecar_path()):
             os.remove(fn)
 
+    def test_update_sidecar_and_diffusion_files_without_a_plan(self):
+        image = Image(modality="dwi", extension=".nii.gz", bval_path="./bval", bvec_path="./bvec")
+        image.add_metadata("EchoTime", 0.1)
+        image.set_path("./sub-01_dwi.nii.gz")
+        self.touch(image.get_bval_path())
+        self.touch(image.get_bvec_path())
+        image.update_sidecar(move=False)
+        image.update_diffusion_files(move=False)
+        for filename in ("sub-01_dwi.json", "sub-01_dwi.bval", "sub-01_dwi.bvec"):
+            self._filenames_to_delete.add(filename)
+            self.assertTrue(os.path.exists(filename))
+        self.assertEqual(read_json("sub-01_dwi.json"), {"EchoTime": 0.1})
+        self.assertEqual(os.path.abspath(image.get_bval_path()), os.path.abspath("sub-01_dwi.bval"))
+
     def touch(self, filename):
         touch(filename)
         self._filenames_to_delete.add(filename)
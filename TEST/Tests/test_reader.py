@@ -1,6 +1,8 @@
 import glob
 import os
+import shutil
 import sqlite3
+import tempfile
 from unittest import TestCase
 from datetime import date, datetime
 
@@ -69,6 +71,13 @@ class TestReaderDataSet001(TestCase):
                                                                            "ds001", "sub-*", "anat", "*T1w.nii.gz"))]
         self.assertEqual(sorted(t1_images), sorted(t1_glob_list))
 
+    def test_read_dataset_in_parallel(self):
+        dataset = read_dataset(os.path.join(get_bids_examples_directory(), "ds001"), jobs=4)
+        self.assertEqual(dataset.get_subject_ids(), self.dataset.get_subject_ids())
+        self.assertEqual(sorted(dataset.get_image_paths()), sorted(self.dataset.get_image_paths()))
+        self.assertEqual(sorted(image.sidecar_path for image in dataset.get_images() if image.sidecar_path),
+                         sorted(image.sidecar_path for image in self.dataset.get_images() if image.sidecar_path))
+
     def test_dataset_path(self):
         self.assertEqual(os.path.join(get_bids_examples_directory(), "ds001"), self.dataset.get_path())
 
@@ -175,6 +184,21 @@ class TestReaderDataSet114(TestCase):
         subject = self.dataset.get_subject("05")
         self.assertEqual(os.path.join(self.ds_path, "sub-05"), subject.get_path())
 
+    def test_lazy_read_only_loads_the_queried_subject(self):
+        dataset = read_dataset(self.ds_path, lazy=True)
+        self.assertEqual(dataset.get_subject_ids(), self.dataset.get_subject_ids())
+        self.assertFalse(any(subject.is_loaded() for subject in dataset.get_subjects()))
+        subject = dataset.get_subject("03")
+        self.assertEqual(set(subject.get_session_names()), {"test", "retest"})
+        self.assertFalse(any(session.is_loaded() for session in subject.get_sessions()))
+        self.assertEqual(sorted(dataset.get_image_paths(subject_id="03", session="test")),
+                         sorted(self.dataset.get_image_paths(subject_id="03", session="test")))
+        self.assertFalse(subject.get_session("retest").is_loaded())
+        self.assertEqual([subject.get_id() for subject in dataset.get_subjects() if subject.is_loaded()], ["03"])
+        self.assertFalse(dataset.is_dirty())
+        self.assertEqual(sorted(dataset.get_image_paths()), sorted(self.dataset.get_image_paths()))
+        self.assertFalse(dataset.is_dirty())
+
 
 class TestReaderTestDir(TestCase):
     @classmethod
@@ -186,6 +210,54 @@ class TestReaderTestDir(TestCase):
         session_names = self.dataset.get_subject("01").get_session_names()
         self.assertEqual(set(session_names), {"test", "retest"})
 
+    def test_participants_tsv_is_parsed_once(self):
+        from bidsmanager.read import table_cache
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dataset_path = os.path.join(tmp_dir, "dataset")
+            shutil.copytree(get_example_directory(), dataset_path)
+            for subject_id in ("02", "03"):
+                os.makedirs(os.path.join(dataset_path, "sub-" + subject_id, "anat"))
+            parsed = []
+            read_tsv = table_cache.read_tsv
+
+            def _recording_read_tsv(in_file):
+                parsed.append(os.path.basename(in_file))
+                return read_tsv(in_file)
+
+            table_cache.read_tsv = _recording_read_tsv
+            try:
+                dataset = read_dataset(dataset_path, jobs=2)
+            finally:
+                table_cache.read_tsv = read_tsv
+            self.assertEqual(parsed.count("participants.tsv"), 1)
+            self.assertEqual(len(parsed), len(set(parsed)))
+            self.assertEqual(dataset.get_subject("01").get_metadata(), self.dataset.get_subject("01").get_metadata())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_temporary_copies_of_images_are_not_read(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dataset_path = os.path.join(tmp_dir, "dataset")
+            shutil.copytree(get_example_directory(), dataset_path)
+            image_path = self.dataset.get_image_paths()[0].replace(get_example_directory(), dataset_path)
+            shutil.copy(image_path, image_path + ".tmp_copy")
+            dataset = read_dataset(dataset_path)
+            self.assertEqual(len(dataset.get_image_paths()), len(self.dataset.get_image_paths()))
+            self.assertNotIn(image_path + ".tmp_copy", dataset.get_image_paths())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_lazy_read_parses_sidecars_when_metadata_is_used(self):
+        dataset = read_dataset(get_example_directory(), lazy=True)
+        image = dataset.get_subject("01").get_session("test").get_image(modality="T1w", acq="contrast")
+        self.assertFalse(image._sidecar_loaded)
+        expected = self.dataset.get_subject("01").get_session("test").get_image(modality="T1w", acq="contrast")
+        self.assertEqual(image.get_metadata(), expected.get_metadata())
+        self.assertTrue(image._sidecar_loaded)
+        self.assertFalse(dataset.is_dirty())
+
     def test_get_session_path(self):
         session = self.dataset.get_subject("01").get_session("retest")
         self.assertEqual(session.get_path(), os.path.abspath(os.path.join(get_example_directory(),
@@ -1,9 +1,17 @@
 import os
+import shutil
+import tempfile
 from unittest import TestCase
 
 from bidsmanager.base.image import Image
 from bidsmanager.read import read_dataset
 from bidsmanager.utils.epi import set_intended_for
+from bidsmanager.utils import checksums as checksums_module
+from bidsmanager.utils.checksums import ChecksumManifest
+from bidsmanager.utils.json_cache import JSONCache, json_cache
+from bidsmanager.write.dataset_writer import write_json
+from bidsmanager.utils.utils import (copy_file, copy_or_move, exchange_paths, update_file, read_tsv, parse_input,
+                                     temporary_path)
 
 
 class TestEPI(TestCase):
@@ -29,3 +37,256 @@ class TestEPI(TestCase):
             bids_dir, "").replace("sub-01", "", 1).strip("/")
         assert _intended_for_path == intended_for_path
         epi_image.get_sidecar_metadata("IntendedFor")
+
+
+class TestCopyOrMove(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self.in_file = os.path.join(self._dir, "in.nii.gz")
+        with open(self.in_file, "wb") as opened_file:
+            opened_file.write(b"image data" * 1000)
+        os.chmod(self.in_file, 0o640)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def read(self, filename):
+        with open(filename, "rb") as opened_file:
+            return opened_file.read()
+
+    def test_copy_keeps_contents_and_mode(self):
+        out_file = os.path.join(self._dir, "out.nii.gz")
+        copy_or_move(self.in_file, out_file)
+        self.assertEqual(self.read(out_file), self.read(self.in_file))
+        self.assertEqual(os.stat(out_file).st_mode, os.stat(self.in_file).st_mode)
+        self.assertNotEqual(os.stat(out_file).st_ino, os.stat(self.in_file).st_ino)
+
+    def test_hardlink_replaces_existing_file(self):
+        out_file = os.path.join(self._dir, "out.nii.gz")
+        with open(out_file, "wb") as opened_file:
+            opened_file.write(b"old")
+        copy_or_move(self.in_file, out_file, move="hardlink")
+        self.assertEqual(os.stat(out_file).st_ino, os.stat(self.in_file).st_ino)
+        self.assertEqual(sorted(os.listdir(self._dir)), ["in.nii.gz", "out.nii.gz"])
+
+    def test_hardlink_ignores_stale_temporary_link(self):
+        out_file = os.path.join(self._dir, "out.nii.gz")
+        with open(out_file + ".tmp_link", "wb") as opened_file:
+            opened_file.write(b"stale")
+        copy_or_move(self.in_file, out_file, move="hardlink")
+        self.assertEqual(os.stat(out_file).st_ino, os.stat(self.in_file).st_ino)
+
+    def test_hardlink_raises_errors_other_than_unsupported_links(self):
+        out_file = os.path.join(self._dir, "missing", "out.nii.gz")
+        with self.assertRaises(FileNotFoundError):
+            copy_or_move(self.in_file, out_file, move="hardlink")
+
+    def test_hardlink_removes_temporary_link_when_replace_fails(self):
+        # a directory in place of out_file makes os.replace fail after the link was created
+        out_file = os.path.join(self._dir, "out.nii.gz")
+        os.makedirs(out_file)
+        with self.assertRaises(OSError):
+            copy_or_move(self.in_file, out_file, move="hardlink")
+        self.assertEqual(sorted(os.listdir(self._dir)), ["in.nii.gz", "out.nii.gz"])
+
+    def test_reflink_copies_contents(self):
+        out_file = os.path.join(self._dir, "out.nii.gz")
+        copy_or_move(self.in_file, out_file, move="reflink")
+        self.assertEqual(self.read(out_file), self.read(self.in_file))
+        self.assertNotEqual(os.stat(out_file).st_ino, os.stat(self.in_file).st_ino)
+
+    def test_copy_does_not_change_hard_links_to_existing_file(self):
+        out_file = os.path.join(self._dir, "out.nii.gz")
+        published_file = os.path.join(self._dir, "published.nii.gz")
+        with open(out_file, "wb") as opened_file:
+            opened_file.write(b"old")
+        os.link(out_file, published_file)
+        copy_or_move(self.in_file, out_file)
+        self.assertEqual(self.read(out_file), self.read(self.in_file))
+        self.assertEqual(self.read(published_file), b"old")
+
+    def test_copy_removes_hidden_temporary_file_on_failure(self):
+        out_file = os.path.join(self._dir, "out.nii.gz")
+
+        class FailingDigest(object):
+            def update(self, block):
+                raise IOError("disk full")
+
+        with self.assertRaises(IOError):
+            copy_file(self.in_file, out_file, digest=FailingDigest())
+        self.assertEqual(os.listdir(self._dir), ["in.nii.gz"])
+
+    def test_temporary_path_is_hidden_and_unique(self):
+        out_file = os.path.join(self._dir, "sub-01_T1w.nii.gz")
+        tmp_file = temporary_path(out_file)
+        self.assertEqual(os.path.dirname(tmp_file), self._dir)
+        self.assertTrue(os.path.basename(tmp_file).startswith("."))
+        self.assertTrue(tmp_file.endswith(".tmp"))
+        self.assertNotEqual(tmp_file, temporary_path(out_file))
+
+    def test_exchange_paths(self):
+        directory = os.path.join(self._dir, "sub-01")
+        os.makedirs(directory)
+        exchange_paths(self.in_file, directory)
+        self.assertTrue(os.path.isdir(self.in_file))
+        self.assertEqual(self.read(directory), b"image data" * 1000)
+        self.assertEqual(sorted(os.listdir(self._dir)), ["in.nii.gz", "sub-01"])
+
+
+class TestChecksumManifest(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self.source = os.path.join(self._dir, "bids", "sourcedata", "source.nii.gz")
+        self.output = os.path.join(self._dir, "bids", "sub-01_T1w.nii.gz")
+        os.makedirs(os.path.dirname(self.source))
+        with open(self.source, "wb") as opened_file:
+            opened_file.write(b"a" * 100)
+        self.digested = []
+        self._compute_digest = checksums_module.compute_digest
+
+        def _recording_compute_digest(path, **kwargs):
+            self.digested.append(os.path.basename(path))
+            return self._compute_digest(path, **kwargs)
+
+        checksums_module.compute_digest = _recording_compute_digest
+
+    def tearDown(self):
+        checksums_module.compute_digest = self._compute_digest
+        shutil.rmtree(self._dir)
+
+    def manifest(self):
+        return ChecksumManifest(os.path.join(self._dir, "bids", ".bidsmanager", "checksums"))
+
+    def test_update_file_compares_cached_digests(self):
+        manifest = self.manifest()
+        update_file(self.source, self.output, checksums=manifest)
+        # both files are digested while the file is copied
+        self.assertTrue(manifest.has_digest(self.source))
+        self.assertTrue(manifest.has_digest(self.output))
+        os.utime(self.output, ns=(1, 1))
+        self.assertTrue(manifest.files_match(self.source, self.output))
+        self.assertEqual(self.digested, ["sub-01_T1w.nii.gz"])
+        manifest.save()
+
+        self.digested = []
+        manifest = self.manifest()
+        update_file(self.source, self.output, checksums=manifest)
+        self.assertEqual(self.digested, [])
+
+        with open(self.source, "wb") as opened_file:
+            opened_file.write(b"b" * 100)
+        update_file(self.source, self.output, checksums=manifest)
+        self.assertEqual(self.digested, ["source.nii.gz"])
+        with open(self.output, "rb") as opened_file:
+            self.assertEqual(opened_file.read(), b"b" * 100)
+        self.assertTrue(manifest.files_match(self.source, self.output))
+        self.assertEqual(self.digested, ["source.nii.gz"])
+
+    def test_files_outside_the_dataset_are_not_recorded(self):
+        external = os.path.join(self._dir, "external", "a.nii.gz")
+        os.makedirs(os.path.dirname(external))
+        shutil.copy(self.source, external)
+        manifest = self.manifest()
+        update_file(external, self.output, checksums=manifest)
+        self.assertFalse(manifest.has_digest(external))
+        self.assertTrue(manifest.has_digest(self.output))
+        os.utime(self.output, ns=(1, 1))
+        self.assertTrue(manifest.files_match(external, self.output))
+        self.assertFalse(manifest.has_digest(external))
+        manifest.save()
+        with open(manifest.filename, "a") as opened_file:
+            opened_file.write("../external/a.nii.gz\t100\t1\tdigest\n")
+        self.assertEqual(list(self.manifest()._entries), ["sub-01_T1w.nii.gz"])
+
+    def test_files_with_different_sizes_are_not_read(self):
+        with open(self.output, "wb") as opened_file:
+            opened_file.write(b"a" * 10)
+        self.assertFalse(self.manifest().files_match(self.source, self.output))
+        self.assertEqual(self.digested, [])
+
+
+class TestReadTSV(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self.tsv_file = os.path.join(self._dir, "sub-01_scans.tsv")
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_columns_are_parsed_like_each_value(self):
+        rows = [["filename", "acq_time", "age", "sex", "mixed", "numbers"],
+                ["anat/a.nii.gz", "2024-01-01T08:00:00", "25", "M", "2020", "1.5"],
+                ["anat/b.nii.gz", "1888/3/12", "25.5", "F", "n/a", "2024"],
+                ["anat/c.nii.gz", "01/02/2024", "", "n/a", "1e5", "20240101"],
+                ["anat/d.nii.gz", "1500-01-01", "-3", "abc", "20240101", "123"],
+                ["anat/e.nii.gz", "2024-01-01 08:00:00.5", "inf", "", "12:30", "-7"]]
+        with open(self.tsv_file, "w") as opened_file:
+            opened_file.write("\n".join("\t".join(row) for row in rows) + "\n")
+        expected = dict((row[0], dict((name, parse_input(value)) for name, value in zip(rows[0][1:], row[1:])
+                                      if value))
+                        for row in rows[1:])
+        data = read_tsv(self.tsv_file)
+        self.assertEqual(data, expected)
+        for key in expected:
+            self.assertEqual(list(data[key].keys()), list(expected[key].keys()))
+            for name in expected[key]:
+                self.assertIs(type(data[key][name]), type(expected[key][name]))
+
+    def test_nan_values(self):
+        with open(self.tsv_file, "w") as opened_file:
+            opened_file.write("participant_id\tage\nsub-01\tnan\nsub-02\t-nan\nsub-03\t2020\n")
+        data = read_tsv(self.tsv_file)
+        self.assertIs(data["sub-01"]["age"], parse_input("nan"))
+        self.assertNotEqual(data["sub-02"]["age"], data["sub-02"]["age"])
+        self.assertIsInstance(data["sub-02"]["age"], float)
+
+
+class TestJSONCache(TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self.json_file = os.path.join(self._dir, "sub-01_T1w.json")
+        with open(self.json_file, "w") as opened_file:
+            opened_file.write('{"EchoTime": 0.03}')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_file_is_parsed_again_only_after_it_changed(self):
+        cache = JSONCache()
+        data = cache.read(self.json_file)
+        self.assertEqual(data, {"EchoTime": 0.03})
+        self.assertIs(cache.read(self.json_file), data)
+        with open(self.json_file, "w") as opened_file:
+            opened_file.write('{"EchoTime": 0.004}')
+        os.utime(self.json_file, ns=(0, os.stat(self.json_file).st_mtime_ns + 1))
+        self.assertEqual(cache.read(self.json_file), {"EchoTime": 0.004})
+
+    def test_least_recently_used_files_are_dropped(self):
+        cache = JSONCache(maxsize=2)
+        filenames = [os.path.join(self._dir, "{}.json".format(index)) for index in range(3)]
+        for index, filename in enumerate(filenames):
+            with open(filename, "w") as opened_file:
+                opened_file.write(str(index))
+        first = cache.read(filenames[0])
+        cache.read(filenames[1])
+        cache.read(filenames[0])
+        cache.read(filenames[2])
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.read(filenames[0]), first)
+        self.assertNotIn(os.path.abspath(filenames[1]), cache._entries)
+
+    def test_written_sidecar_is_cached(self):
+        data = {"RepetitionTime": 2.0, "SliceTiming": [0.0, 1.0]}
+        write_json(data, self.json_file)
+        cached = json_cache.read(self.json_file)
+        self.assertEqual(cached, data)
+        self.assertIs(json_cache.read(self.json_file), cached)
+        data["SliceTiming"].append(2.0)
+        self.assertEqual(json_cache.read(self.json_file)["SliceTiming"], [0.0, 1.0])
+
+    def test_image_metadata_does_not_change_the_cached_sidecar(self):
+        image_file = self.json_file.replace(".json", ".nii.gz")
+        image = Image(path=image_file, sidecar_path=self.json_file, modality="T1w")
+        image.add_metadata("RepetitionTime", 2.0)
+        self.assertEqual(image.get_metadata(), {"EchoTime": 0.03, "RepetitionTime": 2.0})
+        self.assertEqual(json_cache.read(self.json_file), {"EchoTime": 0.03})
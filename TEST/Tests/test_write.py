@@ -6,8 +6,11 @@ import random
 import csv
 
 from bidsmanager.write.dataset_writer import write_dataset
+from bidsmanager.write.write_plan import WritePlan
+from bidsmanager.read.conversion_journal import ConversionJournal
 from bidsmanager.read import read_csv, read_dataset
 from bidsmanager.utils.utils import read_json
+from bidsmanager.utils.dataset_utils import anonymize_dataset
 from bidsmanager.base import DataSet, Subject, Session, Image
 
 
@@ -60,6 +63,36 @@ class TestWrite(TestCase):
         self.assertEqual(len(reread_dataset.get_images(task="fingertapping")), 0)
         self.assertEqual(len(reread_dataset.get_images(task="ft")), len(fingertapping_images))
 
+    def test_write_dataset_leaves_source_dataset_unchanged(self):
+        source_paths = sorted(self.dataset.get_image_paths())
+        written_dataset = write_dataset(self.dataset, self._dir)
+        self.assertEqual(sorted(self.dataset.get_image_paths()), source_paths)
+        self.assertTrue(all(path.startswith(self._dir) for path in written_dataset.get_image_paths()))
+        self.assertEqual(len(written_dataset.get_images()), len(source_paths))
+        self.assertTrue(all(os.path.exists(path) for path in source_paths))
+
+    def test_write_dataset_returns_only_the_written_subjects(self):
+        shutil.copytree(os.path.join(get_script_directory(), "example_bids_dir"), self._dir)
+        written_dataset = write_dataset(self.dataset, self._dir)
+        self.assertEqual(sorted(written_dataset.get_subject_ids()), ["003", "005", "007", "UNMC^001"])
+        self.assertIn("01", read_dataset(self._dir).get_subject_ids())
+        reread_paths = [path for path in read_dataset(self._dir).get_image_paths() if "sub-01" not in path]
+        self.assertEqual(sorted(written_dataset.get_image_paths()), sorted(reread_paths))
+        self.assertFalse(written_dataset.is_dirty())
+        for image in written_dataset.get_images():
+            if image.get_sidecar_path():
+                self.assertTrue(os.path.exists(image.get_sidecar_path()))
+
+    def test_write_dataset_does_not_read_unchanged_sidecars(self):
+        dataset = read_dataset(os.path.join(get_script_directory(), "example_bids_dir"))
+        written_dataset = write_dataset(dataset, self._dir)
+        self.assertFalse(any(image._sidecar_loaded for image in dataset.get_images() if image.get_sidecar_path()))
+        written_images = [image for image in written_dataset.get_images() if image.get_sidecar_path()]
+        self.assertTrue(written_images)
+        for image in written_images:
+            self.assertFalse(image._sidecar_loaded)
+            self.assertEqual(image._sidecar_metadata, read_json(image.get_sidecar_path()))
+
     def test_write_dataset_omits_run_number_for_single_image(self):
         source_dir = os.path.join(self._dir, "source")
         output_dir = os.path.join(self._dir, "output")
@@ -112,6 +145,161 @@ class TestWrite(TestCase):
         self.assertTrue(os.path.exists(existing_file))
         self.assertTrue(os.path.exists(os.path.join(output_dir, "sub-001", "ses-baseline", "anat", "sub-001_ses-baseline_run-01_T1w.nii.gz")))
 
+    def test_update_dry_run_plans_without_writing(self):
+        dataset = read_csv(os.path.join(get_unorganized_example_directory(), "data_dict.csv"))
+        dataset.set_path(self._dir)
+        plan = dataset.update(dry_run=True)
+        self.assertFalse(os.path.exists(self._dir))
+        rows = plan.get_rows()
+        self.assertEqual(rows[0], {"action": "make_dirs", "source": None, "destination": self._dir})
+        copied = [row["destination"] for row in rows if row["action"] == "copy"]
+        self.assertIn(os.path.join(self._dir, "sub-003", "ses-visit1", "anat", "sub-003_ses-visit1_T1w.nii.gz"),
+                      copied)
+
+        plan.execute(jobs=4)
+        self.assertEqual(sorted(os.path.join(self._dir, os.path.relpath(path, self._dir))
+                                for path in glob.glob(os.path.join(self._dir, "**", "*.nii.gz"), recursive=True)),
+                         sorted(path for path in copied if path.endswith(".nii.gz")))
+        self.assertTrue(os.path.exists(os.path.join(self._dir, "dataset_description.json")))
+
+    def test_update_dry_run_leaves_the_dataset_unchanged(self):
+        shutil.copytree(os.path.join(get_script_directory(), "example_bids_dir"), self._dir)
+        dataset = read_dataset(self._dir)
+        subject = dataset.get_subject("01")
+        image = subject.get_images(modality="T1w")[0]
+        image_path = image.get_path()
+        sidecar_path = image.sidecar_path
+        subject.set_name("03")
+        image.set_run_number(2)
+
+        rows = dataset.update(dry_run=True, move=True).get_rows()
+        self.assertTrue(any("sub-03" in (row["destination"] or "") for row in rows))
+        self.assertEqual(image.get_path(), image_path)
+        self.assertEqual(image.sidecar_path, sidecar_path)
+        self.assertEqual(image.get_run_number(), 2)
+        self.assertEqual(subject.get_path(), os.path.join(self._dir, "sub-01"))
+        self.assertTrue(subject.is_dirty())
+
+        dataset.update(move=True)
+        self.assertFalse(os.path.exists(image_path))
+        self.assertTrue(os.path.exists(image.get_path()))
+        self.assertIn("sub-03", image.get_path())
+
+    def test_parallel_plan_shifts_files_without_overwriting(self):
+        os.makedirs(self._dir)
+        paths = [os.path.join(self._dir, "run-{:02d}_T1w.nii.gz".format(run)) for run in (1, 2, 3, 4)]
+        for run, path in enumerate(paths[:3], start=1):
+            with open(path, "w") as f:
+                f.write(str(run))
+        plan = WritePlan()
+        for old_path, new_path in zip(paths[:3], paths[1:]):
+            plan.update_file(old_path, new_path, move=True)
+        plan.execute(jobs=4)
+        contents = dict()
+        for path in paths[1:]:
+            with open(path) as f:
+                contents[os.path.basename(path)] = f.read()
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertEqual(contents, {"run-02_T1w.nii.gz": "1", "run-03_T1w.nii.gz": "2", "run-04_T1w.nii.gz": "3"})
+
+    def test_resumed_plan_skips_operations_done_before_they_were_journaled(self):
+        os.makedirs(self._dir)
+        moved_file = os.path.join(self._dir, "old_T1w.nii.gz")
+        removed_file = os.path.join(self._dir, "old_T1w.json")
+        for path in (moved_file, removed_file):
+            with open(path, "w") as f:
+                f.write(os.path.basename(path))
+        plan = WritePlan()
+        plan.update_file(moved_file, os.path.join(self._dir, "new_T1w.nii.gz"), move=True)
+        plan.remove(removed_file)
+
+        def _execute_interrupted(interrupted_index):
+            journal = ConversionJournal(self._dir, os.path.join(self._dir, "input"))
+            record = journal.record
+
+            def _interrupted_record(stage, key=None, **values):
+                # the process is killed after the operation, before its journal entry is written
+                if stage == "write_operation" and key == interrupted_index:
+                    raise KeyboardInterrupt()
+                record(stage, key=key, **values)
+
+            journal.record = _interrupted_record
+            with self.assertRaises(KeyboardInterrupt):
+                plan.execute(journal=journal)
+
+        _execute_interrupted(0)
+        self.assertFalse(os.path.exists(moved_file))
+        self.assertTrue(os.path.exists(removed_file))
+        # the move is executed again although its source is gone
+        _execute_interrupted(1)
+        self.assertFalse(os.path.exists(removed_file))
+
+        journal = ConversionJournal(self._dir, os.path.join(self._dir, "input"))
+        self.assertTrue(journal.is_done("write_operation", 0))
+        self.assertFalse(journal.is_done("write_operation", 1))
+        plan.execute(journal=journal)
+        self.assertTrue(journal.is_done("write_operation", 1))
+        with open(os.path.join(self._dir, "new_T1w.nii.gz")) as f:
+            self.assertEqual(f.read(), "old_T1w.nii.gz")
+
+    def test_update_only_writes_changed_subtrees(self):
+        shutil.copytree(os.path.join(get_script_directory(), "example_bids_dir"), self._dir)
+        dataset = read_dataset(self._dir)
+        self.assertEqual([row["action"] for row in dataset.update(dry_run=True).get_rows()], ["make_dirs"])
+
+        session = Session("new")
+        session.add_image(Image(path=os.path.join(self._dir, "sub-01", "ses-test", "anat",
+                                                  "sub-01_ses-test_acq-contrast_T1w.nii.gz"), modality="T1w"))
+        dataset.get_subject("01").add_session(session)
+        rows = dataset.update(dry_run=True).get_rows()
+        self.assertEqual(sorted(row["destination"] for row in rows if row["action"] == "copy"),
+                         [os.path.join(self._dir, "sub-01", "ses-new", "anat", "sub-01_ses-new_T1w.nii.gz")])
+        written = [os.path.relpath(row["destination"], self._dir) for row in rows
+                   if row["action"].startswith("write")]
+        self.assertIn(os.path.join("sub-01", "sub-01_sessions.tsv"), written)
+        self.assertFalse(any(os.path.join("sub-01", "ses-test") in (row["destination"] or "") or
+                             os.path.join("sub-01", "ses-retest") in (row["destination"] or "") for row in rows))
+
+        dataset.update()
+        self.assertTrue(os.path.exists(os.path.join(self._dir, "sub-01", "ses-new", "anat",
+                                                    "sub-01_ses-new_T1w.nii.gz")))
+        self.assertFalse(dataset.is_dirty())
+        self.assertEqual([row["action"] for row in dataset.update(dry_run=True).get_rows()], ["make_dirs"])
+
+    def test_update_renames_directories_of_anonymized_subjects(self):
+        shutil.copytree(os.path.join(get_script_directory(), "example_bids_dir"), self._dir)
+        for root, _, filenames in os.walk(os.path.join(self._dir, "sub-01")):
+            new_root = root.replace("sub-01", "sub-02")
+            os.makedirs(new_root)
+            for filename in filenames:
+                shutil.copy(os.path.join(root, filename), os.path.join(new_root, filename.replace("sub-01", "sub-02")))
+        t1w = os.path.join(self._dir, "sub-01", "ses-test", "anat", "sub-01_ses-test_acq-contrast_T1w.nii.gz")
+        inode = os.stat(t1w).st_ino
+
+        mapping_file = os.path.join(self._dir, "mapping.csv")
+        dataset = anonymize_dataset(read_dataset(self._dir), seed=1, mapping_file=mapping_file)
+        rows = dataset.update(move=True).get_rows()
+        self.assertEqual(sorted(os.path.relpath(row["destination"], self._dir) for row in rows
+                                if row["action"] == "rename_directory"),
+                         sorted(["sub-01", "sub-02"] + [os.path.join(subject, session)
+                                                        for subject in ("sub-01", "sub-02")
+                                                        for session in ("ses-01", "ses-02")]))
+        self.assertNotIn("copy", [row["action"] for row in rows])
+
+        with open(mapping_file) as opened_file:
+            mapping = {(row["original_subject"], row["original_session"]): (row["bids_subject"], row["bids_session"])
+                       for row in csv.DictReader(opened_file)}
+        self.assertEqual(mapping[("01", "test")], ("02", "02"))
+        self.assertEqual(mapping[("02", "retest")], ("01", "01"))
+        # the image was renamed in place, not copied
+        self.assertEqual(os.stat(os.path.join(self._dir, "sub-02", "ses-02", "anat",
+                                              "sub-02_ses-02_acq-contrast_T1w.nii.gz")).st_ino, inode)
+        self.assertEqual(sorted(os.listdir(os.path.join(self._dir, "sub-02"))),
+                         ["ses-01", "ses-02", "sub-02_sessions.tsv"])
+        self.assertEqual(sorted(os.listdir(os.path.join(self._dir, "sub-02", "ses-02"))),
+                         ["anat", "fmap", "func", "sub-02_ses-02_scans.tsv"])
+        self.assertFalse(glob.glob(os.path.join(self._dir, "sub-0*", "ses-*test*")))
+
     def test_create_linked_dataset(self):
         new_dataset = DataSet(path=self._dir)
         for subject in self.dataset.get_subjects():
@@ -1,11 +1,14 @@
+import copy
 import os
 
-from ..write.dataset_writer import write_tsv
+from ..write.write_plan import WritePlan
 from ..utils.utils import read_json
 
 
 class BIDSObject(object):
     def __init__(self, name=None, path=None, parent=None, metadata=None, metadata_filename=None):
+        # objects start out dirty (not written yet); readers mark the objects they load from disk as clean
+        self._dirty = True
         self.set_name(name)
         self.set_parent(parent)
         self._previous_path = None
@@ -36,6 +39,8 @@ class BIDSObject(object):
     def set_path(self, path):
         if self._path and os.path.exists(self._path):
             self._previous_path = self._path
+        if self._path != os.path.abspath(path):
+            self.mark_dirty()
         self._path = os.path.abspath(path)
 
     @property
@@ -59,7 +64,15 @@ class BIDSObject(object):
     def set_name(self, name):
         if hasattr(self, "_parent") and self._parent:
             self._parent.modify_key(self._name, name)
+        self._rename(name)
+
+    def _rename(self, name):
+        """
+        Change the name without changing the key of the object in its parent. Callers must re-key the object
+        themselves (see set_name and BIDSFolder.rename_children).
+        """
         self._name = name
+        self.mark_dirty()
 
     def get_metadata(self, key=None):
         if not self._metadata and self._metadata_filename:
@@ -70,6 +83,7 @@ class BIDSObject(object):
 
     def add_metadata(self, key, data):
         self._metadata[key] = data
+        self.mark_dirty()
 
     def load_metadata(self):
         if ".json" in self._metadata_filename and os.path.exists(self._metadata_filename):
@@ -78,26 +92,163 @@ class BIDSObject(object):
     def get_bids_type(self):
         return self._type
 
+    def is_dirty(self):
+        return self._dirty
+
+    def mark_dirty(self):
+        """
+        Mark the object as changed since it was last read or written. Its parents are marked as well so that
+        update() can skip subtrees that are clean.
+        """
+        self._dirty = True
+        parent = getattr(self, "_parent", None)
+        if parent is not None and not parent.is_dirty():
+            parent.mark_dirty()
+
+    def mark_clean(self):
+        self._dirty = False
+
+    def update(self, move=False, jobs=1, dry_run=False, staged=False):
+        """
+        Write the object to its path.
+        :param move: True to move the input files, 'link' to symlink them, 'hardlink' to hard link them, 'reflink' to
+            clone them (see copy_or_move), False to copy them.
+        :param jobs: number of threads used to copy, move and write files.
+        :param dry_run: build the write plan without executing it. The paths, run numbers and dirty flags that
+            planning assigns are reset afterwards, so the object is left as it was.
+        :param staged: write each subject into a hidden staging directory and publish it with a single rename once
+            it is complete (see WritePlan.execute). Only supported for DataSets.
+        Children that have not changed since they were last read or written (see mark_dirty) are skipped.
+        :return: the WritePlan.
+        """
+        plan = self.create_write_plan()
+        if dry_run:
+            saved_state = self._save_state()
+            try:
+                self.plan_update(plan, move=move)
+            finally:
+                self._restore_state(saved_state)
+            return plan
+        self.plan_update(plan, move=move)
+        plan.execute(jobs=jobs, staged=staged)
+        self.mark_clean()
+        return plan
+
+    def create_write_plan(self):
+        return WritePlan()
+
+    def _written_copy(self, path):
+        """
+        :return: a clean copy of the object at path (see plan_write). The copy has no parent and its own metadata
+        dictionary, whose values are shared with the object.
+        """
+        written = copy.copy(self)
+        written._path = os.path.abspath(path)
+        written._previous_path = None
+        written._parent = None
+        written._metadata = dict(self._metadata)
+        written._dirty = False
+        return written
+
+    def _save_state(self):
+        """
+        :return: the attributes of the object and of its loaded descendants, and the dirty flags of its parents.
+        Children that are not loaded yet keep their loader and are read again when they are used.
+        """
+        states = []
+        objects = [self]
+        while objects:
+            bids_object = objects.pop()
+            state = dict(bids_object.__dict__)
+            if "_children" in state:
+                state["_children"] = dict(state["_children"])
+                objects.extend(state["_children"].values())
+            states.append((bids_object, state))
+        parents = []
+        parent = self.get_parent()
+        while parent is not None:
+            parents.append((parent, parent.is_dirty()))
+            parent = parent.get_parent()
+        return states, parents
+
+    @staticmethod
+    def _restore_state(saved_state):
+        states, parents = saved_state
+        for bids_object, state in states:
+            bids_object.__dict__.clear()
+            bids_object.__dict__.update(state)
+        for parent, dirty in parents:
+            parent._dirty = dirty
+
 
 class BIDSFolder(BIDSObject):
     def __init__(self, *inputs, input_dict=None, **kwargs):
+        self._loader = None
         if input_dict:
-            self._dict = input_dict
+            self._children = input_dict
         else:
-            self._dict = dict()
+            self._children = dict()
         super(BIDSFolder, self).__init__(*inputs, **kwargs)
         self._type = "BIDSFolder"
 
+    @property
+    def _dict(self):
+        if self._loader is not None:
+            self._load_children()
+        return self._children
+
+    @_dict.setter
+    def _dict(self, children):
+        self._children = children
+
+    def set_loader(self, loader):
+        """
+        Defer reading the children of the folder until they are first used (see read_dataset with lazy=True).
+        :param loader: function that adds the children to the folder it is given.
+        """
+        self._loader = loader
+
+    def is_loaded(self):
+        return self._loader is None
+
+    def _load_children(self):
+        loader, self._loader = self._loader, None
+        # the children are read from disk, so loading them does not change the folder or its parents
+        dirty_objects = []
+        folder = self
+        while folder is not None:
+            dirty_objects.append((folder, folder.is_dirty()))
+            folder = folder.get_parent()
+        loader(self)
+        for child in self._children.values():
+            child.mark_clean()
+        for folder, dirty in dirty_objects:
+            folder._dirty = dirty
+
     def _add_object(self, object_to_add, object_name, object_title):
         if object_name not in self._dict:
             self._dict[object_name] = object_to_add
             object_to_add.set_parent(self)
         else:
             raise(KeyError("Duplicate {0} found in {1}: {2}".format(object_title, self._type, object_name)))
+        self.mark_dirty()
 
     def modify_key(self, key, new_key):
         self._add_object(self._dict.pop(key), new_key, "object")
 
+    def rename_children(self, new_names):
+        """
+        Rename several children at once. Unlike calling set_name on each child, a child can take the name that
+        another renamed child had before (e.g. when shuffling subject IDs): all renamed children are removed from the
+        folder before any of them is added back under its new name.
+        :param new_names: dictionary of current name -> new name.
+        """
+        children = [(self._dict.pop(name), new_name) for name, new_name in new_names.items()]
+        for child, new_name in children:
+            child._rename(new_name)
+        for child, new_name in children:
+            self._add_object(child, new_name, "object")
+
     def get_children(self):
         return self._dict.values()
 
@@ -109,31 +260,105 @@ class BIDSFolder(BIDSObject):
         self.update_parent_of_children()
 
     def update_parent_of_children(self):
-        for child in self.get_children():
+        # children that are not loaded yet get their parent when they are added
+        for child in self._children.values():
             child.set_parent(self)
 
-    def update(self, move=False):
-        self.make_path()
-        self.update_children(move=move)
-        if self._previous_path and not os.listdir(self._previous_path):
-            os.rmdir(self._previous_path)
+    def plan_update(self, plan, move=False):
+        plan.make_dirs(self.get_path())
+        self.plan_children_update(plan, move=move)
+        if self._previous_path:
+            plan.remove_empty_directory(self._previous_path)
 
-    def update_children(self, move=False):
+    def plan_children_update(self, plan, move=False):
+        old_paths = dict()
+        for child in self._dict.values():
+            old_paths[child] = child._path
+            # setting the path marks the child as dirty if it moved (e.g. after a parent was renamed)
+            child.set_path(self._get_child_path(self.get_path(), child))
+        if move is True:
+            plan.rename_directories(self._get_directory_renames(plan, old_paths))
         for child in self._dict.values():
-            if child.get_basename():
-                child.set_path(os.path.join(self.get_path(), child.get_basename()))
-            else:
-                child.set_path(self.get_path())
-            child.update(move=move)
+            if child.is_dirty():
+                child.plan_update(plan, move=move)
+
+    @staticmethod
+    def _get_directory_renames(plan, old_paths):
+        """
+        Renamed child folders (e.g. subjects renamed by anonymize_dataset) are moved with a single rename of their
+        directory, so that only the files with the old names inside them have to be renamed afterwards.
+        :param old_paths: dictionary of child -> path before the update.
+        :return: sorted list of (old directory, new directory) pairs.
+        """
+        renames = dict()
+        for child, old_path in old_paths.items():
+            if (isinstance(child, BIDSFolder) and old_path and os.path.isdir(old_path)
+                    and plan.map_path(old_path) != child.get_path()):
+                renames[old_path] = child.get_path()
+        # a directory can only take the path of a directory that is renamed as well
+        while True:
+            vacated = set(plan.map_path(old_path) for old_path in renames)
+            blocked = [old_path for old_path, new_path in renames.items()
+                       if plan.exists(new_path) and new_path not in vacated]
+            if not blocked:
+                return sorted(renames.items())
+            for old_path in blocked:
+                renames.pop(old_path)
+
+    @staticmethod
+    def plan_remove_previous_file(plan, previous_file, new_file):
+        """
+        Remove a metadata file named after the previous name of the folder (e.g. sub-01_sessions.tsv), which would
+        otherwise be left behind next to the file written for the new name.
+        """
+        if previous_file != new_file and os.path.isfile(previous_file):
+            plan.remove(previous_file)
+
+    def plan_write(self, plan, path, move=False):
+        """
+        Plan writing the folder and its children to path without changing them (see write_dataset).
+        :return: a copy of the folder and its children with the paths they are written to.
+        """
+        plan.make_dirs(path)
+        written = self._written_copy(path)
+        for name, child in self._dict.items():
+            written._children[name] = child.plan_write(plan, self._get_child_path(path, child), move=move)
+        written.update_parent_of_children()
+        return written
+
+    def _written_copy(self, path):
+        written = super(BIDSFolder, self)._written_copy(path)
+        written._loader = None
+        written._children = dict()
+        return written
+
+    @staticmethod
+    def _get_child_path(path, child):
+        if child.get_basename():
+            return os.path.join(path, child.get_basename())
+        return path
+
+    def mark_clean(self):
+        for child in self._children.values():
+            if child.is_dirty():
+                child.mark_clean()
+        super(BIDSFolder, self).mark_clean()
 
     def make_path(self):
         if self.get_path() and not os.path.exists(self.get_path()):
             os.makedirs(self.get_path())
 
-    def write_child_metadata(self, tsv_basename, first_column="id"):
+    def write_child_metadata(self, tsv_basename, first_column="id", plan=None, directory=None):
         metadata = self.compile_child_metadata()
         if metadata:
-            write_tsv(metadata, os.path.join(self.get_path(), tsv_basename), first_colum=first_column)
+            execute = plan is None
+            if execute:
+                plan = WritePlan()
+            if directory is None:
+                directory = self.get_path()
+            plan.write_tsv(metadata, os.path.join(directory, tsv_basename), first_column=first_column)
+            if execute:
+                plan.execute()
 
     def compile_child_metadata(self):
         metadata = dict()
@@ -2,14 +2,14 @@ import os
 
 from .sql import SQLInterface
 from .base import BIDSFolder
-from ..write.dataset_writer import write_json
+from ..write.write_plan import WritePlan
+from ..utils.checksums import ChecksumManifest
 from ..utils.utils import get_image
 
 
 class DataSet(BIDSFolder):
     def __init__(self, *inputs, subjects=None, **kwargs):
         super(DataSet, self).__init__(*inputs, **kwargs)
-        self.subjects = self._dict
         self._type = "Dataset"
         if subjects:
             self.add_subjects(subjects)
@@ -21,6 +21,10 @@ class DataSet(BIDSFolder):
             self._metadata["GeneratedBy"] = dict()
             self._metadata["GeneratedBy"]["Name"] = "BIDSManager"
 
+    @property
+    def subjects(self):
+        return self._dict
+
     def add_subjects(self, subjects):
         for subject in subjects:
             self.add_subject(subject)
@@ -64,18 +68,35 @@ class DataSet(BIDSFolder):
     def create_sql_interface(self, sql_file):
         return SQLInterface(self, sql_file)
 
-    def update(self, move=False):
-        super(DataSet, self).update(move=move)
-        self.write_child_metadata("participants.tsv")
-        self.write_dataset_description()
-
-    def write_dataset_description(self):
+    def create_write_plan(self):
+        # digests of the written files are kept with the dataset so that re-writes do not compare file contents
+        checksums = ChecksumManifest(os.path.join(self.get_path(), ".bidsmanager", "checksums"), root=self.get_path())
+        return WritePlan(checksums=checksums, root=self.get_path())
+
+    def plan_update(self, plan, move=False):
+        super(DataSet, self).plan_update(plan, move=move)
+        if self.is_dirty():
+            self.write_child_metadata("participants.tsv", plan=plan)
+            self.write_dataset_description(plan=plan)
+
+    def plan_write(self, plan, path, move=False):
+        written = super(DataSet, self).plan_write(plan, path, move=move)
+        self.write_child_metadata("participants.tsv", plan=plan, directory=path)
+        self.write_dataset_description(plan=plan, directory=path)
+        return written
+
+    def write_dataset_description(self, plan=None, directory=None):
+        execute = plan is None
+        if execute:
+            plan = WritePlan()
+        if directory is None:
+            directory = self.get_path()
         if self.get_metadata():
-            write_json(self.get_metadata(), os.path.join(self.get_path(), "dataset_description.json"))
+            plan.write_json(self.get_metadata(), os.path.join(directory, "dataset_description.json"))
         # add a blank README.md file to ensure BIDS compliance
-        if not os.path.isfile(os.path.join(self.get_path(), "README.md")):
-            with open(os.path.join(self.get_path(), "README.md"), "w") as f:
-                f.write("# README\n")
+        plan.write_text("# README\n", os.path.join(directory, "README.md"), overwrite=False)
+        if execute:
+            plan.execute()
 
     def get_name(self):
         if "Name" in self.get_metadata():
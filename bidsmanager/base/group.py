@@ -1,18 +1,54 @@
-import glob
 import os
 
 from .base import BIDSFolder
 
 
+class RunRegistry(object):
+    """
+    Record of the image filenames taken in one group directory, read with a single directory listing.
+    Filenames are also indexed by their run-less form (which carries the same entities as the signature used by
+    Group.normalize_runs_for_write) so that checking whether a run number is free does not touch the filesystem.
+    """
+    def __init__(self, directory):
+        self._existing = set()
+        self._reserved = set()
+        self._existing_runless = set()
+        if os.path.isdir(directory):
+            for basename in os.listdir(directory):
+                self._existing.add(basename)
+                runless_basename = self.runless_basename(basename)
+                if runless_basename != basename:
+                    self._existing_runless.add(runless_basename)
+
+    @staticmethod
+    def runless_basename(basename):
+        return "_".join(part for part in basename.split("_") if not part.startswith("run-"))
+
+    def exists(self, basename):
+        return basename in self._existing
+
+    def has_existing_runs(self, basename):
+        return self.runless_basename(basename) in self._existing_runless
+
+    def is_reserved(self, basename):
+        return basename in self._reserved
+
+    def reserve(self, basename):
+        self._reserved.add(basename)
+
+
 class Group(BIDSFolder):
     def __init__(self, *inputs, images=None, **kwargs):
         self._flags = dict()
         super(Group, self).__init__(*inputs, **kwargs)
-        self._images = self._dict
         self._type = "Group"
         if images:
             self.add_images(images)
 
+    @property
+    def _images(self):
+        return self._dict
+
     def add_image(self, image):
         image_key = image.get_image_key()
         if image_key in self._flags:
@@ -49,91 +85,100 @@ class Group(BIDSFolder):
         return list(self._images.values())
 
     def normalize_runs_for_write(self):
+        normalized_runs = self._get_normalized_runs()
+        for image, run_number in normalized_runs.items():
+            image._run = run_number
+
+        normalized_dict = {}
+        for image in normalized_runs:
+            normalized_dict[image.get_image_key()] = image
+        self._dict = normalized_dict
+
+    def _get_normalized_runs(self):
         # Build runless buckets; singleton buckets should not carry a run label in the final filename.
         images_by_signature = {}
-        for index, image in enumerate(list(self._images.values())):
-            signature = (
-                image.get_task_name(),
-                image.get_acquisition(),
-                image.get_contrast(),
-                image.get_direction(),
-                image.get_reconstruction(),
-                image.get_entity("echo"),
-                image.get_modality(),
-            )
-            images_by_signature.setdefault(signature, []).append((index, image))
-
-        normalized_images = []
+        for image in list(self._images.values()):
+            images_by_signature.setdefault(self._image_signature(image), []).append(image)
+
+        normalized_runs = {}
         for bucket in images_by_signature.values():
             if len(bucket) == 1:
-                image = bucket[0][1]
-                image._run = None
-                normalized_images.append(image)
+                normalized_runs[bucket[0]] = None
                 continue
-            for run_number, (_, image) in enumerate(bucket, start=1):
-                image._run = run_number
-                normalized_images.append(image)
-
-        normalized_dict = {}
-        for image in normalized_images:
-            normalized_dict[image.get_image_key()] = image
-        self._dict = normalized_dict
-        self._images = self._dict
+            for run_number, image in enumerate(bucket, start=1):
+                normalized_runs[image] = run_number
+        return normalized_runs
+
+    @staticmethod
+    def _image_signature(image):
+        return (
+            image.get_task_name(),
+            image.get_acquisition(),
+            image.get_contrast(),
+            image.get_direction(),
+            image.get_reconstruction(),
+            image.get_entity("echo"),
+            image.get_modality(),
+        )
 
     def _assign_run_numbers_for_write(self):
-        reserved_paths = set()
+        registry = RunRegistry(self.get_path())
         for image in list(self.get_images()):
-            self._assign_run_number_for_image(image=image, reserved_paths=reserved_paths)
-
-    def _assign_run_number_for_image(self, image, reserved_paths):
-        run_number = image.get_run_number()
+            image._run, _ = self._allocate_run_number(image, image.get_run_number(), self.get_path(), registry)
+        # runs are set without updating the keys so that a bumped image cannot collide with the key of an image
+        # that has not been assigned yet; the reserved basenames are unique, so the rebuilt keys are as well
+        self._dict = {image.get_image_key(): image for image in self._images.values()}
+
+    @staticmethod
+    def _allocate_run_number(image, run_number, directory, registry):
+        """
+        :return: the first run number (starting from run_number) whose filename is free in directory, and that
+        filename.
+        """
+        current_path = None
+        try:
+            current_path = image.get_path()
+        except ValueError:
+            pass
         while True:
-            candidate_path = os.path.join(self.get_path(), image.get_basename())
-            current_path = None
-            try:
-                current_path = image.get_path()
-            except ValueError:
-                pass
-
-            run_pattern = None
-            if run_number is None:
-                run_pattern = self._image_run_pattern(image)
-
-            if candidate_path not in reserved_paths and (
+            basename = image.get_basename(entities={"run": run_number})
+            candidate_path = os.path.join(directory, basename)
+            # a run-less name is only free if no image with the same entities already carries a run number
+            if not registry.is_reserved(basename) and (
                 candidate_path == current_path
-                or (not os.path.exists(candidate_path) and (run_pattern is None or not glob.glob(run_pattern)))
+                or (not registry.exists(basename) and (run_number is not None
+                                                       or not registry.has_existing_runs(basename)))
             ):
-                reserved_paths.add(candidate_path)
-                return
+                registry.reserve(basename)
+                return run_number, basename
 
             run_number = 1 if run_number is None else run_number + 1
-            image.set_run_number(run_number)
-
-    def _image_run_pattern(self, image):
-        basename_parts = []
-        subject_key = image.get_subject_key()
-        if subject_key:
-            basename_parts.append(subject_key)
-        session_key = image.get_session_key()
-        if session_key:
-            basename_parts.append(session_key)
-
-        for attribute in ("task", "acq", "ce", "dir", "rec"):
-            value = image.get_entity(attribute)
-            if value:
-                basename_parts.append("{}-{}".format(attribute, str(value).replace(" ", "")))
-        basename_parts.append("run-*")
-        echo = image.get_entity("echo")
-        if echo:
-            basename_parts.append("echo-{}".format(str(echo).replace(" ", "")))
-        basename_parts.append(image.get_modality())
-
-        return os.path.join(self.get_path(), "_".join(basename_parts) + image.get_extension())
-
-    def update(self, move=False):
+
+    def prepare_images_for_write(self):
         self.normalize_runs_for_write()
         self._assign_run_numbers_for_write()
-        super(Group, self).update(move=move)
+
+    def plan_update(self, plan, move=False):
+        self.prepare_images_for_write()
+        super(Group, self).plan_update(plan, move=move)
+
+    def plan_write(self, plan, path, move=False):
+        """
+        Plan writing the group to path without changing it. The images get the same run normalization and
+        allocation as in update().
+        :return: a copy of the group whose images have the run numbers and paths they are written to.
+        """
+        plan.make_dirs(path)
+        written = self._written_copy(path)
+        written._flags = dict(self._flags)
+        registry = RunRegistry(path)
+        for image, run_number in self._get_normalized_runs().items():
+            run_number, basename = self._allocate_run_number(image, run_number, path, registry)
+            written_image = image.plan_write(plan, os.path.join(path, basename), move=move)
+            written_image._run = run_number
+            written._children[written_image.get_image_key()] = written_image
+        written.update_parent_of_children()
+        return written
 
 
 class FunctionalGroup(Group):
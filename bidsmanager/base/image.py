@@ -1,8 +1,10 @@
+import copy
 import os
 
 from .base import BIDSObject
-from ..utils.utils import update_file, read_json, combine_dictionaries
-from ..write.dataset_writer import write_json
+from ..utils.json_cache import json_cache
+from ..utils.utils import combine_dictionaries
+from ..write.write_plan import WritePlan
 
 
 class Image(BIDSObject):
@@ -18,16 +20,30 @@ class Image(BIDSObject):
                 setattr(self, "_" + key, None)
         super(Image, self).__init__(*inputs, **kwargs)
         self.sidecar_path = sidecar_path
-        self._sidecar_metadata = dict()
-        self.update_sidecar_metadata()
+        # the sidecar is read the first time the sidecar metadata is used
+        self._sidecar = dict()
+        self._sidecar_loaded = False
         self._modality = modality
         self._type = "Image"
         self._extension = extension
         self._bval_path = bval_path
         self._bvec_path = bvec_path
 
-    def get_basename(self):
-        return "_".join(self.get_subject_session_keys(keys=self.get_image_keys())) + self.get_extension()
+    @property
+    def _sidecar_metadata(self):
+        if not self._sidecar_loaded:
+            self._sidecar_loaded = True
+            if self.sidecar_path:
+                # the sidecar is what is on disk, so reading it does not mark the image as changed
+                self._sidecar.update(self.read_sidecar())
+        return self._sidecar
+
+    def get_basename(self, entities=None):
+        """
+        :param entities: optional dictionary of entity values (e.g. {"run": 2}) used instead of the image's own values.
+        """
+        return "_".join(self.get_subject_session_keys(keys=self.get_image_keys(entities=entities))) + \
+            self.get_extension()
 
     def get_extension(self):
         if self._path:
@@ -42,15 +58,19 @@ class Image(BIDSObject):
     def get_acquisition(self):
         return self._acq
 
-    def get_image_keys(self, keys=None):
+    def get_image_keys(self, keys=None, entities=None):
         if not keys:
             keys = []
         for attribute in image_entities:
-            if self._get_key_attribute(attribute):
+            if entities and attribute in entities:
+                value = entities[attribute]
+            else:
+                value = self._get_key_attribute(attribute)
+            if value:
                 if attribute == "run":
-                    keys.append("{}-{:02d}".format(attribute, int(self.get_run_number())))
+                    keys.append("{}-{:02d}".format(attribute, int(value)))
                 else:
-                    keys.append(attribute + "-" + str(self._get_key_attribute(attribute).replace(" ", "")))
+                    keys.append(attribute + "-" + str(value.replace(" ", "")))
 
         if self._modality:
             keys.append(self._modality)
@@ -94,8 +114,6 @@ class Image(BIDSObject):
         return self._group
 
     def get_metadata(self, key=None):
-        if not self._sidecar_metadata:
-            self.update_sidecar_metadata()
         metadata = combine_dictionaries(self._sidecar_metadata, super(Image, self).get_metadata())
         if key:
             return metadata[key]
@@ -132,6 +150,7 @@ class Image(BIDSObject):
         current_key = self.get_image_key()
         self._acq = acquisition
         self.update_key(current_key)
+        self.mark_dirty()
 
     def set_parent(self, parent):
         super(Image, self).set_parent(parent)
@@ -166,23 +185,63 @@ class Image(BIDSObject):
     def set_reconstruction(self, reconstruction):
         self._set_key_attribute("_rec", reconstruction)
 
-    def update(self, move=False):
+    def plan_update(self, plan, move=False):
         if os.path.basename(self.get_path()) != self.get_basename():
             self.set_path(os.path.join(os.path.dirname(self.get_path()), self.get_basename()))
-        update_file(self._previous_path, self._path, move=move)
-        self.update_sidecar(move=move)
-        self.update_diffusion_files(move=move)
+        plan.update_file(self._previous_path, self._path, move=move)
+        self._plan_update_sidecar(plan, move=move)
+        self._plan_update_diffusion_files(plan, move=move)
+
+    def plan_write(self, plan, path, move=False):
+        """
+        Plan writing the image and its sidecar, bval and bvec files to path without changing the image.
+        :return: a copy of the image with the paths of the written files.
+        """
+        plan.update_file(self.get_path(), path, move=move)
+        written = self._written_copy(path)
+        written.sidecar_path = None
+        sidecar_file = path.replace(self.get_extension(), ".json")
+        if self._plan_sidecar(plan, sidecar_file, move=move):
+            written.sidecar_path = sidecar_file
+        # the written sidecar is read (from the JSON cache if it was written as JSON) when it is first used
+        written._sidecar = dict()
+        written._sidecar_loaded = False
+        for attribute, extension in (("_bval_path", ".bval"), ("_bvec_path", ".bvec")):
+            if getattr(self, attribute):
+                setattr(written, attribute, path.replace(self.get_extension(), extension))
+                plan.update_file(getattr(self, attribute), getattr(written, attribute), move=move)
+        return written
+
+    def update_sidecar(self, move=False, plan=None):
+        self._execute_update(self._plan_update_sidecar, move=move, plan=plan)
+
+    def _plan_update_sidecar(self, plan, move=False):
+        tmp_sidecar_file = self._path.replace(self.get_extension(), ".json")
+        if self._plan_sidecar(plan, tmp_sidecar_file, move=move):
+            self.sidecar_path = tmp_sidecar_file
 
-    def update_sidecar(self, move=False):
+    def _plan_sidecar(self, plan, sidecar_file, move=False):
+        """
+        Plan writing the sidecar to sidecar_file. A sidecar that has not been read is unchanged, so it is copied or
+        moved without parsing it.
+        :return: True if a sidecar is written.
+        """
+        if self.sidecar_path and not self._sidecar_loaded:
+            plan.update_file(self.sidecar_path, sidecar_file, move=move)
+            return True
         if self._sidecar_metadata:
-            tmp_sidecar_file = self._path.replace(self.get_extension(), ".json")
-            if self.sidecar_path is None or self._sidecar_metadata != self.read_sidecar():
-                write_json(self._sidecar_metadata, tmp_sidecar_file)
-                if move and self.sidecar_path and self.sidecar_path != tmp_sidecar_file:
-                    os.remove(self.sidecar_path)
-            else:
-                update_file(self.sidecar_path, tmp_sidecar_file, move=move)
-            self.sidecar_path = tmp_sidecar_file
+            self._plan_sidecar_write(plan, sidecar_file, move=move)
+            return True
+        return False
+
+    def _plan_sidecar_write(self, plan, sidecar_file, move=False):
+        # compared to the cached sidecar, which is only parsed again if the file changed since it was read
+        if self.sidecar_path is None or self._sidecar_metadata != json_cache.read(self.sidecar_path):
+            plan.write_json(self._sidecar_metadata, sidecar_file)
+            if move and self.sidecar_path and self.sidecar_path != sidecar_file:
+                plan.remove(self.sidecar_path)
+        else:
+            plan.update_file(self.sidecar_path, sidecar_file, move=move)
 
     def update_key(self, prev_key):
         if self.get_parent():
@@ -190,7 +249,8 @@ class Image(BIDSObject):
             self.get_parent().modify_key(prev_key, new_key)
 
     def read_sidecar(self):
-        return read_json(self.sidecar_path)
+        # a copy, so that changing the metadata of the image does not change the cached sidecar
+        return copy.deepcopy(json_cache.read(self.sidecar_path))
 
     def update_sidecar_metadata(self):
         if self.sidecar_path:
@@ -205,6 +265,7 @@ class Image(BIDSObject):
 
     def add_sidecar_metadata(self, key, value):
         self._sidecar_metadata[key] = value
+        self.mark_dirty()
 
     def get_task_name(self):
         return self._task
@@ -219,6 +280,7 @@ class Image(BIDSObject):
         current_key = self.get_image_key()
         setattr(self, attribute, value)
         self.update_key(current_key)
+        self.mark_dirty()
 
     def get_sidecar_path(self):
         return self.sidecar_path
@@ -229,21 +291,42 @@ class Image(BIDSObject):
     def get_bvec_path(self):
         return self._bvec_path
 
-    def update_bval(self, move=False):
+    def update_bval(self, move=False, plan=None):
+        self._execute_update(self._plan_update_bval, move=move, plan=plan)
+
+    def update_bvec(self, move=False, plan=None):
+        self._execute_update(self._plan_update_bvec, move=move, plan=plan)
+
+    def update_diffusion_files(self, move=False, plan=None):
+        self._execute_update(self._plan_update_diffusion_files, move=move, plan=plan)
+
+    @staticmethod
+    def _execute_update(plan_update, move=False, plan=None):
+        """
+        Add the writes of plan_update to plan, or to a new WritePlan that is executed right away if plan is None.
+        """
+        execute = plan is None
+        if execute:
+            plan = WritePlan()
+        plan_update(plan, move=move)
+        if execute:
+            plan.execute()
+
+    def _plan_update_bval(self, plan, move=False):
         tmp_bval_file = self.get_path().replace(self.get_extension(), ".bval")
-        update_file(self._bval_path, tmp_bval_file, move=move)
+        plan.update_file(self._bval_path, tmp_bval_file, move=move)
         self._bval_path = tmp_bval_file
 
-    def update_bvec(self, move=False):
+    def _plan_update_bvec(self, plan, move=False):
         tmp_bvec_file = self.get_path().replace(self.get_extension(), ".bvec")
-        update_file(self._bvec_path, tmp_bvec_file, move=move)
+        plan.update_file(self._bvec_path, tmp_bvec_file, move=move)
         self._bvec_path = tmp_bvec_file
 
-    def update_diffusion_files(self, move=False):
+    def _plan_update_diffusion_files(self, plan, move=False):
         if self._bval_path:
-            self.update_bval(move=move)
+            self._plan_update_bval(plan, move=move)
         if self._bvec_path:
-            self.update_bvec(move=move)
+            self._plan_update_bvec(plan, move=move)
 
 
 image_entities = ("task", "acq", "ce", "dir", "rec",  "run", "echo")
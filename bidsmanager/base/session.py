@@ -3,17 +3,20 @@ import os
 from bidsmanager.utils.session_utils import modality_to_group_name
 from .base import BIDSFolder
 from ..utils.session_utils import load_group
-from ..utils.utils import get_image
+from ..utils.utils import get_image, read_tsv
 
 
 class Session(BIDSFolder):
     def __init__(self, *inputs, groups=None, **kwargs):
         super(Session, self).__init__(*inputs, **kwargs)
-        self._groups = self._dict
         self._type = "Session"
         if groups:
             self.add_groups(groups)
 
+    @property
+    def _groups(self):
+        return self._dict
+
     def add_group(self, group):
         self._add_object(group, group.get_name(), "Group")
 
@@ -58,13 +61,62 @@ class Session(BIDSFolder):
     def has_group(self, group_name):
         return group_name in self._groups
 
-    def update(self, move=False):
-        super(Session, self).update(move=move)
+    def plan_update(self, plan, move=False):
+        super(Session, self).plan_update(plan, move=move)
+        if self.is_dirty():
+            if self._previous_path:
+                if self.get_basename():
+                    keys = [os.path.basename(os.path.dirname(self._previous_path)),
+                            os.path.basename(self._previous_path), "scans.tsv"]
+                else:
+                    keys = [os.path.basename(self._previous_path), "scans.tsv"]
+                self.plan_remove_previous_file(plan, os.path.join(self._previous_path, "_".join(keys)),
+                                               os.path.join(self.get_path(), self._get_scans_tsv_basename()))
+            metadata = self._get_existing_scans_metadata(plan)
+            metadata.update(self.compile_child_metadata())
+            if metadata:
+                plan.write_tsv(metadata, os.path.join(self.get_path(), self._get_scans_tsv_basename()),
+                               first_column="filename")
+
+    def plan_write(self, plan, path, move=False):
+        plan.make_dirs(path)
+        written = self._written_copy(path)
+        metadata = dict()
+        for name, group in self._groups.items():
+            written_group = group.plan_write(plan, os.path.join(path, group.get_basename()), move=move)
+            written._children[name] = written_group
+            for image in written_group.get_all_images():
+                if image.get_tsv_metadata():
+                    metadata[os.path.join(group.get_name(), image.get_basename())] = image.get_tsv_metadata()
+        written.update_parent_of_children()
+        if metadata:
+            plan.write_tsv(metadata, os.path.join(path, self._get_scans_tsv_basename()), first_column="filename")
+        return written
+
+    def _get_scans_tsv_basename(self):
         keys = [self.get_parent().get_basename(), self.get_basename(), "scans.tsv"]
         if None in keys:
             keys.remove(None)
-        tsv_basename = "_".join(keys)
-        self.write_child_metadata(tsv_basename=tsv_basename, first_column="filename")
+        return "_".join(keys)
+
+    def _get_existing_scans_metadata(self, plan):
+        """
+        :return: the rows of the scans.tsv file already in the session directory for the files that are still there
+        and that the update does not move or remove. A session that holds only some of the images in its directory
+        (e.g. the series converted by one run) then keeps the rows of the other images.
+        """
+        scans_tsv = os.path.join(self.get_path(), self._get_scans_tsv_basename())
+        if self._previous_path or not os.path.isfile(scans_tsv):
+            # a session that is moved was read from disk, so all of its rows are compiled from its images
+            return dict()
+        replaced_files = set(image._previous_path for image in self.get_images())
+        replaced_files.update(operation.source for operation in plan.operations if operation.action == "remove")
+        metadata = dict()
+        for filename, row in read_tsv(scans_tsv).items():
+            path = os.path.join(self.get_path(), filename)
+            if os.path.isfile(path) and path not in replaced_files:
+                metadata[filename] = row
+        return metadata
 
     def compile_child_metadata(self):
         metadata = dict()
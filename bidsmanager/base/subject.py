@@ -1,12 +1,17 @@
+import os
+
 from .base import BIDSFolder
 
 
 class Subject(BIDSFolder):
     def __init__(self, *inputs, **kwargs):
         super(Subject, self).__init__(*inputs, **kwargs)
-        self._sessions = self._dict
         self._type = "Subject"
 
+    @property
+    def _sessions(self):
+        return self._dict
+
     def add_session(self, session):
         self._add_object(session, session.get_name(), "Session")
 
@@ -40,7 +45,20 @@ class Subject(BIDSFolder):
     def has_session(self, session_name):
         return session_name in self._sessions
 
-    def update(self, move=False):
-        super(Subject, self).update(move=move)
-        tsv_basename = "_".join([self.get_basename(), "sessions.tsv"])
-        self.write_child_metadata(tsv_basename)
+    def plan_update(self, plan, move=False):
+        super(Subject, self).plan_update(plan, move=move)
+        if self.is_dirty():
+            if self._previous_path:
+                previous_basename = os.path.basename(self._previous_path)
+                self.plan_remove_previous_file(plan, os.path.join(self._previous_path,
+                                                                  "_".join([previous_basename, "sessions.tsv"])),
+                                               os.path.join(self.get_path(), self._get_sessions_tsv_basename()))
+            self.write_child_metadata(self._get_sessions_tsv_basename(), plan=plan)
+
+    def plan_write(self, plan, path, move=False):
+        written = super(Subject, self).plan_write(plan, path, move=move)
+        self.write_child_metadata(self._get_sessions_tsv_basename(), plan=plan, directory=path)
+        return written
+
+    def _get_sessions_tsv_basename(self):
+        return "_".join([self.get_basename(), "sessions.tsv"])
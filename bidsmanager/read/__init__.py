@@ -1,3 +1,4 @@
 from .dataset_reader import read_dataset
 from .csv_reader import read_csv
 from .dicom_reader import convert_dicom_directory
+from .ingest import watch_dicom_directory
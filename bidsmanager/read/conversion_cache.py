@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from collections import OrderedDict
+
+from ..utils.utils import copy_or_move
+
+
+class ConversionCache(object):
+    """
+    Persistent cache of dcm2niix outputs (NIfTI, JSON, bval and bvec files) for single series.
+    Entries are keyed by the SeriesInstanceUID, the path, size and modification time of every source file, and the
+    dcm2niix settings, so any change to the source files or the settings results in a new conversion. When a maximum
+    size is given, the least recently used entries are removed once the cache grows beyond it. The cache directory is
+    then scanned once, and the sizes and order of use of the entries are kept up to date as entries are used and
+    added.
+    """
+    def __init__(self, directory, max_size=None):
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        # entry directory -> size, least recently used first (see _get_usage)
+        self._usage = None
+        self._total_size = 0
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    @staticmethod
+    def key(series_uid, file_stats, settings):
+        """
+        :param series_uid: SeriesInstanceUID of the series.
+        :param file_stats: dictionary of source file path -> (size, mtime_ns).
+        :param settings: dictionary of the dcm2niix settings that change the output.
+        :return: hexadecimal cache key.
+        """
+        fingerprint = {"series_instance_uid": series_uid,
+                       "files": sorted([path, size, mtime_ns] for path, (size, mtime_ns) in file_stats.items()),
+                       "settings": settings}
+        return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+    def _entry_directory(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key, output_directory):
+        """
+        Copy the cached outputs of an entry into output_directory.
+        :return: list of the copied file paths, or None if the entry is not cached.
+        """
+        entry_directory = self._entry_directory(key)
+        if not os.path.isdir(entry_directory):
+            return None
+        # the modification time of the entry directory records when it was last used
+        os.utime(entry_directory)
+        if self._usage is not None and entry_directory in self._usage:
+            self._usage.move_to_end(entry_directory)
+        output_files = []
+        for filename in sorted(os.listdir(entry_directory)):
+            output_file = os.path.join(output_directory, filename)
+            copy_or_move(os.path.join(entry_directory, filename), output_file, move="reflink")
+            output_files.append(output_file)
+        return output_files
+
+    def put(self, key, output_files):
+        """
+        Store copies of the dcm2niix outputs of one series and evict old entries if the cache is too large.
+        """
+        entry_directory = self._entry_directory(key)
+        if os.path.isdir(entry_directory):
+            return
+        # copy into a temporary folder first so that an interrupted copy never looks like a valid entry
+        tmp_directory = os.path.join(self.directory, ".tmp_" + uuid.uuid4().hex)
+        os.makedirs(tmp_directory)
+        try:
+            for output_file in output_files:
+                copy_or_move(output_file, os.path.join(tmp_directory, os.path.basename(output_file)), move="reflink")
+            os.makedirs(os.path.dirname(entry_directory), exist_ok=True)
+            os.rename(tmp_directory, entry_directory)
+        finally:
+            if os.path.exists(tmp_directory):
+                shutil.rmtree(tmp_directory)
+        if self.max_size is not None:
+            usage = self._get_usage()
+            if entry_directory not in usage:
+                usage[entry_directory] = sum(output.stat().st_size for output in os.scandir(entry_directory))
+                self._total_size += usage[entry_directory]
+            self.evict()
+
+    def entries(self):
+        """
+        :return: list of (last_used, size, entry_directory) for every cached entry.
+        """
+        entries = []
+        for prefix in os.scandir(self.directory):
+            if not prefix.is_dir() or prefix.name.startswith("."):
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.is_dir():
+                    size = sum(output.stat().st_size for output in os.scandir(entry.path))
+                    entries.append((entry.stat().st_mtime, size, entry.path))
+        return entries
+
+    def _get_usage(self):
+        """
+        :return: OrderedDict of entry directory -> size, least recently used first. The cache directory is only
+        scanned the first time.
+        """
+        if self._usage is None:
+            entries = sorted(self.entries())
+            self._usage = OrderedDict((entry_directory, size) for _, size, entry_directory in entries)
+            self._total_size = sum(self._usage.values())
+        return self._usage
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is no larger than max_size.
+        """
+        if self.max_size is None:
+            return
+        usage = self._get_usage()
+        while usage and self._total_size > self.max_size:
+            entry_directory, size = usage.popitem(last=False)
+            if os.path.isdir(entry_directory):
+                shutil.rmtree(entry_directory)
+            self._total_size -= size
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+
+class ConversionJournal(object):
+    """
+    Write-ahead journal of the conversion of an input directory into a BIDS directory.
+    Each completed stage of the conversion (indexing the DICOM headers, running dcm2niix on each series, planning the
+    writes and each executed write operation) is appended to a journal file in
+    <bids_directory>/.bidsmanager/conversion_journals, so that an interrupted conversion can be resumed from the last
+    completed stage instead of starting over. The journal is removed once the conversion finishes.
+    """
+    def __init__(self, bids_directory, input_directory):
+        self.input_directory = os.path.abspath(input_directory)
+        key = hashlib.sha1(self.input_directory.encode()).hexdigest()[:16]
+        self.directory = os.path.join(os.path.abspath(bids_directory), ".bidsmanager", "conversion_journals", key)
+        self.filename = os.path.join(self.directory, "journal.jsonl")
+        self.finished = False
+        self._entries = []
+        self._done = set()
+        self._lock = threading.Lock()
+        if os.path.exists(self.filename):
+            self.load()
+
+    def load(self):
+        with open(self.filename, "r") as opened_file:
+            for line in opened_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last entry may have been cut off by the crash
+                    break
+                self._add(entry)
+
+    def _add(self, entry):
+        self._entries.append(entry)
+        self._done.add((entry["stage"], entry.get("key")))
+
+    def exists(self):
+        return bool(self._entries)
+
+    def get_entry(self, stage):
+        for entry in self._entries:
+            if entry["stage"] == stage:
+                return entry
+
+    def get_entries(self, stage):
+        return [entry for entry in self._entries if entry["stage"] == stage]
+
+    def is_done(self, stage, key=None):
+        return (stage, key) in self._done
+
+    def start(self, output_directory):
+        self.record("start", input_directory=self.input_directory, output_directory=output_directory)
+
+    def record(self, stage, key=None, sync=True, **values):
+        """
+        Append a completed stage to the journal.
+        :param key: optional key of the completed item (e.g. the SeriesInstanceUID of a converted series).
+        :param sync: If True, wait until the entry is on disk. Entries that are cheap to redo can skip the fsync.
+        """
+        entry = dict(values, stage=stage)
+        if key is not None:
+            entry["key"] = key
+        with self._lock:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            with open(self.filename, "a") as opened_file:
+                opened_file.write(json.dumps(entry) + "\n")
+                opened_file.flush()
+                if sync:
+                    os.fsync(opened_file.fileno())
+            self._add(entry)
+
+    def save(self, name, data):
+        """
+        Store data needed to resume a stage (e.g. the indexed DICOM headers) next to the journal, as a JSON file.
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        filename = os.path.join(self.directory, name + ".json")
+        with open(filename + ".tmp", "w") as opened_file:
+            json.dump(data, opened_file)
+            opened_file.flush()
+            os.fsync(opened_file.fileno())
+        os.replace(filename + ".tmp", filename)
+
+    def load_data(self, name):
+        with open(os.path.join(self.directory, name + ".json"), "r") as opened_file:
+            return json.load(opened_file)
+
+    def discard(self):
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        self._entries = []
+        self._done = set()
+
+    def finish(self):
+        self.discard()
+        self.finished = True
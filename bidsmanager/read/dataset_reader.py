@@ -1,37 +1,78 @@
-import glob
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from ..read.subject_reader import read_subject
+from ..read.table_cache import TableCache
 from ..base.dataset import DataSet
-from ..utils.utils import read_tsv, read_json
+from ..utils.utils import read_tsv, read_json, scan_directory
 
 
-def load_data_set(path_to_dataset):
+def load_data_set(path_to_dataset, jobs=1, lazy=False):
     dataset = DataSet(path=path_to_dataset,
                       metadata_filename=os.path.join(path_to_dataset, "dataset_description.json"))
-    return add_subjects_to_dataset(dataset, path_to_dataset)
+    return add_subjects_to_dataset(dataset, path_to_dataset, jobs=jobs, lazy=lazy)
 
 
-def add_subjects_to_dataset(dataset, path_to_dataset):
-    [dataset.add_subject(subject) for subject in read_subjects_in_dataset_path(path_to_dataset)]
+def add_subjects_to_dataset(dataset, path_to_dataset, jobs=1, lazy=False):
+    [dataset.add_subject(subject) for subject in read_subjects_in_dataset_path(path_to_dataset, jobs=jobs,
+                                                                                lazy=lazy)]
     return dataset
 
 
-def read_subjects_in_dataset_path(path_to_dataset):
-    return [read_subject(path_to_subject, metadata=read_subjects_metadata(path_to_dataset)) for path_to_subject in
-            find_subject_folders(path_to_dataset)]
+def read_subjects_in_dataset_path(path_to_dataset, jobs=1, tables=None, lazy=False):
+    """
+    :param jobs: number of threads that read subject folders at the same time (0 or None uses the number of CPUs).
+    Most of the time spent reading a subject is spent waiting on directory listings and sidecar files, so reading
+    several subjects at once helps on network filesystems.
+    :param tables: optional TableCache with the TSV files already read during this load.
+    :param lazy: return subjects that read their folders when they are first used (jobs is then not used).
+    """
+    if tables is None:
+        tables = TableCache()
+    # participants.tsv is parsed once and every subject looks up its own row
+    subjects_metadata = read_subjects_metadata(path_to_dataset, tables=tables)
+
+    def _read_subject(path_to_subject):
+        return read_subject(path_to_subject, metadata=subjects_metadata, tables=tables, lazy=lazy)
+
+    subject_folders = find_subject_folders(path_to_dataset)
+    if lazy:
+        return [_read_subject(path_to_subject) for path_to_subject in subject_folders]
+    if jobs is None or jobs < 1:
+        jobs = os.cpu_count() or 1
+    if jobs == 1 or len(subject_folders) < 2:
+        return [_read_subject(path_to_subject) for path_to_subject in subject_folders]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_read_subject, subject_folders))
 
 
 def find_subject_folders(path_to_data_set):
-    return sorted(glob.glob(os.path.join(path_to_data_set, "sub-*")))
+    directories, _ = scan_directory(path_to_data_set)
+    return [os.path.join(path_to_data_set, directory) for directory in directories if directory.startswith("sub-")]
 
 
-def read_dataset(path_to_dataset):
-    return load_data_set(path_to_dataset=path_to_dataset)
+def read_dataset(path_to_dataset, jobs=1, lazy=False):
+    """
+    Read a BIDS dataset. Each folder is listed once with os.scandir and sidecar files are matched to their images
+    from that listing.
+    :param jobs: number of threads used to read the subject folders (0 or None uses the number of CPUs).
+    :param lazy: only list the subject folders. Each subject reads its folder the first time its sessions or images
+        are used (e.g. by get_subject(...).get_images() or by iterating over the dataset's images), and each session
+        does the same with its groups and images. Querying a single subject of a large dataset then only reads the
+        folders of that subject.
+    The sidecars of the images are always read the first time their metadata is used, through a cache shared by the
+    whole process (see JSONCache), so reading a dataset again does not parse the sidecars that did not change.
+    """
+    dataset = load_data_set(path_to_dataset=path_to_dataset, jobs=jobs, lazy=lazy)
+    # the loaded objects match what is on disk, so update() only needs to write what is changed afterwards
+    dataset.mark_clean()
+    return dataset
 
 
-def read_subjects_metadata(path_to_dataset):
+def read_subjects_metadata(path_to_dataset, tables=None):
     metadata_file = os.path.join(path_to_dataset, "participants.tsv")
+    if tables is not None:
+        return tables.get_table(metadata_file)
     if os.path.isfile(metadata_file):
         return read_tsv(metadata_file)
 
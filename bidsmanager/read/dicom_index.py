@@ -0,0 +1,114 @@
+import os
+import sqlite3
+
+
+class DicomHeaderIndex(object):
+    """
+    Persistent SQLite index of DICOM header values keyed by file path, size and modification time.
+    Files whose size or modification time changed since they were indexed are treated as not indexed.
+    Files that are not DICOM are stored as well (with is_dicom = 0) so that they are not parsed again. Headers must
+    therefore only be stored by readers that can actually parse DICOM files.
+    """
+    _table = "dicom_headers"
+    # number of paths looked up per query (below SQLite's limit on the number of query parameters)
+    _lookup_batch_size = 500
+
+    def __init__(self, path, fields):
+        self.path = os.path.abspath(path)
+        self.fields = tuple(fields)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(self.path)
+        self.cursor = self.connection.cursor()
+        self._create_tables()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _create_tables(self):
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS index_fields (name TEXT NOT NULL PRIMARY KEY);")
+        stored_fields = tuple(row[0] for row in self.cursor.execute("SELECT name FROM index_fields ORDER BY rowid;"))
+        if stored_fields != self.fields:
+            # the indexed tags changed, so previously stored rows are incomplete
+            self.cursor.execute("DROP TABLE IF EXISTS {0};".format(self._table))
+            self.cursor.execute("DELETE FROM index_fields;")
+            self.cursor.executemany("INSERT INTO index_fields (name) VALUES (?);", [(field,) for field in self.fields])
+        columns = ", ".join(["{0} TEXT".format(field) for field in self.fields])
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS {0} (path TEXT NOT NULL PRIMARY KEY, size INTEGER, "
+                            "mtime_ns INTEGER, is_dicom INTEGER, {1});".format(self._table, columns))
+        self.connection.commit()
+
+    def rebuild(self):
+        self.cursor.execute("DELETE FROM {0};".format(self._table))
+        self.connection.commit()
+
+    def lookup(self, file_stats):
+        """
+        Look up the indexed headers for files that have not changed since they were indexed.
+        :param file_stats: dictionary of file path -> (size, mtime_ns).
+        :return: dictionary of file path -> header dictionary (None for files that are not DICOM).
+        """
+        headers = dict()
+        columns = ", ".join(("path", "size", "mtime_ns", "is_dicom") + self.fields)
+        paths = sorted(file_stats)
+        for start in range(0, len(paths), self._lookup_batch_size):
+            batch = paths[start:start + self._lookup_batch_size]
+            statement = "SELECT {0} FROM {1} WHERE path IN ({2});".format(columns, self._table,
+                                                                          ", ".join(["?"] * len(batch)))
+            for row in self.cursor.execute(statement, batch):
+                path, size, mtime_ns, is_dicom = row[:4]
+                if file_stats.get(path) == (size, mtime_ns):
+                    headers[path] = dict(zip(self.fields, row[4:])) if is_dicom else None
+        return headers
+
+    def store(self, headers, file_stats):
+        """
+        Store headers for the given files, replacing any previous entries.
+        :param headers: dictionary of file path -> header dictionary (None for files that are not DICOM).
+        :param file_stats: dictionary of file path -> (size, mtime_ns).
+        """
+        columns = ("path", "size", "mtime_ns", "is_dicom") + self.fields
+        statement = "INSERT OR REPLACE INTO {0} ({1}) VALUES ({2});".format(self._table, ", ".join(columns),
+                                                                            ", ".join(["?"] * len(columns)))
+        rows = []
+        for path, header in headers.items():
+            size, mtime_ns = file_stats[path]
+            values = [header.get(field) for field in self.fields] if header else [None] * len(self.fields)
+            rows.append([path, size, mtime_ns, int(header is not None)] + values)
+        self.cursor.executemany(statement, rows)
+        self.connection.commit()
+
+    def prune(self, directory, file_paths):
+        """
+        Remove entries for files inside a directory that no longer exist.
+        :param directory: directory that was listed.
+        :param file_paths: the file paths currently found in that directory.
+        """
+        prefix = os.path.join(os.path.abspath(directory), "")
+        # every path starting with prefix sorts between prefix and prefix with its last character incremented
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        current = set(file_paths)
+        stale = [(path,) for (path,) in self.cursor.execute(
+                     "SELECT path FROM {0} WHERE path >= ? AND path < ?;".format(self._table), (prefix, upper))
+                 if path not in current]
+        self.cursor.executemany("DELETE FROM {0} WHERE path = ?;".format(self._table), stale)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def stat_files(file_paths):
+    file_stats = dict()
+    for file_path in file_paths:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            continue
+        file_stats[file_path] = (stat.st_size, stat.st_mtime_ns)
+    return file_stats
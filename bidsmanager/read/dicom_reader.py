@@ -7,12 +7,21 @@ from warnings import warn
 import datetime
 import csv
 import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 from ..base.subject import Subject
 from ..base.dataset import DataSet
 from ..base.session import Session
+from .conversion_cache import ConversionCache
+from .conversion_journal import ConversionJournal
+from .dataset_reader import read_dataset
+from .dicom_index import DicomHeaderIndex, stat_files
 from ..utils.image_utils import load_image
-from ..utils.session_utils import modality_to_group_name
+from ..utils.checksums import ChecksumManifest
+from ..utils.json_cache import json_cache
+from ..utils.utils import same_filesystem, get_free_space, is_writable
+from ..write.write_plan import WritePlan
 
 
 def _matches_series_description(pattern, description, case_sensitive=False):
@@ -30,35 +39,42 @@ def _matches_series_number(pattern, series_number):
     return re.search(pattern, str(series_number)) is not None
 
 
-def parse_image_keys(in_file, description, series_number, heuristic, case_sensitive=False):
+def _match_image_keys(description, series_number, heuristic, case_sensitive=False):
     """
-    Parse the image description (and in the future other image information) to
-    determine the bids keys based on a heuristic provided by the user.
-    :param in_file: nifti file output from dcm2niix
-    :param description: Series Description provided in the filename from dcm2niix
-    :param series_number: Series Number provided in the filename from dcm2niix
-    :param heuristic: user provided heuristic to get the keys from the image information
-    :param case_sensitive: If True, matching of SeriesDescription will be case sensitive.
-    :return: image_keys in dictionary format (will be None if image should be skipped)
+    Match the series information against the heuristic.
+    :return: tuple of (image_keys, skip_match). If a heuristic entry with a null value matched, image_keys is None and
+        skip_match is the (pattern, value) pair that matched. Otherwise skip_match is None.
     """
     image_keys = dict()
     for test_heuristic, test_keys in heuristic.get("SeriesDescription", []):
         if _matches_series_description(test_heuristic, description, case_sensitive=case_sensitive):
             if test_keys is None:
-                print("{} found in {}. Skipping: {}".format(test_heuristic,
-                                                            description,
-                                                            in_file))
-                return None
+                return None, (test_heuristic, description)
             image_keys.update(test_keys)
 
     for test_heuristic, test_keys in heuristic.get("SeriesNumber", []):
         if _matches_series_number(test_heuristic, series_number):
             if test_keys is None:
-                print("{} found in {}. Skipping: {}".format(test_heuristic,
-                                                            series_number,
-                                                            in_file))
-                return None
+                return None, (test_heuristic, series_number)
             image_keys.update(test_keys)
+    return image_keys, None
+
+
+def parse_image_keys(in_file, description, series_number, heuristic, case_sensitive=False):
+    """
+    Parse the image description (and in the future other image information) to
+    determine the bids keys based on a heuristic provided by the user.
+    :param in_file: nifti file output from dcm2niix
+    :param description: Series Description provided in the filename from dcm2niix
+    :param series_number: Series Number provided in the filename from dcm2niix
+    :param heuristic: user provided heuristic to get the keys from the image information
+    :param case_sensitive: If True, matching of SeriesDescription will be case sensitive.
+    :return: image_keys in dictionary format (will be None if image should be skipped)
+    """
+    image_keys, skip_match = _match_image_keys(description, series_number, heuristic, case_sensitive=case_sensitive)
+    if skip_match:
+        print("{} found in {}. Skipping: {}".format(skip_match[0], skip_match[1], in_file))
+        return None
 
     if "modality" not in image_keys:
         # each valid image must have a modality
@@ -67,6 +83,70 @@ def parse_image_keys(in_file, description, series_number, heuristic, case_sensit
     return image_keys
 
 
+def _dcm2niix_safe_name(value):
+    # dcm2niix replaces characters that are unsafe in filenames (e.g. spaces and slashes) with underscores
+    return re.sub(r"[\s<>:\"/\\|?*$;`]", "_", value)
+
+
+def _series_is_kept(header, heuristic, case_sensitive=False):
+    """
+    Predict from the DICOM header whether the heuristic will keep a series after conversion.
+    The SeriesDescription is tested both as stored in the header and as dcm2niix writes it into the output filename,
+    and the series is kept if either form maps to a modality.
+    """
+    description = header.get("series_description")
+    descriptions = [description]
+    if description and _dcm2niix_safe_name(description) != description:
+        descriptions.append(_dcm2niix_safe_name(description))
+    for test_description in descriptions:
+        image_keys, _ = _match_image_keys(test_description, header.get("series_number"), heuristic,
+                                          case_sensitive=case_sensitive)
+        if image_keys and "modality" in image_keys:
+            return True
+    return False
+
+
+def _dcm2niix_time(header):
+    # dcm2niix fills %t with the StudyDate and StudyTime as YYYYMMDDHHMMSS
+    study_date = header.get("study_date")
+    if not study_date:
+        return ""
+    study_time = (header.get("study_time") or "").split(".")[0]
+    return study_date + study_time.ljust(6, "0")[:6]
+
+
+def _predict_dcm2niix_outputs(files_by_series_uid, dicom_headers, output_directory, separator):
+    """
+    Predict the dcm2niix output filename of every series from its DICOM header, without running dcm2niix.
+    Only one output per series is predicted, even if dcm2niix would split a series (e.g. into separate echoes).
+    :return: list of predicted NIfTI paths inside output_directory.
+    """
+    output_niftis = []
+    for series_uid, file_paths in sorted(files_by_series_uid.items()):
+        header = dicom_headers[file_paths[0]]
+        description = _dcm2niix_safe_name(header.get("series_description") or "")
+        protocol = _dcm2niix_safe_name(header.get("protocol_name") or header.get("series_description") or "")
+        basename = separator.join([series_uid, _dcm2niix_time(header), description, protocol,
+                                   header.get("series_number") or "", ""]) + ".nii.gz"
+        output_niftis.append(os.path.join(output_directory, basename))
+    return output_niftis
+
+
+def _select_series(files_by_series_uid, dicom_headers, heuristic, case_sensitive=False):
+    """
+    Split the series into those the heuristic will keep and those it will skip.
+    :return: tuple of (selected files_by_series_uid, sorted list of skipped SeriesInstanceUIDs)
+    """
+    selected = dict()
+    skipped = list()
+    for series_uid, file_paths in files_by_series_uid.items():
+        if _series_is_kept(dicom_headers[file_paths[0]], heuristic, case_sensitive=case_sensitive):
+            selected[series_uid] = file_paths
+        else:
+            skipped.append(series_uid)
+    return selected, sorted(skipped)
+
+
 def manipulate_path_extension(in_file, in_ext, out_ext):
     return in_file.replace(in_ext, out_ext)
 
@@ -105,7 +185,7 @@ def get_image(in_file, separator, heuristic, case_sensitive=False):
     :param case_sensitive: If True, matching of SeriesDescription will be case sensitive.
     :return:
     """
-    subject_name, time, description, protocol, series_number, run = parse_output(in_file, separator)
+    subject_name, time, description, protocol, series_number, run = parse_output(in_file, separator)[:6]
     _ = (subject_name, protocol, run)
     image_keys = parse_image_keys(
         in_file,
@@ -143,6 +223,9 @@ def _normalize_mapping_value(value):
     return text
 
 
+_MAPPING_ROWS_CACHE = dict()
+
+
 def _read_mapping_rows(subject_map=None):
     rows = []
     if not subject_map:
@@ -150,7 +233,17 @@ def _read_mapping_rows(subject_map=None):
     if not os.path.exists(subject_map):
         warn(RuntimeWarning("Subject mapping file not found: {}".format(subject_map)))
         return rows
+    # keep parsed mapping files between conversions (e.g. while watching an inbox) until the file changes
+    stat = os.stat(subject_map)
+    cache_key = (os.path.abspath(subject_map), stat.st_size, stat.st_mtime_ns)
+    if cache_key not in _MAPPING_ROWS_CACHE:
+        _MAPPING_ROWS_CACHE.clear()
+        _MAPPING_ROWS_CACHE[cache_key] = _parse_mapping_rows(subject_map)
+    return list(_MAPPING_ROWS_CACHE[cache_key])
 
+
+def _parse_mapping_rows(subject_map):
+    rows = []
     extension = os.path.splitext(subject_map)[-1].lower()
     if extension == ".csv":
         with open(subject_map, "r") as f:
@@ -218,34 +311,196 @@ def _source_id_candidates(value):
     return [normalized]
 
 
-def _index_dicom_metadata(input_directory):
-    metadata_by_series_uid = {}
+# DICOM keywords read while indexing, keyed by the metadata field they are stored under.
+_DICOM_INDEX_TAGS = (
+    ("series_instance_uid", "SeriesInstanceUID"),
+    ("patient_name", "PatientName"),
+    ("patient_id", "PatientID"),
+    ("series_description", "SeriesDescription"),
+    ("series_number", "SeriesNumber"),
+    ("protocol_name", "ProtocolName"),
+    ("study_date", "StudyDate"),
+    ("study_time", "StudyTime"),
+)
+
+# Header fields that are compared against the subject map and therefore normalized like mapping values.
+_MAPPING_FIELDS = ("series_instance_uid", "patient_name", "patient_id")
+
+# journal key of the conversion of the files that are not part of an indexed series
+_UNINDEXED_FILES_KEY = "unindexed_files"
+
+
+def _resolve_jobs(jobs):
+    if jobs is None or jobs < 1:
+        return os.cpu_count() or 1
+    return jobs
+
+
+def _list_input_files(input_directory):
+    """
+    :return: sorted list of the files in a directory tree. Symbolic links to directories are followed, as they were
+        by glob, but each directory is only listed once so that links that point back up the tree do not loop.
+    """
+    file_paths = []
+    visited = set()
+    for root, directories, filenames in os.walk(input_directory, followlinks=True):
+        stat = os.stat(root)
+        if (stat.st_dev, stat.st_ino) in visited:
+            directories[:] = []
+            continue
+        visited.add((stat.st_dev, stat.st_ino))
+        file_paths.extend(os.path.join(root, filename) for filename in filenames)
+    return sorted(file_paths)
+
+
+def _pydicom_available():
     try:
         import pydicom
     except Exception:
-        return metadata_by_series_uid
+        return False
+    return True
 
-    all_files = glob.glob(os.path.join(input_directory, "**", "*"), recursive=True)
-    for file_path in all_files:
-        if not os.path.isfile(file_path):
-            continue
-        try:
-            dicom = pydicom.dcmread(file_path, stop_before_pixels=True)
-        except Exception:
-            continue
-        series_uid = _normalize_mapping_value(getattr(dicom, "SeriesInstanceUID", None))
-        if not series_uid:
-            continue
-        if series_uid in metadata_by_series_uid:
+
+def _read_dicom_header(file_path):
+    """
+    Read only the indexed tags from a DICOM file.
+    Parsing stops at the first element past the last indexed tag, so neither the remainder of the header nor the
+    pixel data is read from disk.
+    :param file_path: path to a (possibly non-DICOM) file.
+    :return: dictionary of normalized header values, or None if the file is not a DICOM file.
+    """
+    try:
+        from pydicom.datadict import tag_for_keyword
+        from pydicom.filereader import read_partial
+    except Exception:
+        return None
+
+    tags = [tag_for_keyword(keyword) for _, keyword in _DICOM_INDEX_TAGS]
+    last_tag = max(tags)
+    try:
+        with open(file_path, "rb") as opened_file:
+            dicom = read_partial(opened_file,
+                                 stop_when=lambda tag, vr, length: tag > last_tag,
+                                 specific_tags=tags)
+    except Exception:
+        return None
+    header = dict()
+    for field, keyword in _DICOM_INDEX_TAGS:
+        value = getattr(dicom, keyword, None)
+        if field in _MAPPING_FIELDS:
+            header[field] = _normalize_mapping_value(value)
+        else:
+            header[field] = (str(value).strip() or None) if value is not None else None
+    return header
+
+
+def _read_dicom_headers(file_paths, jobs=1):
+    """
+    Read the indexed DICOM tags for a list of files, using a process pool when more than one job is requested.
+    :param file_paths: list of file paths.
+    :param jobs: number of worker processes (None or values below 1 use all available CPUs).
+    :return: list of header dictionaries (None for non-DICOM files) in the same order as file_paths.
+    """
+    jobs = min(_resolve_jobs(jobs), max(len(file_paths), 1))
+    if jobs == 1:
+        return [_read_dicom_header(file_path) for file_path in file_paths]
+    chunksize = max(1, len(file_paths) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_read_dicom_header, file_paths, chunksize=chunksize))
+
+
+def _index_dicom_files(input_directory, jobs=1, header_index=None, rebuild_header_index=False, file_paths=None):
+    """
+    Read the indexed DICOM tags of every file in a directory tree.
+    :param input_directory: directory containing DICOM files.
+    :param jobs: number of worker processes used to read headers that are not already indexed.
+    :param header_index: optional path to a persistent SQLite header index. Only files that are new or whose size or
+        modification time changed since the last run are parsed.
+    :param rebuild_header_index: If True, discard the existing entries of the header index before indexing.
+    :param file_paths: optional listing of input_directory (as returned by _list_input_files), so that a caller that
+        also needs the listing only walks the directory tree once.
+    :return: dictionary of file path -> header dictionary for every DICOM file found.
+    """
+    if file_paths is None:
+        file_paths = _list_input_files(os.path.abspath(input_directory))
+    if header_index and not _pydicom_available():
+        # every file would be stored as not being DICOM, and skipped by later runs that can read it
+        warn(RuntimeWarning("pydicom could not be imported. The header index {} is not used.".format(header_index)))
+        header_index = None
+    if not header_index:
+        headers = dict(zip(file_paths, _read_dicom_headers(file_paths, jobs=jobs)))
+    else:
+        fields = [field for field, _ in _DICOM_INDEX_TAGS]
+        with DicomHeaderIndex(header_index, fields=fields) as index:
+            if rebuild_header_index:
+                index.rebuild()
+            file_stats = stat_files(file_paths)
+            headers = index.lookup(file_stats)
+            new_file_paths = [file_path for file_path in file_paths
+                              if file_path in file_stats and file_path not in headers]
+            new_headers = dict(zip(new_file_paths, _read_dicom_headers(new_file_paths, jobs=jobs)))
+            index.store(new_headers, file_stats)
+            index.prune(input_directory, file_paths)
+            headers.update(new_headers)
+    return {file_path: headers[file_path] for file_path in file_paths if headers.get(file_path)}
+
+
+def _summarize_series_metadata(dicom_headers):
+    metadata_by_series_uid = {}
+    for header in dicom_headers.values():
+        series_uid = header.get("series_instance_uid")
+        if not series_uid or series_uid in metadata_by_series_uid:
             continue
         metadata_by_series_uid[series_uid] = {
-            "patient_name": _normalize_mapping_value(getattr(dicom, "PatientName", None)),
-            "patient_id": _normalize_mapping_value(getattr(dicom, "PatientID", None)),
+            "patient_name": header.get("patient_name"),
+            "patient_id": header.get("patient_id"),
         }
     return metadata_by_series_uid
 
 
-def _build_subject_session_mapping(subject_map=None, source_ids=None):
+def _group_files_by_series(dicom_headers):
+    files_by_series_uid = {}
+    for file_path, header in dicom_headers.items():
+        series_uid = header.get("series_instance_uid")
+        if series_uid:
+            files_by_series_uid.setdefault(series_uid, []).append(file_path)
+    return files_by_series_uid
+
+
+def _find_unindexed_files(file_paths, files_by_series_uid):
+    """
+    :param file_paths: listing of the input directory (as returned by _list_input_files).
+    :return: the files that are not part of any indexed series (files pydicom cannot read or that have no
+        SeriesInstanceUID) and that could still be DICOM files dcm2niix can convert (see _could_be_dicom).
+    """
+    indexed_files = {file_path for file_paths in files_by_series_uid.values() for file_path in file_paths}
+    return [file_path for file_path in file_paths if file_path not in indexed_files and _could_be_dicom(file_path)]
+
+
+def _could_be_dicom(file_path):
+    """
+    :return: False for a DICOMDIR, which dcm2niix skips, and for files that neither have "DICM" after the 128 byte
+        preamble nor, like DICOM files written without a preamble, start with an element of group 0002 or 0008.
+    """
+    if os.path.basename(file_path).upper() == "DICOMDIR":
+        return False
+    try:
+        with open(file_path, "rb") as opened_file:
+            start = opened_file.read(132)
+    except OSError:
+        return False
+    return start[128:132] == b"DICM" or start[:2] in (b"\x02\x00", b"\x08\x00")
+
+
+def _index_dicom_metadata(input_directory, jobs=1, header_index=None, rebuild_header_index=False):
+    if not _pydicom_available():
+        return {}
+
+    return _summarize_series_metadata(_index_dicom_files(input_directory, jobs=jobs, header_index=header_index,
+                                                         rebuild_header_index=rebuild_header_index))
+
+
+def _build_subject_session_mapping(subject_map=None, source_ids=None, match_dcm2niix_names=False):
     subject_map_dict = {}
     session_map_dict = {}
     normalized_source_ids = _normalize_source_ids(source_ids)
@@ -261,7 +516,11 @@ def _build_subject_session_mapping(subject_map=None, source_ids=None):
             source_value = _normalize_mapping_value(row.get(source_column))
             if source_id == "patient_name" and source_value is None:
                 source_value = _normalize_mapping_value(row.get("source_subject"))
-            for source_candidate in _source_id_candidates(source_value):
+            source_candidates = _source_id_candidates(source_value)
+            if match_dcm2niix_names:
+                # identifiers read from dcm2niix filenames have unsafe characters replaced
+                source_candidates += [_dcm2niix_safe_name(candidate) for candidate in source_candidates]
+            for source_candidate in source_candidates:
                 key = (source_id, source_candidate)
                 if bids_subject:
                     subject_map_dict[key] = bids_subject
@@ -270,6 +529,27 @@ def _build_subject_session_mapping(subject_map=None, source_ids=None):
     return subject_map_dict, session_map_dict
 
 
+def _dcm2niix_identifiers(in_file, separator):
+    """
+    Read the patient identifiers of a dcm2niix output file.
+    Values from the sidecar are used when present (dcm2niix only writes them when not anonymizing); otherwise the
+    %n and %i tokens of the filename are used.
+    """
+    parts = parse_output(in_file, separator)
+    identifiers = {
+        "patient_name": _normalize_mapping_value(parts[5]) if len(parts) > 7 else None,
+        "patient_id": _normalize_mapping_value(parts[6]) if len(parts) > 7 else None,
+    }
+    sidecar_path = get_secondary_output(in_file, ".nii.gz", ".json")
+    if sidecar_path:
+        # the image read from the same file later on gets the sidecar from the cache
+        sidecar = json_cache.read(sidecar_path)
+        for field, keyword in (("patient_name", "PatientName"), ("patient_id", "PatientID")):
+            if _normalize_mapping_value(sidecar.get(keyword)):
+                identifiers[field] = _normalize_mapping_value(sidecar.get(keyword))
+    return identifiers
+
+
 def _write_unmatched_source_ids(unmatched_rows, bids_directory, input_directory):
     source_dir = os.path.join(bids_directory if bids_directory else input_directory, "source")
     os.makedirs(source_dir, exist_ok=True)
@@ -287,6 +567,136 @@ def _write_unmatched_source_ids(unmatched_rows, bids_directory, input_directory)
     return output_csv
 
 
+def _plan_dataset_layout(dataset):
+    """
+    Compute the paths the images of a dataset would be written to, without writing anything.
+    :return: list of plan rows for the images in the dataset.
+    """
+    rows = []
+    for subject in sorted(dataset.get_subjects(), key=lambda item: item.get_id()):
+        subject.set_path(os.path.join(dataset.get_path(), subject.get_basename()))
+        for session in sorted(subject.get_sessions(), key=lambda item: item.get_name()):
+            if session.get_basename():
+                session.set_path(os.path.join(subject.get_path(), session.get_basename()))
+            else:
+                session.set_path(subject.get_path())
+            for group in sorted(session.get_groups(), key=lambda item: item.get_name()):
+                group.set_path(os.path.join(session.get_path(), group.get_basename()))
+                group.prepare_images_for_write()
+                for image in group.get_all_images():
+                    rows.append({
+                        "status": "convert",
+                        "subject": subject.get_id(),
+                        "session": session.get_name(),
+                        "group": group.get_name(),
+                        "filename": os.path.relpath(os.path.join(group.get_path(), image.get_basename()),
+                                                    dataset.get_path()),
+                        "source_file": os.path.basename(image.get_path()),
+                    })
+    return rows
+
+
+def _write_conversion_plan(plan_rows, bids_directory, input_directory):
+    source_dir = os.path.join(bids_directory if bids_directory else input_directory, "source")
+    os.makedirs(source_dir, exist_ok=True)
+    output_csv = os.path.join(source_dir, "conversion_plan.csv")
+    fieldnames = ["status", "subject", "session", "group", "filename", "source_file"]
+    with open(output_csv, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for row in plan_rows:
+            writer.writerow(row)
+    print("\t".join(fieldnames))
+    for row in plan_rows:
+        print("\t".join([row.get(fieldname) or "" for fieldname in fieldnames]))
+    print("Wrote conversion plan ({} rows) to {}".format(len(plan_rows), output_csv))
+    return output_csv
+
+
+def _resolve_subject_session(series_uid, metadata, time, subject_name_map, session_name_map, source_ids,
+                             combine_sessions=False, use_session_dates=False):
+    """
+    Apply the subject map and the session rules to the identifiers of one series.
+    :param metadata: dictionary with the patient_name and patient_id of the series.
+    :param time: acquisition time of the series as formatted by dcm2niix (%t).
+    :return: tuple of (subject name, session name, source values). The subject and session names are None if a
+        subject map is given and none of the source identifiers of the series match it.
+    """
+    source_values = {
+        "patient_name": _normalize_mapping_value(metadata.get("patient_name") or series_uid),
+        "patient_id": _normalize_mapping_value(metadata.get("patient_id")),
+    }
+
+    subject_name = source_values.get("patient_name") or series_uid
+    explicit_session_name = None
+    if subject_name_map:
+        matched = False
+        for source_id in source_ids:
+            for source_candidate in _source_id_candidates(source_values.get(source_id)):
+                key = (source_id, source_candidate)
+                if key in subject_name_map:
+                    subject_name = subject_name_map[key]
+                    explicit_session_name = session_name_map.get(key)
+                    matched = True
+                    break
+            if matched:
+                break
+        if not matched:
+            return None, None, source_values
+
+    # session mapping precedence: explicit mapping > date-derived > combined/no-session
+    if combine_sessions:
+        session_name = ""
+    elif explicit_session_name:
+        session_name = explicit_session_name
+    elif use_session_dates:
+        session_name = _session_from_time(time)
+    else:
+        session_name = ""
+    return subject_name, session_name, source_values
+
+
+def _series_manifest_path(bids_directory):
+    return os.path.join(bids_directory, "source", "series_manifest.csv")
+
+
+def _read_series_manifest(bids_directory):
+    manifest_csv = _series_manifest_path(bids_directory)
+    rows = []
+    if os.path.isfile(manifest_csv):
+        with open(manifest_csv, "r", newline="") as f:
+            rows.extend(csv.DictReader(f))
+    return rows
+
+
+def _converted_series_uids(bids_directory):
+    # a series only counts as converted while at least one of the files written from it still exists
+    return {row["series_instance_uid"] for row in _read_series_manifest(bids_directory)
+            if os.path.exists(os.path.join(bids_directory, row["bids_file"]))}
+
+
+def _update_series_manifest(bids_directory, written_files):
+    """
+    Record which BIDS files were written from which series.
+    :param bids_directory: BIDS dataset directory.
+    :param written_files: list of (SeriesInstanceUID, path of the written image).
+    """
+    rows = _read_series_manifest(bids_directory)
+    recorded = {(row["series_instance_uid"], row["bids_file"]) for row in rows}
+    for series_uid, image_path in written_files:
+        row = {"series_instance_uid": series_uid, "bids_file": os.path.relpath(image_path, bids_directory)}
+        if (row["series_instance_uid"], row["bids_file"]) not in recorded:
+            rows.append(row)
+    manifest_csv = _series_manifest_path(bids_directory)
+    os.makedirs(os.path.dirname(manifest_csv), exist_ok=True)
+    with open(manifest_csv, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["series_instance_uid", "bids_file"])
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+    return manifest_csv
+
+
 def _session_from_time(time_value):
     try:
         acquisition_date = datetime.datetime.strptime(time_value, "%Y%m%d%H%M%S")
@@ -296,36 +706,6 @@ def _session_from_time(time_value):
         return ""
 
 
-def _path_exists_for_image(image, subject_name, session_name, bids_directory):
-    if not bids_directory:
-        return False
-    group_name = modality_to_group_name(image.get_modality())
-    parts = [bids_directory, "sub-{}".format(subject_name)]
-    if session_name:
-        parts.append("ses-{}".format(session_name))
-    parts.append(group_name)
-
-    # Image is not attached to a Session yet, so build the final BIDS basename explicitly.
-    basename_parts = ["sub-{}".format(subject_name)]
-    if session_name:
-        basename_parts.append("ses-{}".format(session_name))
-    basename_parts.append(image.get_image_key())
-    out_file = os.path.join(*parts, "_".join(basename_parts) + image.get_extension())
-    return os.path.exists(out_file)
-
-
-def _increment_run_until_unique(image, session, subject_name, session_name, bids_directory):
-    # Keep incrementing run until neither the in-memory session nor the output filesystem has a conflict.
-    run_number = image.get_run_number() if image.get_run_number() else 1
-    image.set_run_number(run_number)
-    while session.get_images(modality=image.get_modality(), task=image.get_task_name(),
-                             acq=image.get_acquisition(), ce=image.get_contrast(), dir=image.get_direction(),
-                             rec=image.get_reconstruction(), run=image.get_run_number()) or \
-            _path_exists_for_image(image, subject_name, session_name, bids_directory):
-        run_number += 1
-        image.set_run_number(run_number)
-
-
 def convert_dicom_directory(input_directory,
                             heuristic,
                             anonymize=True,
@@ -338,7 +718,23 @@ def convert_dicom_directory(input_directory,
                             combine_sessions=False,
                             subject_map=None,
                             source_ids=None,
-                            case_sensitive=False):
+                            case_sensitive=False,
+                            jobs=1,
+                            header_index=None,
+                            rebuild_header_index=False,
+                            selective_conversion=False,
+                            plan_only=False,
+                            identifiers_from_dcm2niix=False,
+                            conversion_cache=None,
+                            conversion_cache_size=None,
+                            skip_converted_series=False,
+                            transfer_mode=False,
+                            staged=False,
+                            journal=False,
+                            resume=False,
+                            scratch_directory=None,
+                            dicom_headers=None,
+                            stream=False):
     """
     Convert a directory of DICOM files to BIDS format using dcm2niix.
     :param input_directory:
@@ -347,7 +743,8 @@ def convert_dicom_directory(input_directory,
     :param separator:
     :param bids_directory:
     :param delete_intermediates:
-    :param cleanup_temp_directory: If True, delete the temporary dcm2niix output directory after conversion.
+    :param cleanup_temp_directory: If True, delete the temporary dcm2niix output directory after conversion. The
+        outputs of a journaled conversion that did not finish are kept so that it can be resumed.
     :param verbose:
     :param use_session_dates: If True, use the acquisition date to create session names.
     :param combine_sessions: If True, put all images for a subject in a single no-session directory.
@@ -357,28 +754,170 @@ def convert_dicom_directory(input_directory,
           This value is site-defined and is not guaranteed to be MRN.
         - patient_name maps to DICOM PatientName (0010,0010) and is matched as an exact string.
     :param case_sensitive: If True, matching of SeriesDescription will be case sensitive. (default: False)
-    :return:
+    :param jobs: Number of worker processes used to index the DICOM headers. When more than one job is requested,
+        dcm2niix is also run separately on each series with up to this many concurrent processes. Files that cannot
+        be assigned to a series from their headers are then converted together by one more dcm2niix process, unless
+        none of them can be a DICOM file. None or values below 1 use all available CPUs. (default: 1)
+    :param header_index: Optional path to a persistent SQLite index of DICOM headers. When given, re-runs only parse
+        files that are new or changed since the previous run.
+    :param rebuild_header_index: If True, discard the existing header index entries and re-read every file.
+    :param selective_conversion: If True, classify each series from its DICOM header (SeriesDescription and
+        SeriesNumber) before conversion and only pass the series that map to a modality to dcm2niix.
+    :param plan_only: If True, do not run dcm2niix or write any images. Instead, predict the dcm2niix outputs from the
+        DICOM headers, apply the heuristic, subject map and session rules to them, and write the resulting layout
+        (including skipped series and unmatched source IDs) to source/conversion_plan.csv.
+    :param identifiers_from_dcm2niix: If True, read PatientName and PatientID from the dcm2niix output (the %n and %i
+        filename tokens, or the sidecar when anonymize is False) instead of indexing the DICOM headers with pydicom.
+        The headers are then only read if another option needs them (selective_conversion, plan_only, more than one
+        job, a header_index or a conversion_cache). dcm2niix replaces characters such as spaces and slashes in
+        filename tokens with underscores, and subject map values are matched both as given and with the same
+        replacements.
+    :param conversion_cache: Optional directory used to cache the dcm2niix outputs of each series, keyed by
+        SeriesInstanceUID and the path, size and modification time of its DICOM files. Cached series are not
+        converted again, so re-running with a changed heuristic only repeats the heuristic and write stages.
+    :param conversion_cache_size: Maximum size of the conversion cache in bytes. The least recently used series are
+        removed when the cache grows beyond it. (default: no limit)
+    :param skip_converted_series: If True, series recorded in the bids_directory's source/series_manifest.csv whose
+        written files still exist are not converted again. The manifest maps each SeriesInstanceUID to the BIDS
+        files written from it and is updated after every conversion into a bids_directory. Series are only matched by
+        their SeriesInstanceUID, so do not skip converted series after changing the heuristic or when files were
+        added to a series that was already converted. (default: False)
+    :param transfer_mode: How the dcm2niix outputs are written into bids_directory when delete_intermediates is
+        False: False copies them, 'hardlink' creates hard links and 'reflink' creates copy-on-write clones (both fall
+        back to a copy across filesystems). (default: False)
+    :param staged: If True, each subject is written into a hidden staging directory inside bids_directory and
+        published with a single rename once all of its files are written, so that other readers of bids_directory
+        never see a partly written subject. (default: False)
+    :param journal: If True, record each completed stage of the conversion (indexing, dcm2niix for each series, the
+        write plan and each executed write) in a journal inside bids_directory, and keep the temporary dcm2niix
+        outputs when the conversion is interrupted, so that it can be resumed. (default: False)
+    :param resume: If True, resume an interrupted journaled conversion of the same input_directory into
+        bids_directory from its last completed stage, and journal the resumed conversion. Without resume, the journal
+        and outputs of an interrupted conversion are discarded. (default: False)
+    :param scratch_directory: directory in which the temporary dcm2niix outputs are written. By default, they are
+        written to a hidden directory next to bids_directory (.<name of bids_directory>.bidsmanager_scratch), which
+        is on the same filesystem, so the outputs are moved into bids_directory by renaming them, but outside of the
+        dataset. Without a bids_directory, the system temporary directory is used. The temporary output directory is
+        only created when dcm2niix runs, and before it runs, the free space of the scratch directory and of
+        bids_directory (if it is on another filesystem) is checked against the size of the DICOM files to convert.
+    :param dicom_headers: optional dictionary of file path -> DICOM header (as read by _read_dicom_headers) for the
+        files in input_directory whose headers were already read, e.g. by the inbox watcher. The headers are then not
+        read again and header_index is not used.
+    :param stream: If True and the series are converted separately (more than one job or a conversion_cache), each
+        session is classified and written into bids_directory as soon as all of its series are converted, while
+        dcm2niix is still running on the other series. The sessions of the series are taken from the DICOM headers.
+        Outputs of series that dcm2niix could not convert and of files without an indexed series are written once
+        every series is converted. Cannot be combined with journal or resume. (default: False)
+    :return: the converted DataSet (when a conversion is resumed after its writes were planned, the DataSet read
+        from bids_directory), or the list of plan rows if plan_only is True.
     """
-    output_directory = random_tmp_directory()
+    if stream and (journal or resume):
+        raise ValueError("A streamed conversion cannot be journaled or resumed.")
+    conversion_journal = None
+    output_directory = None
+    if (journal or resume) and bids_directory and not plan_only:
+        conversion_journal = ConversionJournal(bids_directory, input_directory)
+        output_directory = _get_resumable_output_directory(conversion_journal, resume=resume)
+        if output_directory is None:
+            output_directory = random_tmp_directory(parent_directory=_get_scratch_directory(bids_directory,
+                                                                                            scratch_directory))
+            conversion_journal.start(output_directory)
     dataset = DataSet()
     try:
-        dicom_metadata_by_series_uid = _index_dicom_metadata(input_directory)
-        run_dcm2niix_on_directory(
-            input_directory,
-            output_directory,
-                filename="%j{0}%t{0}%d{0}%p{0}%s{0}".format(separator),
-            anonymize=anonymize,
-            verbose=verbose,
-        )
-        output_niftis = sorted(glob.glob(os.path.join(output_directory, "*.nii.gz")))
-        output_niftis = sorted(
-            output_niftis,
-            key=lambda f: (
-                _output_acquisition_time(f, separator) is None,
-                _output_acquisition_time(f, separator) or datetime.datetime.min,
-                os.path.basename(f),
-            ),
-        )
+        if conversion_journal is not None and conversion_journal.is_done("write_planned"):
+            print("Resuming the writes of the conversion of {}".format(input_directory))
+            write_state = conversion_journal.load_data("write_plan")
+            checksums = ChecksumManifest(os.path.join(bids_directory, ".bidsmanager", "checksums"),
+                                         root=bids_directory)
+            plan = WritePlan.from_dict(write_state["plan"], checksums=checksums)
+            plan.execute(jobs=jobs, staged=staged, journal=conversion_journal)
+            _update_series_manifest(bids_directory, write_state["series_files"])
+            conversion_journal.finish()
+            _raise_for_unmatched_rows(write_state["unmatched_rows"], bids_directory, input_directory)
+            return read_dataset(bids_directory)
+
+        # listing of the input directory, made at most once
+        input_files = None
+        if dicom_headers is not None:
+            dicom_headers = {file_path: header for file_path, header in dicom_headers.items() if header}
+        elif identifiers_from_dcm2niix and not (selective_conversion or plan_only or header_index or conversion_cache
+                                                    or _resolve_jobs(jobs) > 1):
+            dicom_headers = {}
+        elif conversion_journal is not None and conversion_journal.is_done("indexed"):
+            dicom_headers = conversion_journal.load_data("dicom_headers")
+        else:
+            input_files = _list_input_files(os.path.abspath(input_directory))
+            dicom_headers = _index_dicom_files(
+                input_directory,
+                jobs=jobs,
+                header_index=header_index,
+                rebuild_header_index=rebuild_header_index,
+                file_paths=input_files,
+            )
+            if conversion_journal is not None:
+                conversion_journal.save("dicom_headers", dicom_headers)
+                conversion_journal.record("indexed")
+        dicom_metadata_by_series_uid = _summarize_series_metadata(dicom_headers)
+        files_by_series_uid = _group_files_by_series(dicom_headers)
+        # files that cannot be assigned to a series from their headers are converted together whenever dcm2niix is
+        # not run on the whole input directory, so that they are not lost
+        unindexed_files = []
+        if dicom_headers:
+            if input_files is None:
+                input_files = _list_input_files(os.path.abspath(input_directory))
+            unindexed_files = _find_unindexed_files(input_files, files_by_series_uid)
+        # only the files of the remaining series are passed to dcm2niix when series are left out below
+        convert_subset = False
+        if selective_conversion and not plan_only:
+            if files_by_series_uid:
+                files_by_series_uid, skipped_series_uids = _select_series(files_by_series_uid, dicom_headers,
+                                                                          heuristic, case_sensitive=case_sensitive)
+                for series_uid in skipped_series_uids:
+                    print("Series {} does not map to a modality. Skipping conversion.".format(series_uid))
+                convert_subset = True
+            else:
+                warn(RuntimeWarning("No DICOM headers could be read from {}. "
+                                    "Converting all series.".format(input_directory)))
+
+        converted_series_uids = set()
+        if skip_converted_series and bids_directory:
+            converted_series_uids = _converted_series_uids(bids_directory)
+            for series_uid in sorted(converted_series_uids.intersection(files_by_series_uid)):
+                print("Series {} was already converted into {}. Skipping conversion.".format(series_uid,
+                                                                                           bids_directory))
+                files_by_series_uid.pop(series_uid)
+                convert_subset = True
+
+        dcm2niix_done = conversion_journal is not None and conversion_journal.is_done("dcm2niix")
+        if conversion_journal is not None and not dcm2niix_done:
+            # series whose dcm2niix outputs were completed before an interruption are kept, anything else that was
+            # written to the output directory is removed and converted again
+            kept_files = set()
+            for entry in conversion_journal.get_entries("series_converted"):
+                if files_by_series_uid.pop(entry["key"], None) is not None:
+                    convert_subset = True
+                kept_files.update(entry["files"])
+            for name in os.listdir(output_directory) if os.path.isdir(output_directory) else []:
+                if name not in kept_files:
+                    path = os.path.join(output_directory, name)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+
+        if not plan_only and not dcm2niix_done:
+            if dicom_headers:
+                file_paths = [file_path for file_paths in files_by_series_uid.values() for file_path in file_paths]
+                file_paths.extend(unindexed_files)
+            else:
+                file_paths = input_files if input_files is not None else _list_input_files(input_directory)
+            if output_directory is None and (file_paths or not convert_subset):
+                # the temporary output directory is only created when dcm2niix has something to convert
+                output_directory = random_tmp_directory(parent_directory=_get_scratch_directory(bids_directory,
+                                                                                                scratch_directory))
+            if output_directory is not None:
+                _check_free_space(output_directory, bids_directory, sum(size for size, _ in
+                                                                        stat_files(file_paths).values()))
 
         # Heuristic-level mapping paths are supported for backwards compatibility.
         if subject_map is None:
@@ -396,36 +935,38 @@ def convert_dicom_directory(input_directory,
         subject_name_map, session_name_map = _build_subject_session_mapping(
             subject_map=subject_map,
             source_ids=source_ids,
+            match_dcm2niix_names=identifiers_from_dcm2niix,
         )
         unmatched_rows = []
+        skipped_rows = []
+
+        def add_output_niftis(niftis):
+            """
+            Classify dcm2niix outputs with the heuristic and add them to the dataset in order of acquisition.
+            :return: list of (image, SeriesInstanceUID) of the added images.
+            """
+            series_uid_by_image = []
+            niftis = sorted(
+                niftis,
+                key=lambda f: (
+                    _output_acquisition_time(f, separator) is None,
+                    _output_acquisition_time(f, separator) or datetime.datetime.min,
+                    os.path.basename(f),
+                ),
+            )
+            for f in niftis:
+                source_series_uid, time = parse_output(f, separator)[:2]
+                if source_series_uid in converted_series_uids:
+                    # series converted by a previous run but not indexed before dcm2niix (e.g. headers were not read)
+                    continue
 
-        for f in output_niftis:
-            source_series_uid, time, description, protocol, series_number, run = parse_output(f, separator)
-            _ = (description, protocol, series_number, run)
-
-            metadata = dicom_metadata_by_series_uid.get(source_series_uid, {})
-            source_values = {
-                "patient_name": _normalize_mapping_value(metadata.get("patient_name") or source_series_uid),
-                "patient_id": _normalize_mapping_value(metadata.get("patient_id")),
-            }
-
-            subject_name = source_values.get("patient_name") or source_series_uid
-            explicit_session_name = None
-            matched = not bool(subject_name_map)
-            if subject_name_map:
-                matched = False
-                for source_id in source_ids:
-                    for source_candidate in _source_id_candidates(source_values.get(source_id)):
-                        key = (source_id, source_candidate)
-                        if key in subject_name_map:
-                            subject_name = subject_name_map[key]
-                            explicit_session_name = session_name_map.get(key)
-                            matched = True
-                            break
-                    if matched:
-                        break
-
-                if not matched:
+                metadata = dicom_metadata_by_series_uid.get(source_series_uid)
+                if metadata is None:
+                    metadata = _dcm2niix_identifiers(f, separator) if identifiers_from_dcm2niix else {}
+                subject_name, session_name, source_values = _resolve_subject_session(
+                    source_series_uid, metadata, time, subject_name_map, session_name_map, source_ids,
+                    combine_sessions=combine_sessions, use_session_dates=use_session_dates)
+                if subject_name is None:
                     unmatched_rows.append({
                         "nifti_file": os.path.basename(f),
                         "series_instance_uid": source_series_uid,
@@ -435,70 +976,290 @@ def convert_dicom_directory(input_directory,
                     })
                     continue
 
-            if dataset.has_subject_id(subject_name):
-                subject = dataset.get_subject(subject_name)
-            else:
-                subject = Subject(subject_name)
-                dataset.add_subject(subject)
-
-            # session mapping precedence: explicit mapping > date-derived > combined/no-session
-            if combine_sessions:
-                session_name = ""
-            elif explicit_session_name:
-                session_name = explicit_session_name
-            elif use_session_dates:
-                session_name = _session_from_time(time)
-            else:
-                session_name = ""
-
-            if subject.has_session(session_name):
-                session = subject.get_session(session_name)
-            else:
-                session = Session(session_name)
-                subject.add_session(session)
-
-            image = get_image(f, separator, heuristic=heuristic, case_sensitive=case_sensitive)
-            if image:
-                session.add_image(image)
-
-        if bids_directory:
+                if dataset.has_subject_id(subject_name):
+                    subject = dataset.get_subject(subject_name)
+                else:
+                    subject = Subject(subject_name)
+                    dataset.add_subject(subject)
+
+                if subject.has_session(session_name):
+                    session = subject.get_session(session_name)
+                else:
+                    session = Session(session_name)
+                    subject.add_session(session)
+
+                image = get_image(f, separator, heuristic=heuristic, case_sensitive=case_sensitive)
+                if image:
+                    session.add_image(image)
+                    series_uid_by_image.append((image, source_series_uid))
+                else:
+                    skipped_rows.append({"status": "skipped", "subject": subject_name, "session": session_name,
+                                         "source_file": os.path.basename(f)})
+            return series_uid_by_image
+
+        def write_images(series_uid_by_image):
+            """
+            Write the images added to the dataset since it was last written, with the files of the dataset, subjects
+            and sessions that changed.
+            """
+            plan = dataset.create_write_plan()
+            dataset.plan_update(plan, move=True if delete_intermediates else transfer_mode)
+            series_files = [(series_uid, image.get_path()) for image, series_uid in series_uid_by_image]
+            if conversion_journal is not None:
+                # the plan is kept because planning again after some of it was written would assign other runs
+                conversion_journal.save("write_plan", {"plan": plan.to_dict(), "series_files": series_files,
+                                                       "unmatched_rows": unmatched_rows})
+                conversion_journal.record("write_planned")
+            plan.execute(jobs=jobs, staged=staged, journal=conversion_journal)
+            dataset.mark_clean()
+            _update_series_manifest(bids_directory, series_files)
+
+        dcm2niix_filename = "%j{0}%t{0}%d{0}%p{0}%s{0}".format(separator)
+        if identifiers_from_dcm2niix:
+            dcm2niix_filename += "%n{0}%i{0}".format(separator)
+        # When series are converted separately, each finished series is journaled so that a resumed conversion
+        # does not run dcm2niix on it again.
+        def journal_series_converted(series_uid, output_files):
+            conversion_journal.record("series_converted", series_uid,
+                                      files=[os.path.basename(output_file) for output_file in output_files])
+
+        record_series_converted = journal_series_converted if conversion_journal is not None else None
+
+        # outputs that were classified and written while the other series were converting
+        streamed_niftis = set()
+        streaming = bool(stream and bids_directory and not plan_only and dicom_headers)
+        if streaming:
+            # The series of each session are known from the headers, so a session is classified and written as soon
+            # as all of its series are converted. Its run numbers only depend on the images of the session, so they
+            # are the same as when everything is written at the end.
             print("Writing bids directory: {}".format(bids_directory))
             dataset.set_path(bids_directory)
-            if delete_intermediates:
-                dataset.update(move=True)
-            else:
-                dataset.update(move=False)
-
-        if unmatched_rows:
-            unmatched_csv = _write_unmatched_source_ids(
-                unmatched_rows=unmatched_rows,
-                bids_directory=bids_directory,
-                input_directory=input_directory,
+            session_by_series_uid = dict()
+            unconverted_series_uids = dict()
+            for series_uid, file_paths in files_by_series_uid.items():
+                subject_name, session_name, _ = _resolve_subject_session(
+                    series_uid, dicom_metadata_by_series_uid.get(series_uid) or {},
+                    _dcm2niix_time(dicom_headers[file_paths[0]]), subject_name_map, session_name_map, source_ids,
+                    combine_sessions=combine_sessions, use_session_dates=use_session_dates)
+                # unmatched series are reported as soon as they are converted
+                session_key = (subject_name, session_name) if subject_name is not None else (None, series_uid)
+                session_by_series_uid[series_uid] = session_key
+                unconverted_series_uids.setdefault(session_key, set()).add(series_uid)
+            converted_niftis = dict()
+
+            def write_converted_session(series_uid, output_files):
+                session_key = session_by_series_uid[series_uid]
+                converted_niftis.setdefault(session_key, []).extend(
+                    output_file for output_file in output_files if output_file.endswith(".nii.gz"))
+                unconverted_series_uids[session_key].discard(series_uid)
+                if not unconverted_series_uids[session_key]:
+                    niftis = converted_niftis.pop(session_key)
+                    streamed_niftis.update(niftis)
+                    write_images(add_output_niftis(niftis))
+
+            on_series_converted = write_converted_session
+        else:
+            on_series_converted = record_series_converted
+
+        # False when dcm2niix is run on the whole input directory, which includes the unindexed files
+        converted_by_series = True
+        # the predicted outputs of a plan are only named like the dcm2niix outputs, their directory is not created
+        plan_directory = os.path.join(tempfile.gettempdir(), "bidsmanager_plan")
+        if plan_only:
+            output_niftis = _predict_dcm2niix_outputs(files_by_series_uid, dicom_headers, plan_directory, separator)
+        elif conversion_cache and files_by_series_uid:
+            run_dcm2niix_with_cache(
+                files_by_series_uid,
+                output_directory,
+                cache=ConversionCache(conversion_cache, max_size=conversion_cache_size),
+                filename=dcm2niix_filename,
+                anonymize=anonymize,
+                verbose=verbose,
+                jobs=jobs,
+                on_series_converted=on_series_converted,
+            )
+        elif dcm2niix_done:
+            # resumed after all series were converted
+            pass
+        elif _resolve_jobs(jobs) > 1 and len(files_by_series_uid) > 1:
+            run_dcm2niix_on_series(
+                files_by_series_uid,
+                output_directory,
+                filename=dcm2niix_filename,
+                anonymize=anonymize,
+                verbose=verbose,
+                jobs=jobs,
+                on_series_converted=on_series_converted,
             )
-            raise RuntimeError(
-                "Found unmatched conversion rows for subject mapping. See {} and add matching rows before rerun.".format(
-                    unmatched_csv
+        elif convert_subset:
+            if files_by_series_uid:
+                run_dcm2niix_on_files(
+                    [file_path for file_paths in files_by_series_uid.values() for file_path in file_paths],
+                    output_directory,
+                    filename=dcm2niix_filename,
+                    anonymize=anonymize,
+                    verbose=verbose,
                 )
+        else:
+            converted_by_series = False
+            run_dcm2niix_on_directory(
+                input_directory,
+                output_directory,
+                filename=dcm2niix_filename,
+                anonymize=anonymize,
+                verbose=verbose,
             )
+        if (unindexed_files and converted_by_series and not plan_only and not dcm2niix_done
+                and not (conversion_journal is not None
+                         and conversion_journal.is_done("series_converted", _UNINDEXED_FILES_KEY))):
+            output_files = run_dcm2niix_on_unindexed_files(unindexed_files, output_directory,
+                                                           filename=dcm2niix_filename, anonymize=anonymize,
+                                                           verbose=verbose)
+            if conversion_journal is not None:
+                conversion_journal.record("series_converted", _UNINDEXED_FILES_KEY,
+                                          files=[os.path.basename(output_file) for output_file in output_files])
+        if conversion_journal is not None and not dcm2niix_done:
+            conversion_journal.record("dcm2niix")
+        if not plan_only:
+            output_niftis = []
+            if output_directory is not None:
+                # outputs of sessions with a series that failed to convert and of unindexed files are written last
+                output_niftis = [output_nifti for output_nifti in glob.glob(os.path.join(output_directory, "*.nii.gz"))
+                                 if output_nifti not in streamed_niftis]
+        series_uid_by_image = add_output_niftis(output_niftis)
+
+        if plan_only:
+            dataset.set_path(bids_directory if bids_directory else plan_directory)
+            plan_rows = _plan_dataset_layout(dataset) + skipped_rows
+            plan_rows.extend({"status": "unmatched", "source_file": row["nifti_file"]} for row in unmatched_rows)
+            _write_conversion_plan(plan_rows, bids_directory=bids_directory, input_directory=input_directory)
+            return plan_rows
+
+        if bids_directory:
+            if not streaming:
+                print("Writing bids directory: {}".format(bids_directory))
+                dataset.set_path(bids_directory)
+            write_images(series_uid_by_image)
+
+        if conversion_journal is not None:
+            conversion_journal.finish()
+        _raise_for_unmatched_rows(unmatched_rows, bids_directory, input_directory)
     finally:
-        if cleanup_temp_directory and os.path.exists(output_directory):
+        if conversion_journal is not None and not conversion_journal.finished:
+            print("The conversion of {} was interrupted. Its progress and temporary outputs are kept in {}. Run it "
+                  "again with resume=True (--resume) to continue it.".format(input_directory, bids_directory))
+        elif cleanup_temp_directory and output_directory is not None and os.path.exists(output_directory):
             shutil.rmtree(output_directory)
+            if bids_directory:
+                _remove_default_scratch_directory(bids_directory, output_directory)
 
     return dataset
 
 
+def _get_resumable_output_directory(conversion_journal, resume=False):
+    """
+    :return: the dcm2niix output directory of the interrupted conversion recorded in the journal if it is resumed,
+        otherwise None. The journal and outputs of a conversion that is not resumed are discarded.
+    """
+    if not conversion_journal.exists():
+        return None
+    start = conversion_journal.get_entry("start")
+    output_directory = start["output_directory"] if start else None
+    if resume and output_directory and os.path.isdir(output_directory):
+        print("Resuming the conversion of {}".format(conversion_journal.input_directory))
+        return output_directory
+    if resume:
+        warn(RuntimeWarning("The outputs of the interrupted conversion of {} no longer exist. Converting from the "
+                            "start.".format(conversion_journal.input_directory)))
+    else:
+        warn(RuntimeWarning("Discarding an interrupted conversion of {}. Pass resume=True (--resume) to continue "
+                            "interrupted conversions.".format(conversion_journal.input_directory)))
+        if output_directory and os.path.isdir(output_directory):
+            shutil.rmtree(output_directory)
+    conversion_journal.discard()
+    return None
+
+
+def _raise_for_unmatched_rows(unmatched_rows, bids_directory, input_directory):
+    if unmatched_rows:
+        unmatched_csv = _write_unmatched_source_ids(
+            unmatched_rows=unmatched_rows,
+            bids_directory=bids_directory,
+            input_directory=input_directory,
+        )
+        raise RuntimeError(
+            "Found unmatched conversion rows for subject mapping. See {} and add matching rows before rerun.".format(
+                unmatched_csv
+            )
+        )
+
+
 def random_hash():
     number = random.getrandbits(128)
     key = "{0:032x}".format(number)
     return key
 
 
-def random_tmp_directory():
-    directory = os.path.join("/tmp", "bidsmanager_" + random_hash())
+def random_tmp_directory(parent_directory=None):
+    if parent_directory is None:
+        parent_directory = tempfile.gettempdir()
+    directory = os.path.join(parent_directory, "bidsmanager_" + random_hash())
     os.makedirs(directory)
     return directory
 
 
+def _get_scratch_directory(bids_directory=None, scratch_directory=None):
+    """
+    :return: the directory for the temporary dcm2niix outputs: scratch_directory if given, otherwise the default
+        scratch directory of bids_directory (see _default_scratch_directory), or None (the system temporary
+        directory) if there is no bids_directory or the default scratch directory cannot be used.
+    """
+    if not scratch_directory:
+        if bids_directory:
+            default_directory = _default_scratch_directory(bids_directory)
+            # not the case when bids_directory is a mount point
+            if is_writable(default_directory) and same_filesystem(default_directory, bids_directory):
+                return default_directory
+        return None
+    scratch_directory = os.path.abspath(scratch_directory)
+    if bids_directory and not same_filesystem(scratch_directory, bids_directory):
+        warn(RuntimeWarning("The scratch directory {} is not on the same filesystem as {}. The converted files "
+                            "will be copied instead of renamed.".format(scratch_directory, bids_directory)))
+    return scratch_directory
+
+
+def _default_scratch_directory(bids_directory):
+    # a hidden sibling of the dataset is on the same filesystem, so the outputs are renamed into the dataset, but
+    # outside of it, so readers of the dataset never see them
+    bids_directory = os.path.abspath(bids_directory)
+    return os.path.join(os.path.dirname(bids_directory), ".{}.bidsmanager_scratch".format(
+        os.path.basename(bids_directory)))
+
+
+def _remove_default_scratch_directory(bids_directory, output_directory):
+    scratch_directory = _default_scratch_directory(bids_directory)
+    if os.path.dirname(output_directory) == scratch_directory and os.path.isdir(scratch_directory) \
+            and not os.listdir(scratch_directory):
+        os.rmdir(scratch_directory)
+
+
+def _check_free_space(output_directory, bids_directory, estimated_size):
+    """
+    Raise an error before dcm2niix runs if the dcm2niix outputs (estimated from the size of the DICOM files) would
+    not fit into the scratch directory, or into bids_directory when it is on another filesystem.
+    """
+    directories = [output_directory]
+    if bids_directory and not same_filesystem(output_directory, bids_directory):
+        directories.append(bids_directory)
+    for directory in directories:
+        free_space = get_free_space(directory)
+        if free_space < estimated_size:
+            raise RuntimeError("Not enough free space in {0} to convert {1:.1f} MB of DICOM files ({2:.1f} MB "
+                               "free). Use scratch_directory (--scratch-dir) to write the temporary dcm2niix "
+                               "outputs elsewhere.".format(directory, estimated_size / 1024 ** 2,
+                                                           free_space / 1024 ** 2))
+
+
 def run_dcm2niix_on_directory(input_directory, output_directory, filename="%t%d%n%p", anonymize=True,
                               verbose=False, directory_depth=9):
     command = ['dcm2niix', "-b", "y", "-ba", "-z", "y", "-d", str(directory_depth),
@@ -518,3 +1279,157 @@ def run_dcm2niix_on_directory(input_directory, output_directory, filename="%t%d%
 def parse_cmd_output(cmd_output):
     if "No valid DICOM files were found" in str(cmd_output):
         raise RuntimeError("No valid DICOM files were found")
+
+
+def _link_series_files(file_paths, link_directory):
+    """
+    :return: dictionary of file path -> path of its link in link_directory.
+    """
+    os.makedirs(link_directory)
+    links = dict()
+    for index, file_path in enumerate(sorted(file_paths)):
+        # prefix with the index so that files with the same basename from different folders do not collide
+        links[file_path] = os.path.join(link_directory, "{0:06d}_{1}".format(index, os.path.basename(file_path)))
+        os.symlink(file_path, links[file_path])
+    return links
+
+
+def run_dcm2niix_on_files(file_paths, output_directory, filename="%t%d%n%p", anonymize=True, verbose=False):
+    """
+    Run dcm2niix on a subset of the files in a directory tree by linking them into a temporary input folder.
+    """
+    link_directory = os.path.join(output_directory, ".series_inputs", "selected")
+    try:
+        _link_series_files(file_paths, link_directory)
+        run_dcm2niix_on_directory(link_directory, output_directory, filename=filename, anonymize=anonymize,
+                                  verbose=verbose)
+    finally:
+        if os.path.exists(os.path.dirname(link_directory)):
+            shutil.rmtree(os.path.dirname(link_directory))
+
+
+def run_dcm2niix_on_unindexed_files(file_paths, output_directory, filename="%t%d%n%p", anonymize=True,
+                                   verbose=False):
+    """
+    Run dcm2niix once on the files that were not assigned to a series while indexing the headers. Files that dcm2niix
+    cannot convert either are ignored, as they are when dcm2niix is run on the whole input directory.
+    :return: list of the files the conversion added to output_directory.
+    """
+    previous_files = set(os.listdir(output_directory))
+    try:
+        run_dcm2niix_on_files(file_paths, output_directory, filename=filename, anonymize=anonymize, verbose=verbose)
+    except RuntimeError:
+        # no valid DICOM files among them
+        return []
+    if verbose:
+        print("Converted {} files that are not part of an indexed series".format(len(file_paths)))
+    return [os.path.join(output_directory, name) for name in sorted(set(os.listdir(output_directory))
+                                                                     - previous_files)]
+
+
+def run_dcm2niix_on_series(files_by_series_uid, output_directory, filename="%j%t%d%p", anonymize=True,
+                           verbose=False, jobs=1, on_series_converted=None):
+    """
+    Run a separate dcm2niix process for each series, with at most `jobs` processes running at once.
+    Each series is linked into its own input folder and converted into its own output folder. Series with the most
+    files are started first. As soon as a series is converted, its outputs are moved into output_directory and
+    on_series_converted is called, so that a finished series is cached, journaled or written (see the stream option
+    of convert_dicom_directory) while the remaining series are converted.
+    The filename must contain %j (SeriesInstanceUID), so that the merged outputs do not depend on which process
+    finished first.
+    :param files_by_series_uid: dictionary of SeriesInstanceUID -> list of DICOM file paths.
+    :param output_directory: directory that receives the dcm2niix output of every series.
+    :param filename: dcm2niix output filename format.
+    :param anonymize: If True, dcm2niix anonymizes the BIDS sidecars.
+    :param verbose: If True, print the dcm2niix output.
+    :param jobs: maximum number of concurrent dcm2niix processes.
+    :param on_series_converted: optional function called as on_series_converted(series_uid, output_files) in the
+        calling thread for every converted series, in order of completion.
+    :return: dictionary of SeriesInstanceUID -> list of output files (in output_directory) of that series.
+    """
+    if "%j" not in filename:
+        raise ValueError("The dcm2niix filename must contain %j when converting series separately: {}".format(
+            filename))
+    series_uids = sorted(files_by_series_uid)
+    input_root = os.path.join(output_directory, ".series_inputs")
+    output_root = os.path.join(output_directory, ".series_outputs")
+    shard_inputs = dict()
+    shard_outputs = dict()
+    outputs_by_series_uid = dict()
+    errors = dict()
+    try:
+        for index, series_uid in enumerate(series_uids):
+            shard_inputs[series_uid] = os.path.join(input_root, "{0:06d}".format(index))
+            shard_outputs[series_uid] = os.path.join(output_root, "{0:06d}".format(index))
+            _link_series_files(files_by_series_uid[series_uid], shard_inputs[series_uid])
+            os.makedirs(shard_outputs[series_uid])
+
+        largest_first = sorted(series_uids, key=lambda series_uid: -len(files_by_series_uid[series_uid]))
+        with ThreadPoolExecutor(max_workers=min(_resolve_jobs(jobs), max(len(series_uids), 1))) as executor:
+            futures = {executor.submit(run_dcm2niix_on_directory, shard_inputs[series_uid], shard_outputs[series_uid],
+                                       filename=filename, anonymize=anonymize, verbose=verbose): series_uid
+                       for series_uid in largest_first}
+            for future in as_completed(futures):
+                series_uid = futures[future]
+                try:
+                    future.result()
+                except RuntimeError as error:
+                    errors[series_uid] = error
+                    continue
+                outputs_by_series_uid[series_uid] = []
+                for output_file in sorted(os.listdir(shard_outputs[series_uid])):
+                    shutil.move(os.path.join(shard_outputs[series_uid], output_file),
+                                os.path.join(output_directory, output_file))
+                    outputs_by_series_uid[series_uid].append(os.path.join(output_directory, output_file))
+                if on_series_converted:
+                    on_series_converted(series_uid, outputs_by_series_uid[series_uid])
+
+        if series_uids and len(errors) == len(series_uids):
+            raise RuntimeError("No valid DICOM files were found")
+        for series_uid in sorted(errors):
+            warn(RuntimeWarning("dcm2niix could not convert series {}: {}".format(series_uid, errors[series_uid])))
+    finally:
+        for directory in (input_root, output_root):
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+    return outputs_by_series_uid
+
+
+def run_dcm2niix_with_cache(files_by_series_uid, output_directory, cache, filename="%j%t%d%p", anonymize=True,
+                            verbose=False, jobs=1, on_series_converted=None):
+    """
+    Restore the outputs of previously converted series from a ConversionCache and run dcm2niix (one process per
+    series) only on the series that are not cached. The new outputs are added to the cache as each series finishes.
+    :param files_by_series_uid: dictionary of SeriesInstanceUID -> list of DICOM file paths.
+    :param output_directory: directory that receives the dcm2niix output of every series.
+    :param cache: ConversionCache instance.
+    :param filename: dcm2niix output filename format.
+    :param anonymize: If True, dcm2niix anonymizes the BIDS sidecars.
+    :param verbose: If True, print the dcm2niix output.
+    :param jobs: maximum number of concurrent dcm2niix processes.
+    :param on_series_converted: optional function called as on_series_converted(series_uid, output_files) for every
+        series restored from the cache or converted.
+    """
+    settings = {"filename": filename, "anonymize": anonymize}
+    keys = dict()
+    uncached_files_by_series_uid = dict()
+    for series_uid in sorted(files_by_series_uid):
+        keys[series_uid] = cache.key(series_uid, stat_files(files_by_series_uid[series_uid]), settings)
+        output_files = cache.get(keys[series_uid], output_directory)
+        if output_files is None:
+            uncached_files_by_series_uid[series_uid] = files_by_series_uid[series_uid]
+            continue
+        if verbose:
+            print("Using cached dcm2niix output for series {}".format(series_uid))
+        if on_series_converted:
+            on_series_converted(series_uid, output_files)
+
+    def _cache_series(series_uid, output_files):
+        if output_files:
+            cache.put(keys[series_uid], output_files)
+        if on_series_converted:
+            on_series_converted(series_uid, output_files)
+
+    if uncached_files_by_series_uid:
+        run_dcm2niix_on_series(uncached_files_by_series_uid, output_directory, filename=filename, anonymize=anonymize,
+                               verbose=verbose, jobs=jobs, on_series_converted=_cache_series)
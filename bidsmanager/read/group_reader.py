@@ -1,8 +1,11 @@
-import glob
 import os
 
 from ..utils.session_utils import load_group
 from ..read.image_reader import read_image
+from ..utils.utils import scan_directory
+
+# only files with these extensions are read as images, so temporary and backup copies of images are left out
+IMAGE_EXTENSIONS = (".nii", ".nii.gz")
 
 
 class GroupReader(object):
@@ -17,7 +20,10 @@ class GroupReader(object):
 
     @staticmethod
     def read_images(path_to_group_folder, metadata=None):
-        return [read_image(image_file, metadata=metadata) for image_file in glob.glob(os.path.join(path_to_group_folder, "*.nii*"))]
+        # the sidecars of the images are matched from the same listing
+        _, filenames = scan_directory(path_to_group_folder)
+        return [read_image(os.path.join(path_to_group_folder, filename), metadata=metadata, filenames=filenames)
+                for filename in sorted(filenames) if filename.endswith(IMAGE_EXTENSIONS)]
 
 
 def read_group(path_to_group_folder, metadata=None):
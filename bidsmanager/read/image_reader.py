@@ -30,21 +30,30 @@ def parse_entities(path_to_image, entity_specification, **custom_entities):
 
 
 def read_image_from_bids_path(path_to_image, metadata_dictionary=None, entity_specification=image_entities,
-                              **custom_entities):
+                              filenames=None, **custom_entities):
     modality, entities = parse_entities(path_to_image, entity_specification, **custom_entities)
     metadata_key = os.path.join(os.path.basename(os.path.dirname(path_to_image)), os.path.basename(path_to_image))
     if metadata_dictionary and metadata_key in metadata_dictionary:
         image_metadata = metadata_dictionary[metadata_key]
     else:
         image_metadata = None
-    return load_image(path_to_image, modality=modality, bval_path=find_sidecar(path_to_image, extension=".bval"),
-                      bvec_path=find_sidecar(path_to_image, extension=".bvec"),
-                      path_to_sidecar=find_sidecar(path_to_image, extension=".json"),
+    return load_image(path_to_image, modality=modality,
+                      bval_path=find_sidecar(path_to_image, extension=".bval", filenames=filenames),
+                      bvec_path=find_sidecar(path_to_image, extension=".bvec", filenames=filenames),
+                      path_to_sidecar=find_sidecar(path_to_image, extension=".json", filenames=filenames),
                       metadata=image_metadata, **entities)
 
 
-def find_sidecar(in_file, extension=".json"):
+def find_sidecar(in_file, extension=".json", filenames=None):
+    """
+    :param filenames: optional set of the names of the files in the folder of in_file. The sidecar is then looked up
+        in it instead of on disk.
+    """
     sidecar_file = in_file.replace(".nii.gz", extension)
+    if filenames is not None:
+        if os.path.basename(sidecar_file) in filenames:
+            return sidecar_file
+        return None
     return get_file(sidecar_file)
 
 
@@ -64,5 +73,6 @@ def parse_image_modality(path_to_image):
     return os.path.basename(path_to_image).split(".")[0].split("_")[-1]
 
 
-def read_image(path_to_image_file, metadata=None, **custom_entities):
-    return read_image_from_bids_path(path_to_image_file, metadata_dictionary=metadata, **custom_entities)
+def read_image(path_to_image_file, metadata=None, filenames=None, **custom_entities):
+    return read_image_from_bids_path(path_to_image_file, metadata_dictionary=metadata, filenames=filenames,
+                                     **custom_entities)
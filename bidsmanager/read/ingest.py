@@ -0,0 +1,195 @@
+import csv
+import os
+import shutil
+import tempfile
+import time
+from warnings import warn
+
+from . import dicom_reader
+from .dicom_index import stat_files
+
+
+class DicomInboxWatcher(object):
+    """
+    Watch an inbox directory for arriving DICOM files and convert each series into a BIDS directory once no new files
+    have arrived for it for settle_time seconds.
+    Only files that are new or changed since the previous poll have their headers read. Each completed series is
+    converted on its own with convert_dicom_directory, using the same heuristic, subject map and session rules and
+    the headers read while polling, so that each file is only parsed once.
+    A series that fails to convert is tried again after settle_time seconds, up to max_retries times. Series that
+    still fail and files that arrive after their series was converted are written to
+    bids_directory/source/unconverted_series.csv.
+    The watcher only keeps track of the files that are still in the inbox, so files should be removed from it once
+    they are converted.
+    """
+    def __init__(self, input_directory, bids_directory, heuristic, settle_time=10, max_retries=2, **convert_kwargs):
+        self.input_directory = os.path.abspath(input_directory)
+        self.bids_directory = os.path.abspath(bids_directory)
+        self.heuristic = heuristic
+        self.settle_time = settle_time
+        self.max_retries = max_retries
+        # every series is converted from its own temporary folder, so there is nothing to resume it from
+        convert_kwargs["journal"] = False
+        convert_kwargs["resume"] = False
+        self.convert_kwargs = convert_kwargs
+        self._file_stats = dict()
+        self._pending_files = dict()
+        # headers of the files of the pending series
+        self._headers = dict()
+        self._last_change = dict()
+        self._failed_attempts = dict()
+        # files, still in the inbox, of the series that are no longer pending
+        self._finished_files = dict()
+
+    @property
+    def unconverted_series_csv(self):
+        return os.path.join(self.bids_directory, "source", "unconverted_series.csv")
+
+    def poll(self, now=None):
+        """
+        Read the headers of new or changed files and add them to their pending series.
+        :param now: time of the poll (default: the current time).
+        :return: list of the new or changed files.
+        """
+        now = time.time() if now is None else now
+        file_paths = dicom_reader._list_input_files(self.input_directory)
+        file_stats = stat_files(file_paths)
+        self._forget_removed_files(file_stats)
+        changed_files = [file_path for file_path in file_paths
+                         if file_path in file_stats and self._file_stats.get(file_path) != file_stats[file_path]]
+        for file_path, header in zip(changed_files, dicom_reader._read_dicom_headers(changed_files)):
+            # files that are still being written are read again once their size or modification time changes
+            self._file_stats[file_path] = file_stats[file_path]
+            series_uid = header.get("series_instance_uid") if header else None
+            if not series_uid:
+                continue
+            if series_uid in self._finished_files:
+                warn(RuntimeWarning("{} arrived after series {} was converted and will not be converted. It is "
+                                    "listed in {}.".format(file_path, series_uid, self.unconverted_series_csv)))
+                self._write_unconverted_series(series_uid, "arrived_after_conversion", [file_path])
+                continue
+            self._pending_files.setdefault(series_uid, set()).add(file_path)
+            self._headers[file_path] = header
+            self._last_change[series_uid] = now
+        return changed_files
+
+    def _forget_removed_files(self, file_stats):
+        self._file_stats = {file_path: stat for file_path, stat in self._file_stats.items() if file_path in file_stats}
+        self._headers = {file_path: header for file_path, header in self._headers.items() if file_path in file_stats}
+        for series_uid in list(self._pending_files):
+            self._pending_files[series_uid].intersection_update(file_stats)
+            if not self._pending_files[series_uid]:
+                # every file of the series was removed before it was converted
+                del self._pending_files[series_uid]
+                self._last_change.pop(series_uid, None)
+                self._failed_attempts.pop(series_uid, None)
+        for series_uid in list(self._finished_files):
+            self._finished_files[series_uid].intersection_update(file_stats)
+            if not self._finished_files[series_uid]:
+                del self._finished_files[series_uid]
+
+    def _write_unconverted_series(self, series_uid, status, file_paths, error=""):
+        output_csv = self.unconverted_series_csv
+        os.makedirs(os.path.dirname(output_csv), exist_ok=True)
+        write_header = not os.path.exists(output_csv)
+        with open(output_csv, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["series_instance_uid", "status", "source_file", "error"])
+            if write_header:
+                writer.writeheader()
+            for file_path in sorted(file_paths):
+                writer.writerow({"series_instance_uid": series_uid, "status": status, "source_file": file_path,
+                                 "error": error})
+
+    def get_ready_series(self, now=None):
+        """
+        :return: sorted list of the pending series that have not changed for settle_time seconds.
+        """
+        now = time.time() if now is None else now
+        return sorted(series_uid for series_uid, last_change in self._last_change.items()
+                      if now - last_change >= self.settle_time)
+
+    def convert_series(self, series_uid, now=None):
+        """
+        Convert one pending series into the BIDS directory.
+        A series that fails to convert stays pending and is tried again settle_time seconds later. After max_retries
+        failed retries, the series is written to unconverted_series.csv.
+        :param now: time of the conversion (default: the current time).
+        :return: the converted DataSet, or None if the conversion failed.
+        """
+        file_paths = self._pending_files.pop(series_uid)
+        self._last_change.pop(series_uid)
+        link_root = tempfile.mkdtemp(prefix="bidsmanager_series_")
+        try:
+            link_directory = os.path.join(link_root, "dicoms")
+            links = dicom_reader._link_series_files(file_paths, link_directory)
+            dataset = dicom_reader.convert_dicom_directory(input_directory=link_directory,
+                                                           heuristic=self.heuristic,
+                                                           bids_directory=self.bids_directory,
+                                                           dicom_headers={links[file_path]: self._headers.get(file_path)
+                                                                          for file_path in file_paths},
+                                                           **self.convert_kwargs)
+        except Exception as error:
+            attempts = self._failed_attempts.get(series_uid, 0) + 1
+            if attempts <= self.max_retries:
+                warn(RuntimeWarning("Could not convert series {}: {}. It will be tried again in {} seconds.".format(
+                    series_uid, error, self.settle_time)))
+                self._failed_attempts[series_uid] = attempts
+                self._pending_files[series_uid] = file_paths
+                self._last_change[series_uid] = time.time() if now is None else now
+            else:
+                warn(RuntimeWarning("Could not convert series {}: {}. It is listed in {}.".format(
+                    series_uid, error, self.unconverted_series_csv)))
+                self._failed_attempts.pop(series_uid, None)
+                self._finish_series(series_uid, file_paths)
+                self._write_unconverted_series(series_uid, "failed", file_paths, error=str(error))
+            return None
+        finally:
+            shutil.rmtree(link_root)
+        self._failed_attempts.pop(series_uid, None)
+        self._finish_series(series_uid, file_paths)
+        return dataset
+
+    def _finish_series(self, series_uid, file_paths):
+        self._finished_files[series_uid] = set(file_paths)
+        for file_path in file_paths:
+            self._headers.pop(file_path, None)
+
+    def run(self, poll_interval=2, max_polls=None):
+        """
+        Poll the inbox and convert completed series until interrupted.
+        :param poll_interval: seconds to wait between polls.
+        :param max_polls: optional number of polls after which to stop.
+        """
+        polls = 0
+        try:
+            while max_polls is None or polls < max_polls:
+                self.poll()
+                for series_uid in self.get_ready_series():
+                    print("Converting series {}".format(series_uid))
+                    self.convert_series(series_uid)
+                polls += 1
+                if max_polls is None or polls < max_polls:
+                    time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            print("Stopped watching {}".format(self.input_directory))
+
+
+def watch_dicom_directory(input_directory, heuristic, bids_directory, settle_time=10, poll_interval=2, max_polls=None,
+                          max_retries=2, **convert_kwargs):
+    """
+    Watch a directory for arriving DICOM files and convert each series into bids_directory once it is complete.
+    :param input_directory: inbox directory that receives DICOM files.
+    :param heuristic: heuristic used to convert the series (see convert_dicom_directory).
+    :param bids_directory: BIDS directory the series are converted into.
+    :param settle_time: seconds without new files after which a series is considered complete.
+    :param poll_interval: seconds to wait between polls of the inbox.
+    :param max_polls: optional number of polls after which to stop (default: run until interrupted).
+    :param max_retries: number of times a series that failed to convert is tried again.
+    :param convert_kwargs: additional keyword arguments passed to convert_dicom_directory.
+    :return: the DicomInboxWatcher.
+    """
+    watcher = DicomInboxWatcher(input_directory, bids_directory, heuristic, settle_time=settle_time,
+                                max_retries=max_retries, **convert_kwargs)
+    print("Watching {} for DICOM files".format(watcher.input_directory))
+    watcher.run(poll_interval=poll_interval, max_polls=max_polls)
+    return watcher
@@ -1,45 +1,71 @@
-import glob
 import os
+from functools import partial
 
 from ..base.session import Session
 from ..read.group_reader import read_group
 from ..read.image_reader import parse_generic_name
-from ..utils.utils import read_tsv
+from ..utils.utils import read_tsv, scan_directory
 
 
-def load_groups(path_to_session_folder, metadata=None):
-    groups = list()
-    for group_folder in glob.glob(os.path.join(path_to_session_folder, "*")):
-        if os.path.isdir(group_folder):
-            groups.append(read_group(group_folder, metadata=metadata))
-    return groups
+def load_groups(path_to_session_folder, metadata=None, directories=None):
+    """
+    :param directories: optional names of the folders in the session folder, so that it does not have to be listed
+        again.
+    """
+    if directories is None:
+        directories, _ = scan_directory(path_to_session_folder)
+    return [read_group(os.path.join(path_to_session_folder, directory), metadata=metadata)
+            for directory in directories]
 
 
 def parse_session_name(path_to_session_folder):
     return parse_generic_name(path_to_session_folder, "ses")
 
 
-def read_session(path_to_session_folder, subject_id, metadata=None):
+def read_session(path_to_session_folder, subject_id, metadata=None, filenames=None, directories=None, tables=None,
+                 lazy=False):
+    """
+    :param filenames: optional names of the files in the session folder.
+    :param directories: optional names of the folders in the session folder. The session folder is listed if the
+        names are not given.
+    :param tables: optional TableCache with the TSV files already read during this load.
+    :param lazy: return the session without reading its folder; the groups are read when they are first used.
+    """
     session_name = parse_session_name(path_to_session_folder)
     session = Session(name=session_name, path=path_to_session_folder,
                       metadata=get_session_metadata(metadata, session_name))
-    for group in load_groups(path_to_session_folder, metadata=read_scans_metadata(path_to_session_folder, subject_id,
-                                                                                  session_name)):
-        session.add_group(group)
+    load = partial(add_groups_to_session, path_to_session_folder=path_to_session_folder, subject_id=subject_id,
+                   filenames=filenames, directories=directories, tables=tables)
+    if lazy:
+        session.set_loader(load)
+    else:
+        load(session)
     return session
 
 
+def add_groups_to_session(session, path_to_session_folder, subject_id, filenames=None, directories=None, tables=None):
+    if filenames is None or directories is None:
+        directories, filenames = scan_directory(path_to_session_folder)
+    for group in load_groups(path_to_session_folder, directories=directories,
+                             metadata=read_scans_metadata(path_to_session_folder, subject_id, session.get_name(),
+                                                          filenames=filenames, tables=tables)):
+        session.add_group(group)
+
+
 def get_session_metadata(metadata, session_name):
     if metadata:
         return metadata["ses-{0}".format(session_name)]
 
 
-def read_scans_metadata(path_to_session_folder, subject_id, session_name=None):
+def read_scans_metadata(path_to_session_folder, subject_id, session_name=None, filenames=None, tables=None):
     subject_basename = "sub-{}".format(subject_id)
     components = [subject_basename, "scans.tsv"]
     if session_name:
         session_basename = "ses-{}".format(session_name)
         components.insert(1, session_basename)
     metadata_file = os.path.join(path_to_session_folder, "_".join(components))
-    if os.path.isfile(metadata_file):
+    exists = ("_".join(components) in filenames) if filenames is not None else None
+    if tables is not None:
+        return tables.get_table(metadata_file, exists=exists)
+    if exists if exists is not None else os.path.isfile(metadata_file):
         return read_tsv(metadata_file)
@@ -1,38 +1,66 @@
-import glob
 import os
+from functools import partial
 
 from ..base.subject import Subject
 from ..read.session_reader import read_session
 from ..read.image_reader import parse_generic_name
-from ..utils.utils import read_tsv
+from ..utils.utils import read_tsv, scan_directory
 
 
 def parse_subject_id(path_to_subject):
     return parse_generic_name(path_to_subject, "sub")
 
 
-def read_subject(path_to_subject, metadata=None):
+def read_subject(path_to_subject, metadata=None, tables=None, lazy=False):
+    """
+    :param lazy: return the subject without reading its folder; the sessions are read when they are first used and
+        their folders when their images are first used.
+    """
     subject_id = parse_subject_id(path_to_subject)
     subject = Subject(subject_id, metadata=get_subject_metadata(metadata, subject_id), path=path_to_subject)
-    session_folders = glob.glob(os.path.join(path_to_subject, "ses-*"))
-    add_session_folders(session_folders, subject, path_to_subject)
+    load = partial(add_sessions_to_subject, path_to_subject=path_to_subject, tables=tables, lazy=lazy)
+    if lazy:
+        subject.set_loader(load)
+    else:
+        load(subject)
     return subject
 
 
-def add_session_folders(session_folders, subject, path_to_subject):
-    sessions_metadata = read_sessions_metadata(path_to_subject, subject.get_id())
+def add_sessions_to_subject(subject, path_to_subject, tables=None, lazy=False):
+    directories, filenames = scan_directory(path_to_subject)
+    session_folders = [os.path.join(path_to_subject, directory) for directory in directories
+                       if directory.startswith("ses-")]
+    add_session_folders(session_folders, subject, path_to_subject, filenames=filenames,
+                        directories=None if session_folders else directories, tables=tables, lazy=lazy)
+
+
+def add_session_folders(session_folders, subject, path_to_subject, filenames=None, directories=None, tables=None,
+                        lazy=False):
+    """
+    :param filenames: optional names of the files in the subject folder, so that it does not have to be listed again.
+    :param directories: optional names of the folders in the subject folder (used when it has no session folders).
+    :param tables: optional TableCache with the TSV files already read during this load.
+    :param lazy: add sessions that read their folders when they are first used.
+    """
+    sessions_metadata = read_sessions_metadata(path_to_subject, subject.get_id(), filenames=filenames, tables=tables)
     if session_folders:
         for session_folder in session_folders:
-            session = read_session(session_folder, subject_id=subject.get_id(), metadata=sessions_metadata)
+            session = read_session(session_folder, subject_id=subject.get_id(), metadata=sessions_metadata,
+                                   tables=tables, lazy=lazy)
             subject.add_session(session)
     else:
-        session = read_session(path_to_subject, subject_id=subject.get_id(), metadata=sessions_metadata)
+        session = read_session(path_to_subject, subject_id=subject.get_id(), metadata=sessions_metadata,
+                               filenames=filenames, directories=directories, tables=tables, lazy=lazy)
         subject.add_session(session)
 
 
-def read_sessions_metadata(path_to_subject, subject_id):
-    meta_data_file = os.path.join(path_to_subject, "sub-{0}_sessions.tsv".format(subject_id))
-    if os.path.isfile(meta_data_file):
+def read_sessions_metadata(path_to_subject, subject_id, filenames=None, tables=None):
+    basename = "sub-{0}_sessions.tsv".format(subject_id)
+    meta_data_file = os.path.join(path_to_subject, basename)
+    exists = (basename in filenames) if filenames is not None else None
+    if tables is not None:
+        return tables.get_table(meta_data_file, exists=exists)
+    if exists if exists is not None else os.path.isfile(meta_data_file):
         return read_tsv(meta_data_file)
 
 
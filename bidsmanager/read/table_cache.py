@@ -0,0 +1,33 @@
+import os
+import threading
+
+from ..utils.utils import read_tsv
+
+
+class TableCache(object):
+    """
+    TSV metadata files (participants.tsv, sessions.tsv and scans.tsv) read while loading a dataset.
+    Each file is parsed at most once per load, even when subjects are read by several threads, and every subject or
+    session then looks up its own row in the parsed table.
+    """
+    def __init__(self):
+        self._tables = dict()
+        self._locks = dict()
+        self._lock = threading.Lock()
+
+    def get_table(self, filename, exists=None):
+        """
+        :param exists: optional result of a directory listing telling whether the file exists, so that it does not
+            have to be checked on disk.
+        :return: dictionary of row key -> row (see read_tsv), or None if the file does not exist.
+        """
+        with self._lock:
+            if filename in self._tables:
+                return self._tables[filename]
+            file_lock = self._locks.setdefault(filename, threading.Lock())
+        with file_lock:
+            if filename not in self._tables:
+                if exists is None:
+                    exists = os.path.isfile(filename)
+                self._tables[filename] = read_tsv(filename) if exists else None
+        return self._tables[filename]
@@ -0,0 +1,157 @@
+import hashlib
+import os
+import threading
+
+
+class ChecksumManifest(object):
+    """
+    Content digests of files, cached together with the size and modification time they were computed for.
+    The manifest is stored as a TSV file (usually <dataset>/.bidsmanager/checksums) with paths relative to the
+    directory of the dataset, so comparing a file to a copy of it only reads files whose digests are unknown or whose
+    size or modification time changed. Only files inside the dataset are recorded; the digests of files outside of
+    it (e.g. the sources of a conversion) are computed when they are needed.
+    """
+    _header = ("path", "size", "mtime_ns", "digest")
+
+    def __init__(self, filename, root=None):
+        self.filename = os.path.abspath(filename)
+        self.root = os.path.abspath(root) if root else os.path.dirname(os.path.dirname(self.filename))
+        self._entries = dict()
+        self._lock = threading.Lock()
+        if os.path.exists(self.filename):
+            self.load()
+
+    def _key(self, path):
+        """
+        :return: the path relative to the directory of the dataset, or None if it is outside of it.
+        """
+        key = os.path.relpath(os.path.abspath(path), self.root)
+        if key == os.pardir or key.startswith(os.pardir + os.sep):
+            return None
+        return key
+
+    def load(self):
+        with open(self.filename, "r") as opened_file:
+            for index, line in enumerate(opened_file):
+                row = line.rstrip("\n").split("\t")
+                if index == 0 or len(row) != len(self._header):
+                    continue
+                path, size, mtime_ns, digest = row
+                if path != os.pardir and not path.startswith(os.pardir + os.sep):
+                    self._entries[path] = (int(size), int(mtime_ns), digest)
+
+    def save(self):
+        directory = os.path.dirname(self.filename)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_filename = self.filename + ".tmp"
+        with self._lock:
+            rows = sorted(self._entries.items())
+        with open(tmp_filename, "w") as opened_file:
+            opened_file.write("\t".join(self._header) + "\n")
+            for path, (size, mtime_ns, digest) in rows:
+                opened_file.write("\t".join([path, str(size), str(mtime_ns), digest]) + "\n")
+        os.replace(tmp_filename, self.filename)
+
+    def digest(self, path):
+        """
+        :return: the digest of the file, computed only if it is not cached for the file's current size and
+        modification time.
+        """
+        stat = os.stat(path)
+        key = self._key(path)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            return entry[2]
+        digest = compute_digest(path)
+        if key is not None:
+            with self._lock:
+                self._entries[key] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+    def has_digest(self, path):
+        """
+        :return: True if the digest of the file is cached for its current size and modification time.
+        """
+        key = self._key(path)
+        with self._lock:
+            entry = self._entries.get(key)
+        if not entry:
+            return False
+        stat = os.stat(path)
+        return entry[:2] == (stat.st_size, stat.st_mtime_ns)
+
+    def record_digest(self, path, digest):
+        """
+        Cache the digest of a file that was computed while it was written (see update_file).
+        """
+        key = self._key(path)
+        if key is not None:
+            stat = os.stat(path)
+            with self._lock:
+                self._entries[key] = (stat.st_size, stat.st_mtime_ns, digest)
+
+    def record_transfer(self, in_file, out_file, moved=False):
+        """
+        Give out_file the cached digest of in_file after it was copied, moved or linked from it, so that the digest
+        does not have to be computed again.
+        """
+        with self._lock:
+            entry = self._entries.pop(self._key(in_file), None) if moved else self._entries.get(self._key(in_file))
+        if entry and not moved:
+            stat = os.stat(in_file)
+            if entry[:2] != (stat.st_size, stat.st_mtime_ns):
+                entry = None
+        out_key = self._key(out_file)
+        if entry and out_key is not None:
+            stat = os.stat(out_file)
+            if stat.st_size == entry[0]:
+                with self._lock:
+                    self._entries[out_key] = (stat.st_size, stat.st_mtime_ns, entry[2])
+
+    def move_directories(self, renames):
+        """
+        Move the cached digests of the files in renamed directories to their new paths.
+        :param renames: list of (old directory, new directory) pairs. The directories may take each other's paths.
+        """
+        with self._lock:
+            moved = dict()
+            for old_directory, new_directory in renames:
+                old_key = self._key(old_directory)
+                new_key = self._key(new_directory)
+                if old_key is None or new_key is None:
+                    continue
+                for key in [key for key in self._entries if key == old_key or key.startswith(old_key + os.sep)]:
+                    moved[new_key + key[len(old_key):]] = self._entries.pop(key)
+            self._entries.update(moved)
+
+    def forget(self, path):
+        with self._lock:
+            self._entries.pop(self._key(path), None)
+
+    def files_match(self, file1, file2):
+        """
+        :return: True if the two files have the same contents. Files with different sizes are never read; files
+        that are not the same file and have different modification times are compared by their digests.
+        """
+        stat1 = os.stat(file1)
+        stat2 = os.stat(file2)
+        if stat1.st_size != stat2.st_size:
+            return False
+        # same shortcut as filecmp.cmp: files with the same size and modification time are treated as equal
+        if (stat1.st_dev, stat1.st_ino) == (stat2.st_dev, stat2.st_ino) or stat1.st_mtime_ns == stat2.st_mtime_ns:
+            return True
+        return self.digest(file1) == self.digest(file2)
+
+
+def new_digest():
+    return hashlib.blake2b(digest_size=16)
+
+
+def compute_digest(path, block_size=1024 * 1024):
+    digest = new_digest()
+    with open(path, "rb") as opened_file:
+        for block in iter(lambda: opened_file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
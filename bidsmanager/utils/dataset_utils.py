@@ -1,11 +1,41 @@
+import csv
+import random
 
 
-def anonymize_dataset(dataset, id_length=2):
-    # todo: implement shuffling
-    for i, subject in enumerate(dataset.get_subjects()):
-        subject.set_name("{0:0{1}d}".format(i + 1, id_length))
-        for ii, session_name in enumerate(sorted(subject.get_session_names())):
-            session = subject.get_session(session_name)
-            session.set_name("{0:0{1}d}".format(ii + 1, id_length))
+def anonymize_dataset(dataset, id_length=2, shuffle=True, mapping_file=None, seed=None):
+    """
+    Replace the subject and session names of a dataset with numbers. Call dataset.update(move=True) afterwards to
+    rename the subject and session directories on disk.
+    :param dataset: DataSet to anonymize.
+    :param id_length: number of digits of the new names.
+    :param shuffle: assign the subject numbers in random order, so that they do not follow the order of the original
+        names.
+    :param mapping_file: optional CSV file to write the original and new subject and session names to, with the
+        columns original_subject, original_session, bids_subject and bids_session.
+    :param seed: optional seed for the shuffling.
+    :return: the anonymized DataSet.
+    """
+    subject_names = sorted(dataset.get_subject_ids())
+    new_subject_names = ["{0:0{1}d}".format(i + 1, id_length) for i in range(len(subject_names))]
+    if shuffle:
+        random.Random(seed).shuffle(new_subject_names)
+    dataset.rename_children(dict(zip(subject_names, new_subject_names)))
+
+    rows = []
+    for subject_name, new_subject_name in zip(subject_names, new_subject_names):
+        subject = dataset.get_subject(new_subject_name)
+        session_names = sorted(subject.get_session_names())
+        new_session_names = ["{0:0{1}d}".format(i + 1, id_length) for i in range(len(session_names))]
+        subject.rename_children(dict(zip(session_names, new_session_names)))
+        for session_name, new_session_name in zip(session_names, new_session_names):
+            rows.append({"original_subject": subject_name, "original_session": session_name,
+                         "bids_subject": new_subject_name, "bids_session": new_session_name})
+
+    if mapping_file:
+        with open(mapping_file, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["original_subject", "original_session", "bids_subject",
+                                                   "bids_session"])
+            writer.writeheader()
+            writer.writerows(rows)
 
     return dataset
@@ -0,0 +1,60 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+class JSONCache(object):
+    """
+    Parsed JSON files (mostly image sidecars) kept for the whole process. Entries are keyed on the path of the file
+    and are only used while the file has the size and modification time it had when it was parsed, so a file is
+    parsed again only after it changed. The least recently used entries are dropped once more than maxsize files are
+    cached.
+    The cached values are shared by everyone reading the same file; callers that change them must copy them first.
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, path):
+        """
+        :return: the parsed contents of the JSON file, read from disk only if they are not cached for the file's
+        current size and modification time.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == (stat.st_size, stat.st_mtime_ns):
+                self._entries.move_to_end(path)
+                return entry[1]
+        with open(path, "r") as opened_file:
+            data = json.load(opened_file)
+        self._add(path, stat, data)
+        return data
+
+    def store(self, path, data):
+        """
+        Cache data as the contents of a JSON file that was just written, so that reading the file back does not parse
+        it again.
+        """
+        path = os.path.abspath(path)
+        self._add(path, os.stat(path), data)
+
+    def _add(self, path, stat, data):
+        with self._lock:
+            self._entries[path] = ((stat.st_size, stat.st_mtime_ns), data)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+json_cache = JSONCache()
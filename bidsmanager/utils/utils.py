@@ -1,22 +1,237 @@
+import errno
 import filecmp
 import shutil
 import os
 import json
+import uuid
 
+from .checksums import new_digest
 
 
-def update_file(old_file, new_file, move=False):
-    if not os.path.exists(new_file) or (old_file is not None and not filecmp.cmp(old_file, new_file)):
-        copy_or_move(old_file, new_file, move=move)
+def update_file(old_file, new_file, move=False, checksums=None):
+    """
+    Copy, move or link old_file to new_file unless new_file already has the same contents. A move whose old_file is
+    gone and whose new_file exists is treated as done, so that a write that was interrupted can be executed again.
+    :param checksums: optional ChecksumManifest used to compare the files by their cached digests instead of
+    reading both of them. A file that is copied and whose digest is not cached yet is digested while it is copied.
+    """
+    if move is True and old_file is not None and not os.path.lexists(old_file) and os.path.lexists(new_file):
+        return
+    if checksums is None:
+        if not os.path.exists(new_file) or (old_file is not None and not filecmp.cmp(old_file, new_file)):
+            copy_or_move(old_file, new_file, move=move)
+    elif not os.path.exists(new_file) or (old_file is not None and not checksums.files_match(old_file, new_file)):
+        if move not in (True, 'link', 'hardlink', 'reflink') and not checksums.has_digest(old_file):
+            digest = new_digest()
+            copy_file(old_file, new_file, digest=digest)
+            checksums.record_digest(old_file, digest.hexdigest())
+            checksums.record_digest(new_file, digest.hexdigest())
+        else:
+            copy_or_move(old_file, new_file, move=move)
+            checksums.record_transfer(old_file, new_file, moved=move is True)
+
+
+# size of the blocks in which files are copied when they are digested at the same time
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# ioctl request that clones the extents of one file into another on filesystems such as btrfs and XFS
+FICLONE = 0x40049409
+
+# errors of os.link for files on different filesystems or filesystems that do not support hard links
+HARDLINK_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP)
 
 
 def copy_or_move(in_file, out_file, move=False):
+    """
+    :param move: True moves the file, 'link' creates a symbolic link, 'hardlink' creates a hard link and 'reflink'
+    creates a copy-on-write clone. Hard links and clones fall back to a copy when the files are on different
+    filesystems or the filesystem does not support them. Any other value copies the file.
+    """
     if move == 'link':
         os.symlink(in_file, out_file)
     elif move is True:
         shutil.move(in_file, out_file)
+    elif move == 'hardlink':
+        hardlink_or_copy(in_file, out_file)
+    elif move == 'reflink':
+        reflink_or_copy(in_file, out_file)
     else:
-        shutil.copy(in_file, out_file)
+        copy_file(in_file, out_file)
+
+
+def hardlink_or_copy(in_file, out_file):
+    # a unique temporary name so that a link left behind by an interrupted run never blocks linking
+    tmp_file = temporary_path(out_file)
+    try:
+        os.link(in_file, tmp_file)
+    except OSError as error:
+        if error.errno not in HARDLINK_UNSUPPORTED_ERRNOS:
+            raise
+        copy_file(in_file, out_file)
+        return
+    try:
+        os.replace(tmp_file, out_file)
+    except BaseException:
+        remove_temporary_file(tmp_file)
+        raise
+
+
+def reflink_or_copy(in_file, out_file):
+    tmp_file = temporary_path(out_file)
+    try:
+        import fcntl
+        with open(in_file, "rb") as source, open(tmp_file, "wb") as destination:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+    except (ImportError, OSError):
+        remove_temporary_file(tmp_file)
+        copy_file(in_file, out_file)
+        return
+    try:
+        shutil.copymode(in_file, tmp_file)
+        os.replace(tmp_file, out_file)
+    except BaseException:
+        remove_temporary_file(tmp_file)
+        raise
+
+
+def copy_file(in_file, out_file, digest=None):
+    """
+    Copy a file with os.copy_file_range so that the kernel (or an NFS server) copies the data without passing it
+    through user space. Falls back to shutil.copy where copy_file_range is not available or not supported between
+    the two filesystems.
+    The copy is written to a hidden temporary file that then replaces out_file, so readers never see a partly written
+    file and hard links to a previous out_file are left unchanged.
+    :param digest: optional hashlib object that is updated with the contents of the file. The file is then copied
+    block by block through user space, so that it is read only once.
+    """
+    if os.path.isdir(out_file):
+        out_file = os.path.join(out_file, os.path.basename(in_file))
+    tmp_file = temporary_path(out_file)
+    try:
+        _copy_contents(in_file, tmp_file, digest=digest)
+        shutil.copymode(in_file, tmp_file)
+        os.replace(tmp_file, out_file)
+    except BaseException:
+        remove_temporary_file(tmp_file)
+        raise
+
+
+def _copy_contents(in_file, out_file, digest=None):
+    remaining = None
+    if digest is not None:
+        with open(in_file, "rb") as source, open(out_file, "wb") as destination:
+            for block in iter(lambda: source.read(COPY_BLOCK_SIZE), b""):
+                digest.update(block)
+                destination.write(block)
+        remaining = 0
+    elif hasattr(os, "copy_file_range"):
+        try:
+            with open(in_file, "rb") as source, open(out_file, "wb") as destination:
+                remaining = os.fstat(source.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(source.fileno(), destination.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+        except OSError:
+            remaining = None
+    if remaining != 0:
+        shutil.copyfile(in_file, out_file)
+
+
+def temporary_path(path):
+    """
+    :return: a unique path next to path for a file that is written and then renamed to path. The name starts with "."
+    so that readers listing the folder never pick up a partly written file, and ends with ".tmp" instead of the
+    extension of path.
+    """
+    directory, basename = os.path.split(path)
+    return os.path.join(directory, ".{0}.{1}.tmp".format(basename, uuid.uuid4().hex))
+
+
+def remove_temporary_file(tmp_file):
+    try:
+        os.remove(tmp_file)
+    except FileNotFoundError:
+        pass
+
+
+def same_filesystem(path1, path2):
+    """
+    :return: True if the two paths (or, for paths that do not exist yet, their closest existing parents) are on the
+    same filesystem, so that files can be renamed from one to the other instead of copied.
+    """
+    return os.stat(_existing_parent(path1)).st_dev == os.stat(_existing_parent(path2)).st_dev
+
+
+def get_free_space(path):
+    """
+    :return: the number of bytes available on the filesystem of path (or its closest existing parent).
+    """
+    return shutil.disk_usage(_existing_parent(path)).free
+
+
+def is_writable(path):
+    """
+    :return: True if files can be created in path (or, for a path that does not exist yet, in its closest existing
+    parent).
+    """
+    return os.access(_existing_parent(path), os.W_OK)
+
+
+def _existing_parent(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+# renameat2() flag that atomically exchanges two paths (Linux)
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+
+
+def exchange_paths(path1, path2):
+    """
+    Swap two files or directories. On Linux this is a single atomic renameat2(RENAME_EXCHANGE) call; elsewhere, or
+    when the filesystem does not support it, path1 is renamed aside first, which leaves a short moment in which
+    path1 does not exist.
+    """
+    try:
+        import ctypes
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (ImportError, OSError, AttributeError):
+        renameat2 = None
+    if renameat2 is not None and renameat2(AT_FDCWD, os.fsencode(path1), AT_FDCWD, os.fsencode(path2),
+                                           RENAME_EXCHANGE) == 0:
+        return
+    tmp_path = "{0}.exchange_{1}".format(path1, uuid.uuid4().hex)
+    os.rename(path1, tmp_path)
+    os.rename(path2, path1)
+    os.rename(tmp_path, path2)
+
+
+def scan_directory(directory):
+    """
+    List a directory with a single os.scandir call.
+    Entries whose names start with "." are left out, and a directory that does not exist is empty, as with glob.
+    :return: sorted list of the names of the subdirectories and set of the names of the other entries.
+    """
+    directories = []
+    filenames = set()
+    try:
+        entries = os.scandir(directory)
+    except (FileNotFoundError, NotADirectoryError):
+        return directories, filenames
+    with entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                directories.append(entry.name)
+            else:
+                filenames.add(entry.name)
+    return sorted(directories), filenames
 
 
 def read_json(in_file):
@@ -25,37 +240,92 @@ def read_json(in_file):
 
 
 def read_tsv(in_file):
-    data = dict()
+    """
+    Read a TSV file into a dictionary of row key -> dictionary of column name -> value. Empty cells are left out and
+    the values of each column are parsed together (see parse_column).
+    """
     with open(in_file, "r") as tsv_file:
-        for i, line in enumerate(tsv_file):
-            row = line.strip().split("\t")
-            if i == 0:
-                header = row
-            else:
-                row_data = dict()
-                # assumes all rows are the same length
-                for index in range(1, len(row)):
-                    value = row[index]
-                    if value:
-                        row_data[header[index]] = parse_input(value)
-                # assumes the first column to be the id column
-                key = row[0]
-                data[key] = row_data
+        rows = [line.strip().split("\t") for line in tsv_file]
+    data = dict()
+    if len(rows) < 2:
+        return data
+    header, rows = rows[0], rows[1:]
+    rows_data = [dict() for _ in rows]
+    for index in range(1, max(len(row) for row in rows)):
+        cells = [(row_data, row[index]) for row, row_data in zip(rows, rows_data) if len(row) > index and row[index]]
+        if cells:
+            values = parse_column([value for _, value in cells])
+            for (row_data, _), value in zip(cells, values):
+                row_data[header[index]] = value
+    for row, row_data in zip(rows, rows_data):
+        # assumes the first column to be the id column
+        data[row[0]] = row_data
     return data
 
 
+def parse_column(values):
+    """
+    Parse the values of a TSV column the same way parse_input parses each value, but with a single call to
+    pandas.to_numeric and a single call to pandas.to_datetime for the whole column instead of one call per value.
+    Numbers are only tested as datetimes if they are written as plain digits that could be a date (e.g. 2024 or
+    20240101), so numeric columns skip the datetime parsing entirely.
+    :param values: list of non-empty strings.
+    :return: list of parsed values.
+    """
+    import pandas as pd
+    series = pd.Series(values, dtype=object)
+    is_text = pd.to_numeric(series, errors="coerce").isna()
+    if is_text.all():
+        date_indices = list(range(len(values)))
+    else:
+        date_indices = [index for index, (value, text) in enumerate(zip(values, is_text))
+                        if text or _could_be_date(value)]
+    parsed = list(values)
+    for index, text in enumerate(is_text):
+        if not text:
+            parsed[index] = parse_float(values[index])
+    if not date_indices:
+        return parsed
+    date_values = [values[index] for index in date_indices]
+    try:
+        datetimes = pd.to_datetime(series.iloc[date_indices], format="mixed", errors="coerce")
+    except ValueError:
+        # e.g. datetimes in different time zones
+        for index, value in zip(date_indices, date_values):
+            parsed[index] = parse_input(value)
+        return parsed
+    for index, value, datetime_ in zip(date_indices, date_values, datetimes):
+        if datetime_ is not pd.NaT:
+            parsed[index] = _date_or_datetime(datetime_)
+        elif value.strip().lower() in ("nan", "nat"):
+            # parsed as NaT, not as a failed datetime
+            parsed[index] = parse_input(value)
+        elif is_text.iat[index]:
+            parsed[index] = parse_float(value)
+    return parsed
+
+
+def _could_be_date(value):
+    # pandas reads digits-only values of four or more digits as years or as dates such as 20240101
+    value = value.strip()
+    return len(value) >= 4 and value.isdigit()
+
+
 def parse_input(string):
     import pandas as pd
     try:
-        datetime_ = pd.to_datetime(string)
-        if datetime_.hour == 0 and datetime_.minute == 0 and datetime_.second == 0:
-            return datetime_.date()
-        else:
-            return datetime_
+        return _date_or_datetime(pd.to_datetime(string))
     except ValueError:
         return parse_float(string)
 
 
+def _date_or_datetime(datetime_):
+    if datetime_.hour == 0 and datetime_.minute == 0 and datetime_.second == 0:
+        return datetime_.date()
+    else:
+        return datetime_
+
+
 def parse_float(string):
     try:
         return float(string)
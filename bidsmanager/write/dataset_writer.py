@@ -1,14 +1,26 @@
 import os
 import json
 from datetime import datetime
-import copy
 
+from ..utils.json_cache import json_cache
 
-def write_dataset(dataset, output_dir, move=False):
-    dataset = copy.deepcopy(dataset)
-    dataset.set_path(os.path.abspath(output_dir))
-    dataset.update(move=move)
-    return dataset
+
+def write_dataset(dataset, output_dir, move=False, jobs=1):
+    """
+    Write a dataset to output_dir. The target paths are computed from the dataset without copying or changing it.
+    :param move: True to move the input files, 'link', 'hardlink' or 'reflink' to link them, False to copy them.
+    :param jobs: number of threads used to copy, move and write files.
+    :return: a copy of the dataset with the paths it was written to. Other subjects already in output_dir are not
+        included.
+    """
+    from .write_plan import WritePlan
+    from ..utils.checksums import ChecksumManifest
+    output_dir = os.path.abspath(output_dir)
+    plan = WritePlan(checksums=ChecksumManifest(os.path.join(output_dir, ".bidsmanager", "checksums"),
+                                                root=output_dir))
+    written_dataset = dataset.plan_write(plan, output_dir, move=move)
+    plan.execute(jobs=jobs)
+    return written_dataset
 
 
 def make_dirs(directory):
@@ -18,7 +30,8 @@ def make_dirs(directory):
 
 def write_tsv(data_dict, out_file, first_colum="id"):
     columns = get_all_sub_keys(data_dict)
-    with open(out_file, "w") as opened_file:
+    tmp_file = out_file + ".tmp"
+    with open(tmp_file, "w") as opened_file:
         header = [first_colum] + list(columns)
         write_tsv_row(header, opened_file)
         for key, value in data_dict.items():
@@ -30,6 +43,8 @@ def write_tsv(data_dict, out_file, first_colum="id"):
                     column_values.append("")
             row = [key] + column_values
             write_tsv_row(row, opened_file)
+    # readers of the dataset see either the previous or the new file, never a partly written one
+    os.replace(tmp_file, out_file)
 
 
 def data_value_to_string(data):
@@ -48,8 +63,14 @@ def data_value_to_string(data):
 
 
 def write_json(data, out_file):
-    with open(out_file, "w") as opened_file:
-        json.dump(data, opened_file)
+    tmp_file = out_file + ".tmp"
+    text = json.dumps(data)
+    with open(tmp_file, "w") as opened_file:
+        opened_file.write(text)
+    os.replace(tmp_file, out_file)
+    # parsed from the written text (not the data, which the caller may still change) so that reading the file back
+    # does not read it from disk
+    json_cache.store(out_file, json.loads(text))
 
 
 def write_tsv_row(row, opened_file):
@@ -0,0 +1,327 @@
+import os
+import shutil
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .dataset_writer import write_json, write_tsv, data_value_to_string
+from ..utils.utils import update_file, hardlink_or_copy, exchange_paths
+
+
+WriteOperation = namedtuple("WriteOperation", ["action", "source", "destination", "data"])
+
+
+class WritePlan(object):
+    """
+    Ordered list of the filesystem operations needed to write a BIDS object: directories to rename, directories to
+    create, files to copy, move or link, JSON/TSV files to write, files to remove and previous directories to remove
+    once they are empty. Source paths of operations added after a directory rename are mapped into the renamed
+    directory.
+    Building the plan does not touch the output directory, so a plan can be inspected as a dry run before it is
+    executed. When a ChecksumManifest is given, existing files are compared to their sources by digest and the
+    manifest is saved after the plan is executed.
+    :param root: directory of the dataset the plan writes to; needed for staged execution.
+    """
+    def __init__(self, checksums=None, root=None):
+        self.checksums = checksums
+        self.root = os.path.abspath(root) if root else None
+        self.staging_directory = None
+        if self.root:
+            self.staging_directory = os.path.join(self.root, ".bidsmanager", "staging", uuid.uuid4().hex)
+        self.directory_renames = []
+        self.directories = []
+        self.operations = []
+        self.directories_to_remove = []
+
+    def to_dict(self):
+        """
+        :return: the plan as a dictionary that can be written as JSON (see from_dict). The values of TSV files are
+            converted to the strings they are written as. The checksum manifest is not included.
+        """
+        operations = []
+        for operation in self.operations:
+            data = operation.data
+            if operation.action == "write_tsv":
+                rows, first_column = data
+                data = [dict((key, dict((column, data_value_to_string(value)) for column, value in row.items()))
+                             for key, row in rows.items()), first_column]
+            operations.append([operation.action, operation.source, operation.destination, data])
+        return {"root": self.root,
+                "staging_directory": self.staging_directory,
+                "directory_renames": self.directory_renames,
+                "directories": self.directories,
+                "operations": operations,
+                "directories_to_remove": self.directories_to_remove}
+
+    @classmethod
+    def from_dict(cls, state, checksums=None):
+        """
+        :param state: dictionary returned by to_dict.
+        :param checksums: optional ChecksumManifest of the dataset the plan writes to.
+        :return: the WritePlan.
+        """
+        plan = cls(checksums=checksums, root=state["root"])
+        plan.staging_directory = state["staging_directory"]
+        plan.directory_renames = [[tuple(rename) for rename in renames] for renames in state["directory_renames"]]
+        plan.directories = list(state["directories"])
+        plan.operations = [WriteOperation(*operation) for operation in state["operations"]]
+        plan.directories_to_remove = list(state["directories_to_remove"])
+        return plan
+
+    def rename_directories(self, renames):
+        """
+        Rename a batch of sibling directories. The renames are done through temporary names, so directories in the
+        batch can take each other's names.
+        :param renames: list of (old directory, new directory) pairs.
+        """
+        if renames:
+            self.directory_renames.append([(self.map_path(old), new) for old, new in renames])
+
+    def map_path(self, path):
+        """
+        :return: the path a file or directory will have after the planned directory renames.
+        """
+        for renames in self.directory_renames:
+            path = self._map_path_in_batch(path, renames)
+        return path
+
+    @staticmethod
+    def _map_path_in_batch(path, renames):
+        for old, new in renames:
+            if path == old or path.startswith(old + os.sep):
+                return new + path[len(old):]
+        return path
+
+    def exists(self, path):
+        """
+        :return: True if path will exist once the planned directory renames are done.
+        """
+        for renames in reversed(self.directory_renames):
+            for old, new in renames:
+                if path == new or path.startswith(new + os.sep):
+                    path = old + path[len(new):]
+                    break
+            else:
+                if any(path == old or path.startswith(old + os.sep) for old, _ in renames):
+                    return False
+        return os.path.exists(path)
+
+    def make_dirs(self, directory):
+        if directory not in self.directories:
+            self.directories.append(directory)
+
+    def update_file(self, old_file, new_file, move=False):
+        if old_file is not None:
+            old_file = self.map_path(old_file)
+        self.operations.append(WriteOperation("update_file", old_file, new_file, move))
+
+    def write_json(self, data, out_file):
+        self.operations.append(WriteOperation("write_json", None, out_file, data))
+
+    def write_tsv(self, data, out_file, first_column="id"):
+        self.operations.append(WriteOperation("write_tsv", None, out_file, (data, first_column)))
+
+    def write_text(self, text, out_file, overwrite=True):
+        self.operations.append(WriteOperation("write_text", None, out_file, (text, overwrite)))
+
+    def remove(self, in_file):
+        self.operations.append(WriteOperation("remove", self.map_path(in_file), None, None))
+
+    def remove_empty_directory(self, directory):
+        for renames in self.directory_renames:
+            if any(directory == old for old, _ in renames):
+                # the directory is not left behind, it is renamed
+                return
+            directory = self._map_path_in_batch(directory, renames)
+        self.directories_to_remove.append(directory)
+
+    def get_rows(self):
+        """
+        :return: list of dictionaries (action, source, destination) describing the plan in execution order.
+        """
+        rows = [{"action": "rename_directory", "source": old, "destination": new}
+                for renames in self.directory_renames for old, new in renames]
+        rows.extend({"action": "make_dirs", "source": None, "destination": directory} for directory in self.directories)
+        for operation in self.operations:
+            action = operation.action
+            if action == "update_file":
+                action = {True: "move", "link": "link"}.get(operation.data, "copy")
+            rows.append({"action": action, "source": operation.source, "destination": operation.destination})
+        rows.extend({"action": "remove_empty_directory", "source": directory, "destination": None}
+                    for directory in self.directories_to_remove)
+        return rows
+
+    def execute(self, jobs=1, staged=False, journal=None):
+        """
+        Execute the plan. Directories are renamed and created first, then the file operations are run by a pool of
+        jobs threads, then emptied previous directories are removed.
+        :param jobs: number of threads used for the file operations (0 or None uses the number of CPUs).
+        :param staged: write each subject directory of the dataset into a hidden staging directory first
+            (<root>/.bidsmanager/staging) and publish it with a single rename once all its files are written, so
+            that readers of the dataset never see a partly written subject. Existing subjects are hard linked into
+            the staging directory and swapped with it.
+        :param journal: optional ConversionJournal. Completed steps are recorded in it and skipped when the plan is
+            executed again after an interruption.
+        """
+        if jobs is None or jobs < 1:
+            jobs = os.cpu_count() or 1
+        for index, renames in enumerate(self.directory_renames):
+            if journal is not None and journal.is_done("rename_directories", index):
+                continue
+            tmp_directories = []
+            for old, new in renames:
+                tmp_directory = "{0}.renaming_{1}".format(old, uuid.uuid4().hex)
+                os.rename(old, tmp_directory)
+                tmp_directories.append((tmp_directory, new))
+            for tmp_directory, new in tmp_directories:
+                os.rename(tmp_directory, new)
+            if self.checksums is not None:
+                self.checksums.move_directories(renames)
+            if journal is not None:
+                journal.record("rename_directories", index)
+        directories = self.directories
+        operations = self.operations
+        directories_to_remove = self.directories_to_remove
+        staging = dict()
+        if staged:
+            staging = self._stage_subject_directories(journal=journal)
+            directories = [self._get_staged_path(directory, staging) for directory in directories]
+            operations = [operation._replace(source=self._get_staged_path(operation.source, staging),
+                                             destination=self._get_staged_path(operation.destination, staging))
+                          for operation in operations]
+            directories_to_remove = [self._get_staged_path(directory, staging)
+                                     for directory in directories_to_remove]
+        for directory in directories:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+        indices = dict((id(operation), index) for index, operation in enumerate(operations))
+        if journal is not None:
+            operations = [operation for operation in operations
+                          if not journal.is_done("write_operation", indices[id(operation)])]
+
+        def _execute(operation):
+            self._execute_operation(operation)
+            if journal is not None:
+                # the entries are not synced one by one: operations that are executed again after a crash are
+                # idempotent (moves and removes that already happened are skipped, copies and writes are repeated)
+                journal.record("write_operation", indices[id(operation)], sync=False)
+
+        for wave in self._get_waves(operations):
+            if jobs == 1 or len(wave) == 1:
+                for operation in wave:
+                    _execute(operation)
+            else:
+                with ThreadPoolExecutor(max_workers=jobs) as executor:
+                    list(executor.map(_execute, wave))
+        for directory in directories_to_remove:
+            if os.path.isdir(directory) and not os.listdir(directory):
+                os.rmdir(directory)
+        if staged:
+            self._publish_staged_directories(staging, journal=journal)
+        if self.checksums is not None:
+            self.checksums.save()
+
+    def _stage_subject_directories(self, journal=None):
+        """
+        :return: dictionary of subject directory -> staging directory for each subject directory the plan writes to.
+        """
+        if self.root is None:
+            raise ValueError("Staged writes need the directory of the dataset the plan writes to.")
+        staging_root = self.staging_directory
+        paths = set(self.directories + self.directories_to_remove)
+        for operation in self.operations:
+            paths.update((operation.source, operation.destination))
+        staging = dict()
+        for path in paths:
+            if not path or not path.startswith(self.root + os.sep):
+                continue
+            name = os.path.relpath(path, self.root).split(os.sep)[0]
+            directory = os.path.join(self.root, name)
+            if (name.startswith("sub-") and directory not in staging
+                    and not (journal is not None and journal.is_done("publish", directory))):
+                staging[directory] = os.path.join(staging_root, name)
+        if staging and not os.path.exists(staging_root):
+            os.makedirs(staging_root)
+        for directory, staging_directory in staging.items():
+            if journal is not None and journal.is_done("stage", directory):
+                continue
+            if os.path.exists(staging_directory):
+                # left over from an interrupted copy
+                shutil.rmtree(staging_directory)
+            if os.path.isdir(directory):
+                # hard links share the data of the published files; files are only ever replaced in the staging
+                # directory, never written in place, so the published files do not change
+                shutil.copytree(directory, staging_directory, symlinks=True, copy_function=hardlink_or_copy)
+            if journal is not None:
+                journal.record("stage", directory)
+        return staging
+
+    @staticmethod
+    def _get_staged_path(path, staging):
+        if path:
+            for directory, staging_directory in staging.items():
+                if path == directory or path.startswith(directory + os.sep):
+                    return staging_directory + path[len(directory):]
+        return path
+
+    def _publish_staged_directories(self, staging, journal=None):
+        for directory, staging_directory in sorted(staging.items()):
+            if os.path.exists(staging_directory):
+                if os.path.exists(directory):
+                    exchange_paths(staging_directory, directory)
+                else:
+                    os.rename(staging_directory, directory)
+            elif os.path.exists(directory):
+                # everything was moved out of the subject directory (e.g. the subject was renamed)
+                shutil.rmtree(directory)
+            if journal is not None:
+                journal.record("publish", directory)
+        if self.checksums is not None:
+            self.checksums.move_directories([(staging_directory, directory)
+                                             for directory, staging_directory in staging.items()])
+        # what is left in the staging directory are the previous versions of the published subjects
+        if os.path.exists(self.staging_directory):
+            shutil.rmtree(self.staging_directory)
+
+    def _get_waves(self, operations):
+        # an operation that writes to a file that another operation still has to read or remove (e.g. run numbers
+        # being shifted by moves) has to wait for that operation to finish
+        pending = list(operations)
+        while pending:
+            sources = dict()
+            for index, operation in enumerate(pending):
+                if operation.source:
+                    sources.setdefault(operation.source, set()).add(index)
+            waiting = set(index for index, operation in enumerate(pending)
+                          if sources.get(operation.destination, set()).difference({index}))
+            if len(waiting) == len(pending):
+                # cyclic dependencies are executed in the order they were planned
+                for operation in pending:
+                    yield [operation]
+                return
+            yield [operation for index, operation in enumerate(pending) if index not in waiting]
+            pending = [operation for index, operation in enumerate(pending) if index in waiting]
+
+    def _execute_operation(self, operation):
+        if operation.action == "update_file":
+            update_file(operation.source, operation.destination, move=operation.data, checksums=self.checksums)
+        elif operation.action == "write_json":
+            write_json(operation.data, operation.destination)
+        elif operation.action == "write_tsv":
+            data, first_column = operation.data
+            write_tsv(data, operation.destination, first_colum=first_column)
+        elif operation.action == "write_text":
+            text, overwrite = operation.data
+            if overwrite or not os.path.isfile(operation.destination):
+                tmp_file = operation.destination + ".tmp"
+                with open(tmp_file, "w") as opened_file:
+                    opened_file.write(text)
+                os.replace(tmp_file, operation.destination)
+        elif operation.action == "remove":
+            # the file may already have been removed by an interrupted execution of the plan
+            if os.path.lexists(operation.source):
+                os.remove(operation.source)
+            if self.checksums is not None:
+                self.checksums.forget(operation.source)
+        else:
+            raise ValueError("Unknown write operation: {}".format(operation.action))
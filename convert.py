@@ -48,6 +48,109 @@ def parse_args():
         action="store_true",
         help="Disable anonymization of sensitive patient data during conversion (not recommended).",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes used to read DICOM headers and run dcm2niix per series, and of threads used "
+             "to write the BIDS files (0 uses all CPUs).",
+    )
+    parser.add_argument(
+        "--header-index",
+        type=str,
+        default=None,
+        help="Optional SQLite file used to cache DICOM headers between runs; only new or changed files are re-read.",
+    )
+    parser.add_argument(
+        "--rebuild-header-index",
+        action="store_true",
+        help="Discard the cached entries of --header-index and re-read every DICOM header.",
+    )
+    parser.add_argument(
+        "--selective-conversion",
+        action="store_true",
+        help="Classify series from their DICOM headers and only convert the series that map to a modality.",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Predict the BIDS layout from the DICOM headers and write it to output_dir/source/conversion_plan.csv "
+             "without running dcm2niix.",
+    )
+    parser.add_argument(
+        "--identifiers-from-dcm2niix",
+        action="store_true",
+        help="Read PatientName/PatientID from the dcm2niix output instead of a separate pydicom pass over the input.",
+    )
+    parser.add_argument(
+        "--conversion-cache",
+        type=str,
+        default=None,
+        help="Optional directory that caches the dcm2niix output of each series so unchanged series are not "
+             "converted again.",
+    )
+    parser.add_argument(
+        "--conversion-cache-size",
+        type=float,
+        default=None,
+        help="Maximum size of --conversion-cache in gigabytes; least recently used series are evicted first.",
+    )
+    parser.add_argument(
+        "--skip-converted",
+        action="store_true",
+        help="Do not convert series again that output_dir/source/series_manifest.csv shows were already written.",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and convert each series that arrives in input_dir once no new files have arrived for it "
+             "for --settle-time seconds.",
+    )
+    parser.add_argument(
+        "--settle-time",
+        type=float,
+        default=10,
+        help="Seconds without new files after which a series is considered complete in --watch mode.",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=2,
+        help="Seconds between scans of input_dir in --watch mode.",
+    )
+    parser.add_argument(
+        "--staged",
+        action="store_true",
+        help="Write each subject into a hidden staging directory in output_dir and publish it with a single rename, "
+             "so that jobs reading output_dir never see a partly written subject.",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="With more than one job or a --conversion-cache, write each session into output_dir as soon as all of "
+             "its series are converted, while dcm2niix is still running on the other series. Cannot be combined with "
+             "--journal or --resume.",
+    )
+    parser.add_argument(
+        "--journal",
+        action="store_true",
+        help="Record the completed stages of the conversion in output_dir and keep the temporary dcm2niix outputs if "
+             "it is interrupted, so that it can be continued with --resume.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted --journal conversion of input_dir into output_dir from its last completed stage "
+             "instead of converting everything again.",
+    )
+    parser.add_argument(
+        "--scratch-dir",
+        type=str,
+        default=None,
+        help="Directory for the temporary dcm2niix outputs (default: a hidden directory next to output_dir, "
+             ".<output_dir name>.bidsmanager_scratch). A directory on the same filesystem as output_dir lets the "
+             "outputs be moved into it by renaming instead of copying.",
+    )
     parser.add_argument("--verbose", action="store_true", help="Enable verbose output.")
     parser.add_argument("--debug", action="store_true", help="Enable debug output.")
     return parser.parse_args()
@@ -78,6 +181,14 @@ def main():
     if isinstance(source_ids, str):
         source_ids = [source_ids]
 
+    header_index = os.path.abspath(args.header_index) if args.header_index else None
+    scratch_directory = os.path.abspath(args.scratch_dir) if args.scratch_dir else None
+
+    conversion_cache = os.path.abspath(args.conversion_cache) if args.conversion_cache else None
+    conversion_cache_size = None
+    if args.conversion_cache_size is not None:
+        conversion_cache_size = int(args.conversion_cache_size * 1024 ** 3)
+
     input_dir = os.path.abspath(args.input_dir)
     output_dir = os.path.abspath(args.output_dir)
     verbose = args.verbose
@@ -87,17 +198,37 @@ def main():
         output_file = os.path.join(output_dir, "source", "dicom_files.csv")
         os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
-    convert_dicom_directory(input_directory=input_dir,
-                            heuristic=heuristic,
-                            anonymize=not args.no_anonymize,
-                            bids_directory=output_dir,
-                            delete_intermediates=True,
-                            verbose=verbose,
-                            use_session_dates=use_session_dates,
-                            combine_sessions=combine_sessions,
-                            subject_map=subject_map,
-                            source_ids=source_ids,
-                            cleanup_temp_directory=not args.debug)
+    convert_kwargs = dict(heuristic=heuristic,
+                          anonymize=not args.no_anonymize,
+                          bids_directory=output_dir,
+                          delete_intermediates=True,
+                          verbose=verbose,
+                          use_session_dates=use_session_dates,
+                          combine_sessions=combine_sessions,
+                          subject_map=subject_map,
+                          source_ids=source_ids,
+                          cleanup_temp_directory=not args.debug,
+                          jobs=args.jobs,
+                          header_index=header_index,
+                          rebuild_header_index=args.rebuild_header_index,
+                          selective_conversion=args.selective_conversion,
+                          plan_only=args.plan,
+                          identifiers_from_dcm2niix=args.identifiers_from_dcm2niix,
+                          conversion_cache=conversion_cache,
+                          conversion_cache_size=conversion_cache_size,
+                          skip_converted_series=args.skip_converted,
+                          staged=args.staged,
+                          stream=args.stream,
+                          journal=args.journal,
+                          resume=args.resume,
+                          scratch_directory=scratch_directory)
+
+    if args.watch:
+        from bidsmanager.read.ingest import watch_dicom_directory
+        watch_dicom_directory(input_directory=input_dir, settle_time=args.settle_time,
+                              poll_interval=args.poll_interval, **convert_kwargs)
+    else:
+        convert_dicom_directory(input_directory=input_dir, **convert_kwargs)
 
 
 if __name__ == "__main__":